@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+'''
+Throughput of federation crypto under concurrent requests with each kind of
+CryptoExecutor. Request threads each open and verify a stream of envelopes
+(decrypt_payload and verify_signature, as validate_payload and
+validate_connection do) through an app configured with the executor.
+
+    python benchmarks/crypto_executor.py --threads 8 --messages 50 --workers 4
+
+Process pools only help with more than one CPU - compare against nproc.
+'''
+import argparse
+import os
+import sys
+import threading
+import time
+
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from socialmedia import create_app
+from socialmedia.crypto_executor import KINDS, CryptoExecutor
+from socialmedia.key_pool import KeyPool
+from socialmedia.models import Profile
+from socialmedia.views.utils import (
+    EC_SUITE,
+    RSA_SUITE,
+    decrypt_payload,
+    secure_envelope,
+    verify_signature,
+)
+
+def _keys(suite):
+    if suite == EC_SUITE:
+        public_key, private_key = Profile.generate_ec_keys()
+        return SimpleNamespace(ec_public_key=public_key, ec_private_key=private_key)
+    public_key, private_key = Profile.generate_keys()
+    return SimpleNamespace(public_key=public_key, private_key=private_key)
+
+def _run(app, suite, threads, messages, payload):
+    sender, receiver = _keys(suite), _keys(suite)
+    with app.app_context():
+        envelope = secure_envelope(sender, receiver, payload)
+
+    def receive():
+        with app.app_context():
+            for _ in range(messages):
+                received = decrypt_payload(
+                    receiver, envelope['enc_key'], envelope['enc_payload'],
+                    envelope['nonce'], envelope['tag'], suite,
+                )
+                verify_signature(sender, envelope['signature'], received, suite)
+
+    workers = [threading.Thread(target=receive) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--threads', type=int, default=8,
+        help='concurrent request threads')
+    parser.add_argument('--messages', type=int, default=50,
+        help='envelopes each thread opens')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+        help='executor workers')
+    parser.add_argument('--payload-size', type=int, default=64 * 1024,
+        help='approximate payload size in bytes')
+    parser.add_argument('--suite', choices=(RSA_SUITE, EC_SUITE), default=RSA_SUITE)
+    args = parser.parse_args()
+
+    payload = {'posts': ['x' * 1000] * max(1, args.payload_size // 1004)}
+    total = args.threads * args.messages
+    print(f'{os.cpu_count()} CPUs, {args.threads} threads x {args.messages} {args.suite} envelopes')
+    print(f'{"executor":<8} {"seconds":>8} {"msgs/s":>8} {"avg wait ms":>12} {"avg run ms":>11}')
+    for kind in KINDS:
+        executor = CryptoExecutor(kind=kind, workers=args.workers)
+        app = create_app(
+            None, None, None, mock.Mock(), None, None, None,
+            key_pool=KeyPool(size=0), crypto_executor=executor,
+        )
+        # start the pool's workers before timing
+        executor.run(pow, 2, 2)
+        elapsed = _run(app, args.suite, args.threads, args.messages, payload)
+        executor.shutdown()
+        stats = executor.stats()
+        print(
+            f'{kind:<8} {elapsed:>8.2f} {total / elapsed:>8.1f} '
+            f'{stats["avg_wait_seconds"] * 1000:>12.2f} {stats["avg_run_seconds"] * 1000:>11.2f}'
+        )
+
+if __name__ == '__main__':
+    main()
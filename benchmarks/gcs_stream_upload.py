@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+'''
+Throughput and peak memory of GCSObjectStreamUpload's buffering, compared with
+the previous implementation (which copied the whole buffer on every write and
+read). Nothing is uploaded - the resumable upload is replaced with one that
+reads chunks from the stream the same way and discards them.
+
+    python benchmarks/gcs_stream_upload.py --sizes 10 100 1000
+
+Each run happens in a fresh process so peak RSS is per run.
+'''
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from socialmedia.gcloud.gcs_object_stream_upload import GCSObjectStreamUpload
+
+MB = 1024 * 1024
+
+class DiscardingUpload():
+    ''' reads chunks from the stream like ResumableUpload, without sending them '''
+
+    def __init__(self, stream, chunk_size):
+        self._stream = stream
+        self._chunk_size = chunk_size
+
+    def transmit_next_chunk(self, transport):
+        self._stream.read(self._chunk_size)
+
+class LegacyStreamUpload(GCSObjectStreamUpload):
+    ''' the buffering GCSObjectStreamUpload used before '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._buffer = b''
+
+    def write(self, data):
+        data_len = len(data)
+        self._buffer_size += data_len
+        self._buffer += data
+        del data
+        while self._buffer_size >= self._chunk_size:
+            self._request.transmit_next_chunk(self._transport)
+        return data_len
+
+    def read(self, chunk_size):
+        to_read = min(chunk_size, self._buffer_size)
+        memview = memoryview(self._buffer)
+        self._buffer = memview[to_read:].tobytes()
+        self._read += to_read
+        self._buffer_size -= to_read
+        return memview[:to_read].tobytes()
+
+def _run(upload_cls, size_mb, write_size, chunk_size, results):
+    upload = upload_cls(
+        client=mock.Mock(),
+        bucket_name='bucket',
+        blob_name='blob',
+        content_type='application/octet-stream',
+        chunk_size=chunk_size,
+    )
+    upload._request = DiscardingUpload(upload, chunk_size)
+    data = os.urandom(write_size)
+    writes = size_mb * MB // write_size
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for _ in range(writes):
+        upload.write(data)
+    upload.stop()
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((upload.tell(), elapsed, peak_kb, peak_kb - baseline_kb))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+        help='stream sizes in MB')
+    parser.add_argument('--write-size', type=int, default=64 * 1024,
+        help='bytes per write (werkzeug hands over 64KB at a time)')
+    parser.add_argument('--chunk-size', type=int, default=MB,
+        help='upload chunk size')
+    parser.add_argument('--skip-legacy', action='store_true',
+        help="don't run the old implementation (slow for large sizes)")
+    args = parser.parse_args()
+
+    implementations = [('current', GCSObjectStreamUpload)]
+    if not args.skip_legacy:
+        implementations.append(('legacy', LegacyStreamUpload))
+    context = multiprocessing.get_context('spawn')
+    print(f'{"impl":<8} {"size MB":>8} {"seconds":>9} {"MB/s":>9} {"peak RSS MB":>12} {"growth MB":>10}')
+    for size_mb in args.sizes:
+        for name, upload_cls in implementations:
+            results = context.Queue()
+            process = context.Process(
+                target=_run,
+                args=(upload_cls, size_mb, args.write_size, args.chunk_size, results),
+            )
+            process.start()
+            uploaded, elapsed, peak_kb, growth_kb = results.get()
+            process.join()
+            assert uploaded == size_mb * MB // args.write_size * args.write_size
+            print(
+                f'{name:<8} {size_mb:>8} {elapsed:>9.3f} {size_mb / elapsed:>9.1f} '
+                f'{peak_kb / 1024:>12.1f} {growth_kb / 1024:>10.1f}'
+            )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+'''
+Per-message CPU of the RSA and EC (Ed25519/X25519) key suites - encrypting and
+signing a payload, then decrypting it and verifying the signature, the way
+secure_envelope, open_envelope and validate_connection do. Also reports key
+generation time and how many bytes the envelope adds on the wire.
+
+    python benchmarks/key_suites.py --messages 500 --payload-size 2048
+'''
+import argparse
+import json
+import os
+import sys
+import time
+
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask
+
+from socialmedia.models import Profile
+from socialmedia.views.utils import (
+    EC_SUITE,
+    RSA_SUITE,
+    decrypt_payload,
+    ec_enc_and_sign_payload,
+    enc_and_sign_payload,
+    verify_signature,
+)
+
+def _profile(suite):
+    start = time.process_time()
+    if suite == EC_SUITE:
+        public_key, private_key = Profile.generate_ec_keys()
+        keys = {'ec_public_key': public_key, 'ec_private_key': private_key}
+    else:
+        public_key, private_key = Profile.generate_keys()
+        keys = {'public_key': public_key, 'private_key': private_key}
+    return SimpleNamespace(**keys), time.process_time() - start
+
+def _run(suite, messages, payload):
+    sender, sender_keygen = _profile(suite)
+    receiver, receiver_keygen = _profile(suite)
+    # each side's connection to the other holds the other's public key
+    to_receiver = SimpleNamespace(
+        public_key=getattr(receiver, 'public_key', None),
+        ec_public_key=getattr(receiver, 'ec_public_key', None),
+    )
+    to_sender = SimpleNamespace(
+        public_key=getattr(sender, 'public_key', None),
+        ec_public_key=getattr(sender, 'ec_public_key', None),
+    )
+    enc_and_sign = ec_enc_and_sign_payload if suite == EC_SUITE else enc_and_sign_payload
+    send_seconds = receive_seconds = 0.0
+    for _ in range(messages):
+        start = time.process_time()
+        enc_payload, enc_key, signature, nonce, tag = enc_and_sign(
+            sender, to_receiver, payload
+        )
+        send_seconds += time.process_time() - start
+        start = time.process_time()
+        received = decrypt_payload(receiver, enc_key, enc_payload, nonce, tag, suite)
+        verify_signature(to_sender, signature, received, suite)
+        receive_seconds += time.process_time() - start
+        assert received == payload
+    return {
+        'keygen_ms': (sender_keygen + receiver_keygen) / 2 * 1000,
+        'send_ms': send_seconds / messages * 1000,
+        'receive_ms': receive_seconds / messages * 1000,
+        # the envelope's key and signature fields
+        'overhead_bytes': len(enc_key) + len(signature),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--messages', type=int, default=500,
+        help='messages per suite')
+    parser.add_argument('--payload-size', type=int, default=2048,
+        help='approximate payload size in bytes')
+    args = parser.parse_args()
+
+    payload = {'post_ids': ['x' * 30] * max(1, args.payload_size // 34)}
+    print(f'payload {len(json.dumps(payload))} bytes, {args.messages} messages per suite')
+    print(f'{"suite":<8} {"keygen ms":>10} {"send ms":>9} {"receive ms":>11} {"total ms":>9} {"overhead B":>11}')
+    with Flask(__name__).app_context():
+        for suite in (RSA_SUITE, EC_SUITE):
+            result = _run(suite, args.messages, payload)
+            print(
+                f'{suite:<8} {result["keygen_ms"]:>10.1f} {result["send_ms"]:>9.3f} '
+                f'{result["receive_ms"]:>11.3f} '
+                f'{result["send_ms"] + result["receive_ms"]:>9.3f} {result["overhead_bytes"]:>11}'
+            )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+'''
+Wire size and latency of federation replies with and without compression.
+Builds retrieve-posts style feeds - posts with their authors' profiles,
+signed file URLs and nested comments - then seals them with secure_envelope
+and opens them with open_envelope for each compression available.
+
+    python benchmarks/payload_compression.py --posts 20 100 500
+
+zstd is only measured if zstandard is installed.
+'''
+import argparse
+import json
+import os
+import random
+import secrets
+import string
+import sys
+import time
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dateutil import tz
+
+from socialmedia import compression, connection_status, create_app
+from socialmedia.key_pool import KeyPool
+from socialmedia.models import Connection, Profile
+from socialmedia.views.utils import open_envelope, secure_envelope
+
+WORDS = [
+    ''.join(random.choice(string.ascii_lowercase) for _ in range(random.randint(2, 9)))
+    for _ in range(2000)
+]
+
+def _signed_url(filename):
+    # shaped like a GCS V4 signed URL - the signature doesn't compress
+    return (
+        f'https://storage.googleapis.com/project.appspot.com/{filename}'
+        '?X-Goog-Algorithm=GOOG4-RSA-SHA256'
+        '&X-Goog-Credential=project%40appspot.gserviceaccount.com%2F20240101%2Fauto%2Fstorage%2Fgoog4_request'
+        f'&X-Goog-Date=20240101T000000Z&X-Goog-Expires=900&X-Goog-SignedHeaders=host'
+        f'&X-Goog-Signature={secrets.token_hex(256)}'
+    )
+
+def _text(words):
+    return ' '.join(random.choice(WORDS) for _ in range(words))
+
+def _feed(author, commenters, posts):
+    now = datetime.now().astimezone(tz.UTC)
+    feed = []
+    for i in range(posts):
+        created = now - timedelta(minutes=i * 7)
+        feed.append({
+            'profile': author.as_json(),
+            'id': secrets.token_hex(16),
+            'text': _text(random.randint(5, 60)),
+            'created': str(created),
+            'updated': str(created),
+            'files': [
+                _signed_url(f'{secrets.token_hex(8)}_640w.jpg')
+                for _ in range(random.choice((0, 0, 1, 1, 2, 4)))
+            ],
+            'comments': [{
+                'profile': commenter.as_json(),
+                'id': secrets.token_hex(16),
+                'post_id': secrets.token_hex(16),
+                'text': _text(random.randint(3, 30)),
+                'created': str(created + timedelta(minutes=1)),
+                'files': [],
+            } for commenter in random.sample(commenters, random.randint(0, len(commenters)))],
+        })
+    return feed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--posts', type=int, nargs='+', default=[20, 100, 500],
+        help='posts per feed')
+    parser.add_argument('--runs', type=int, default=5,
+        help='times each feed is sealed and opened')
+    args = parser.parse_args()
+
+    random.seed(1)
+    app = create_app(
+        None, None, None, mock.Mock(), None, None, None, key_pool=KeyPool(size=0),
+    )
+    author = Profile(display_name='Author', handle='author', user_id='1')
+    reader = Profile(display_name='Reader', handle='reader', user_id='2')
+    commenters = [
+        Profile(display_name=f'Commenter {i}', handle=f'commenter{i}', user_id=str(i + 3))
+        for i in range(5)
+    ]
+    # each side's connection to the other
+    to_reader = Connection(
+        profile=author, handle='reader', public_key=reader.public_key,
+        status=connection_status.CONNECTED,
+    )
+    to_author = Connection(
+        profile=reader, handle='author', public_key=author.public_key,
+        status=connection_status.CONNECTED,
+    )
+    print(f'{"posts":>6} {"compression":<12} {"JSON KB":>8} {"wire KB":>8} {"ratio":>6} '
+          f'{"seal ms":>8} {"open ms":>8}')
+    with app.app_context():
+        # parse and cache the keys before timing anything
+        open_envelope(reader, to_author, secure_envelope(author, to_reader, {}))
+        for posts in args.posts:
+            feed = _feed(author, commenters, posts)
+            json_size = len(json.dumps(feed))
+            for name in [None] + compression.available():
+                seal = unseal = 0.0
+                for _ in range(args.runs):
+                    start = time.perf_counter()
+                    envelope = secure_envelope(
+                        author, to_reader, feed, accept_compression=[name] if name else None
+                    )
+                    seal += time.perf_counter() - start
+                    start = time.perf_counter()
+                    opened = open_envelope(reader, to_author, envelope)
+                    unseal += time.perf_counter() - start
+                assert opened == feed
+                assert envelope.get('compression') == name
+                wire_size = len(json.dumps(envelope))
+                print(
+                    f'{posts:>6} {name or "none":<12} {json_size / 1024:>8.1f} '
+                    f'{wire_size / 1024:>8.1f} {json_size / wire_size:>6.2f} '
+                    f'{seal / args.runs * 1000:>8.2f} {unseal / args.runs * 1000:>8.2f}'
+                )
+
+if __name__ == '__main__':
+    main()
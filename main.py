@@ -1,7 +1,7 @@
 import os
 
 from socialmedia import create_app, datastore as gcloud_datastore
-from socialmedia.gcloud.gcs_object_stream_upload import gcs_stream_factory
+from socialmedia.gcloud.gcs_object_stream_upload import GCSObjectStore, gcs_stream_factory
 from socialmedia.gcloud.utils import (
     generate_signed_urls,
     get_shas,
@@ -10,7 +10,7 @@ from socialmedia.gcloud.utils import (
     update_frontend,
 )
 
-from google.cloud import datastore
+from google.cloud import datastore, storage
 
 try:
     import googleclouddebugger
@@ -20,6 +20,8 @@ try:
 except ImportError:
     pass
 
+storage_client = storage.Client()
+
 app = create_app(
     gcloud_datastore,
     gcs_stream_factory,
@@ -31,7 +33,12 @@ app = create_app(
     get_shas,
     update_backend,
     update_frontend,
+    object_store=GCSObjectStore(
+        storage_client.bucket(f'{storage_client.project}.appspot.com')
+    ),
 )
+# start generating key pairs for signups
+app.key_pool.start()
 
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8080, debug=True)
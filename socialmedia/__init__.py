@@ -1,18 +1,25 @@
 import os
 
-from flask import Flask
+from flask import Flask, request
 from flask_cors import CORS
 from flask_login import LoginManager
 
+from socialmedia import metrics, request_stats
+from socialmedia.crypto_executor import CryptoExecutor
+from socialmedia.http_client import HttpClient
+from socialmedia.key_pool import KeyPool
 from socialmedia.views.auth import auth, load_user, request_loader
 from socialmedia.views.main import blueprint as main
+from socialmedia.views.metrics import blueprint as metrics_blueprint
 from socialmedia.views.external_comms import blueprint as external_comms
 from socialmedia.views.queue_workers import blueprint as queue_workers
 from socialmedia.views.update import blueprint as update
+from socialmedia.views.utils import NEXT_CURSOR_HEADER
 
 def create_app(
     model_datastore, stream_factory, url_signer, task_manager, get_shas,
-    update_backend, update_frontend,
+    update_backend, update_frontend, http_client=None, object_store=None,
+    key_pool=None, crypto_executor=None,
 ):
     app = Flask(__name__)
     # main handles all direct requests from the browser (html and json)
@@ -24,8 +31,54 @@ def create_app(
     # queue_workers handles queue messages
     app.register_blueprint(queue_workers, url_prefix='/worker')
     app.register_blueprint(update, url_prefix='/update')
+    app.register_blueprint(metrics_blueprint, url_prefix='/metrics')
     app.config.update(
-        SECRET_KEY = os.environ.get('SECRET_KEY', 'e0c1dae0e44dd8239b8f01d83322d0cc')
+        SECRET_KEY = os.environ.get('SECRET_KEY', 'e0c1dae0e44dd8239b8f01d83322d0cc'),
+        POST_PAGE_SIZE = int(os.environ.get('POST_PAGE_SIZE', '20')),
+        # limits for requests made to several connections' hosts at once
+        FAN_OUT_CONCURRENCY = int(os.environ.get('FAN_OUT_CONCURRENCY', '10')),
+        FAN_OUT_TIMEOUT = float(os.environ.get('FAN_OUT_TIMEOUT', '5')),
+        CONNECTION_INFO_DEADLINE = float(os.environ.get('CONNECTION_INFO_DEADLINE', '5')),
+        # most connections on one host notified by a single post-notify task
+        POST_NOTIFY_BATCH_SIZE = int(os.environ.get('POST_NOTIFY_BATCH_SIZE', '100')),
+        # symmetric session keys with connections' hosts instead of RSA on
+        # every message. Keys are replaced after SESSION_KEY_TTL seconds and
+        # still accepted for SESSION_KEY_GRACE seconds after that
+        SESSION_KEYS = os.environ.get('SESSION_KEYS', 'false').lower() == 'true',
+        SESSION_KEY_TTL = int(os.environ.get('SESSION_KEY_TTL', '86400')),
+        SESSION_KEY_GRACE = int(os.environ.get('SESSION_KEY_GRACE', '300')),
+        # give new profiles Ed25519/X25519 keys as well as RSA ones - they're
+        # used with connections whose profiles have them too
+        EC_KEYS = os.environ.get('EC_KEYS', 'false').lower() == 'true',
+        # shared client for requests to other hosts
+        HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', '10')),
+        HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '3')),
+        HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '20')),
+        # seconds a connection's posts are cached for - has to be less than
+        # the time left on the signed URLs in them (see SIGNED_URL_MARGIN)
+        REMOTE_POSTS_CACHE_TTL = int(os.environ.get('REMOTE_POSTS_CACHE_TTL', '240')),
+        REMOTE_COMMENTS_CACHE_TTL = int(os.environ.get('REMOTE_COMMENTS_CACHE_TTL', '240')),
+        # widths of the resized copies made of uploaded images
+        MEDIA_VARIANT_WIDTHS = [
+            int(width) for width in
+            os.environ.get('MEDIA_VARIANT_WIDTHS', '320,640,1280').split(',')
+        ],
+        # RSA key pairs generated ahead of signups, and the processes
+        # generating them - 0 generates keys during the signup request
+        KEY_POOL_SIZE = int(os.environ.get('KEY_POOL_SIZE', '4')),
+        KEY_POOL_WORKERS = int(os.environ.get('KEY_POOL_WORKERS', '1')),
+        # where federation crypto runs - 'inline' (the request thread),
+        # 'thread' or 'process' (a pool of CRYPTO_WORKERS)
+        CRYPTO_EXECUTOR = os.environ.get('CRYPTO_EXECUTOR', 'inline'),
+        CRYPTO_WORKERS = int(os.environ.get('CRYPTO_WORKERS', '4')),
+        # compression accepted for federation replies, most preferred first
+        # (empty for none), and the smallest payload worth compressing
+        COMPRESSION = [
+            name for name in os.environ.get('COMPRESSION', 'zstd,zlib').split(',') if name
+        ],
+        COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024')),
+        # log each request's counters (datastore round trips, etc)
+        REQUEST_STATS_LOG = os.environ.get('REQUEST_STATS_LOG', 'false').lower() == 'true',
     )
 
     # need these for flask login management
@@ -40,10 +93,46 @@ def create_app(
 
     app.stream_factory = stream_factory
     app.url_signer = url_signer
+    # read/write access to uploaded files, for post-processing them
+    app.object_store = object_store
     app.task_manager = task_manager
     app.get_sha_function = get_shas
     app.update_backend_function = update_backend
     app.update_frontend_function = update_frontend
+    # pooled, keep-alive connections for requests to other hosts
+    app.http_client = http_client or HttpClient(
+        timeout=app.config['HTTP_TIMEOUT'],
+        retries=app.config['HTTP_RETRIES'],
+        pool_maxsize=app.config['HTTP_POOL_SIZE'],
+    )
+    metrics.register('http_client', app.http_client.stats)
+    # let the task manager share the pool if it hasn't been given its own
+    if getattr(task_manager, 'http_client', False) is None:
+        task_manager.http_client = app.http_client
+    # key pairs for new profiles
+    app.key_pool = key_pool or KeyPool(
+        size=app.config['KEY_POOL_SIZE'],
+        workers=app.config['KEY_POOL_WORKERS'],
+    )
+    metrics.register('key_pool', app.key_pool.stats)
+    # signing, verifying and encrypting federation payloads
+    app.crypto_executor = crypto_executor or CryptoExecutor(
+        kind=app.config['CRYPTO_EXECUTOR'],
+        workers=app.config['CRYPTO_WORKERS'],
+    )
+    metrics.register('crypto_executor', app.crypto_executor.stats)
+
+    @app.after_request
+    def report_request_stats(response):
+        # per-request counters (datastore round trips, etc) for diagnosing
+        # how much work each endpoint does - off by default since it's a line
+        # for every request
+        if not app.config['REQUEST_STATS_LOG']:
+            return response
+        stats = request_stats.get_all()
+        if stats:
+            print(f'[request_stats] {request.method} {request.path}: {stats}')
+        return response
 
-    CORS(app)
+    CORS(app, expose_headers=[NEXT_CURSOR_HEADER])
     return app
@@ -0,0 +1,160 @@
+'''
+Parallel composite uploads - a file is split into parts that are uploaded
+concurrently as separate objects, which the object store then composes into
+the final object. The parts are deleted afterwards.
+
+Object stores implement upload(name, data, content_type), read(name),
+compose(name, part_names, content_type) and delete(names). GCSObjectStore
+(socialmedia.gcloud.gcs_object_stream_upload) is the real one,
+LocalObjectStore keeps objects on the local filesystem.
+'''
+import os
+import shutil
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.utils import secure_filename
+
+# most objects a single compose accepts (the GCS limit)
+MAX_COMPOSE_COMPONENTS = 32
+
+class LocalObjectStore():
+    ''' object store on the local filesystem, for tests and local development '''
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def upload(self, name, data, content_type=None):
+        with open(self.path(name), 'wb') as f:
+            f.write(data)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def compose(self, name, part_names, content_type=None):
+        composing = f'{self.path(name)}.composing'
+        with open(composing, 'wb') as f:
+            for part_name in part_names:
+                with open(self.path(part_name), 'rb') as part:
+                    shutil.copyfileobj(part, f)
+        os.replace(composing, self.path(name))
+
+    def delete(self, names):
+        for name in names:
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+
+class ParallelCompositeUpload():
+    '''
+    Stream for werkzeug's form parser that uploads a file to store in parts of
+    part_size bytes, up to parallelism parts at a time, and composes them into
+    blob_name when the file is complete. A file that fits in one part is
+    uploaded as-is. Writes wait while parallelism parts are uploading, so about
+    (parallelism + 1) * part_size bytes are held in memory at most.
+    '''
+
+    def __init__(
+            self, store, blob_name, content_type='application/octet-stream',
+            part_size=8 * 1024 * 1024, parallelism=4,
+        ):
+        self._store = store
+        self._content_type = content_type
+        self._part_size = part_size
+        self._buffer = bytearray()
+        self._written = 0
+        self._parts = []
+        self._intermediates = []
+        self._futures = []
+        self._executor = ThreadPoolExecutor(max_workers=parallelism)
+        self._uploading = threading.BoundedSemaphore(parallelism)
+        self._done = False
+        self.filename = blob_name
+
+    def seek(self, pos):
+        # Flask appears to use this as an "I'm done" marker
+        if pos == 0:
+            self.stop()
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        self._written += len(data)
+        while len(self._buffer) >= self._part_size:
+            part = bytes(self._buffer[:self._part_size])
+            del self._buffer[:self._part_size]
+            self._upload_part(part)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._written
+
+    def stop(self):
+        if self._done:
+            return
+        self._done = True
+        try:
+            if not self._parts:
+                self._store.upload(self.filename, bytes(self._buffer), self._content_type)
+                return
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            self._buffer = bytearray()
+            # raises the first failed part's exception
+            for future in self._futures:
+                future.result()
+            self._compose(self.filename, self._parts)
+        finally:
+            self._executor.shutdown(wait=True)
+            if self._parts:
+                self._store.delete(self._parts + self._intermediates)
+
+    def _upload_part(self, data):
+        part_name = f'{self.filename}.part-{len(self._parts):05d}'
+        self._parts.append(part_name)
+        self._uploading.acquire()
+        future = self._executor.submit(
+            self._store.upload, part_name, data, self._content_type
+        )
+        future.add_done_callback(lambda _: self._uploading.release())
+        self._futures.append(future)
+
+    def _compose(self, name, part_names):
+        # compose only takes MAX_COMPOSE_COMPONENTS objects at once, so larger
+        # files are composed in rounds through intermediate objects
+        compose_round = 0
+        while len(part_names) > MAX_COMPOSE_COMPONENTS:
+            groups = [
+                part_names[i:i + MAX_COMPOSE_COMPONENTS]
+                for i in range(0, len(part_names), MAX_COMPOSE_COMPONENTS)
+            ]
+            intermediates = [
+                f'{name}.compose-{compose_round}-{i:05d}' for i in range(len(groups))
+            ]
+            self._intermediates.extend(intermediates)
+            futures = [
+                self._executor.submit(
+                    self._store.compose, intermediate, group, self._content_type
+                )
+                for intermediate, group in zip(intermediates, groups)
+            ]
+            for future in futures:
+                future.result()
+            part_names = intermediates
+            compose_round += 1
+        self._store.compose(name, part_names, self._content_type)
+
+def composite_stream_factory(store, part_size=8 * 1024 * 1024, parallelism=4):
+    ''' werkzeug stream factory uploading each file to store in parallel parts '''
+    def stream_factory(total_content_length, filename, content_type, content_length=None):
+        return ParallelCompositeUpload(
+            store, secure_filename(filename), content_type,
+            part_size=part_size, parallelism=parallelism,
+        )
+    return stream_factory
@@ -0,0 +1,54 @@
+'''
+Compression for federation payloads, applied to the plaintext before it's
+encrypted (ciphertext doesn't compress). zlib is always available, zstd
+needs the zstandard package - without it only zlib is offered.
+'''
+import io
+import zlib
+
+try:
+    import zstandard
+except ImportError: # pragma: no cover
+    zstandard = None
+
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+# most bytes a payload may decompress to - anything bigger is refused rather
+# than held in memory
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+def available():
+    ''' names of the supported algorithms, most preferred first '''
+    if zstandard is not None:
+        return [ZSTD, ZLIB]
+    return [ZLIB]
+
+def compress(name, data):
+    if name == ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if name == ZLIB:
+        # most of the ratio of the default level 6 at around half the CPU
+        return zlib.compress(data, 3)
+    raise ValueError(f'Unsupported compression {name}')
+
+def decompress(name, data, max_size=MAX_DECOMPRESSED_SIZE):
+    ''' raises ValueError for unsupported or corrupt data, or data over max_size '''
+    if name == ZSTD and zstandard is not None:
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)) as reader:
+                decompressed = reader.read(max_size + 1)
+        except zstandard.ZstdError as e:
+            raise ValueError(f'Invalid zstd data: {e}')
+    elif name == ZLIB:
+        decompressor = zlib.decompressobj()
+        try:
+            decompressed = decompressor.decompress(data, max_size + 1)
+        except zlib.error as e:
+            raise ValueError(f'Invalid zlib data: {e}')
+        if not decompressor.eof and len(decompressed) <= max_size:
+            raise ValueError('Invalid zlib data: truncated')
+    else:
+        raise ValueError(f'Unsupported compression {name}')
+    if len(decompressed) > max_size:
+        raise ValueError(f'Decompressed payload larger than {max_size} bytes')
+    return decompressed
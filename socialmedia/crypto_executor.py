@@ -0,0 +1,125 @@
+'''
+Executor for the CPU-bound crypto in federation requests (RSA and EC key
+operations, AES over large payloads). With kind 'process' the work runs in
+worker processes, so concurrent requests on one server process don't queue
+behind each other for the GIL. 'thread' runs it on a bounded thread pool,
+which helps as far as the crypto libraries release the GIL in their C code,
+and 'inline' runs it on the calling thread, as before.
+
+Functions run by a process pool must be picklable - module-level functions
+taking keys as PEM/hex and payloads as bytes.
+'''
+import multiprocessing
+import threading
+import time
+
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+
+KINDS = ('inline', 'thread', 'process')
+
+def _timed(func, args):
+    # time.time rather than a monotonic clock so it's comparable across
+    # processes
+    started = time.time()
+    return started, func(*args)
+
+class CryptoExecutor():
+    '''
+    Runs crypto functions on a pool of workers of the given kind. Keeps
+    counts of queued and running calls, and how long calls wait for a worker
+    and take to run. The pool runs calls in the order they're submitted, so
+    any beyond the number of workers are queued.
+    '''
+
+    def __init__(self, kind='inline', workers=4):
+        if kind not in KINDS:
+            raise ValueError(f'Crypto executor kind must be one of [{", ".join(KINDS)}]')
+        self.kind = kind
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def _get_executor(self):
+        # created on first use, so process pools start after the web server
+        # has forked
+        with self._lock:
+            if self._executor is None:
+                if self.kind == 'process':
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn'),
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix='crypto',
+                    )
+            return self._executor
+
+    def run(self, func, *args):
+        ''' calls func(*args) on a worker and returns its result (or raises its exception) '''
+        submitted = time.time()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            if self.kind == 'inline':
+                started, result = _timed(func, args)
+            else:
+                executor = self._get_executor()
+                started, result = executor.submit(_timed, func, args).result()
+        except BrokenExecutor:
+            # a pool whose process died won't run anything else - the next
+            # call starts a new one
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            self._finished(submitted, None)
+            raise
+        except Exception:
+            self._finished(submitted, None)
+            raise
+        self._finished(submitted, started)
+        return result
+
+    def _finished(self, submitted, started):
+        finished = time.time()
+        with self._lock:
+            self.in_flight -= 1
+            self.calls += 1
+            if started is None:
+                self.errors += 1
+                return
+            wait = max(started - submitted, 0.0)
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            self.run_seconds += finished - started
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _capacity(self):
+        # inline calls each run on their own request thread
+        return self.in_flight if self.kind == 'inline' else self.workers
+
+    def stats(self):
+        with self._lock:
+            succeeded = self.calls - self.errors
+            return {
+                'kind': self.kind,
+                'workers': self.workers,
+                'queue_depth': max(self.in_flight - self._capacity(), 0),
+                'running': min(self.in_flight, self._capacity()),
+                'calls': self.calls,
+                'errors': self.errors,
+                'avg_wait_seconds': self.wait_seconds / succeeded if succeeded else 0.0,
+                'max_wait_seconds': self.max_wait_seconds,
+                'avg_run_seconds': self.run_seconds / succeeded if succeeded else 0.0,
+            }
@@ -5,4 +5,5 @@ from .message import Message
 from .post import Post
 from .post_reference import PostReference
 from .profile import Profile
+from .timeline_entry import TimelineEntry
 from .user import User
@@ -8,8 +8,10 @@ from .profile import Profile
 
 class Comment(BaseComment, DatastoreBase):
     kind = 'Comment'
+    parent_attr = 'profile'
+    parent_cls = Profile
 
-    def save(self):
+    def _entity(self):
         if not hasattr(self,'key'):
             key = datastore_client.key('Comment', self.id,
                 parent=getattr(self.profile, 'key')
@@ -19,9 +21,9 @@ class Comment(BaseComment, DatastoreBase):
             setattr(self, 'key', key)
         else:
             key = getattr(self, 'key')
-        comment_entity = datastore.Entity(key=key)
+        comment_entity = datastore.Entity(key=key, exclude_from_indexes=('variants',))
         comment_entity.update(self.as_dict())
-        datastore_client.put(comment_entity)
+        return comment_entity
 
     def as_dict(self):
         return {
@@ -29,10 +31,6 @@ class Comment(BaseComment, DatastoreBase):
             'post_id': self.post_id,
             'text': self.text,
             'files': self.files,
+            'variants': self.variants,
             'created': self.created,
         }
-
-    def from_datastore_obj(self, datastore_obj):
-        if not self.profile:
-            datastore_obj = datastore_client.get(self.key.parent)
-            self.profile = Profile._build_obj(datastore_obj) # pylint: disable=protected-access
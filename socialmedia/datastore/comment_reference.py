@@ -10,8 +10,10 @@ from .dataclient import datastore_client
 
 class CommentReference(BaseCommentReference, DatastoreBase):
     kind = 'CommentReference'
+    parent_attr = 'connection'
+    parent_cls = Connection
 
-    def save(self):
+    def _entity(self):
         if not hasattr(self,'key'):
             key = datastore_client.key('CommentReference', str(uuid4()),
                 parent=getattr(self.connection, 'key')
@@ -23,7 +25,7 @@ class CommentReference(BaseCommentReference, DatastoreBase):
             key = getattr(self, 'key')
         notification_entity = datastore.Entity(key=key)
         notification_entity.update(self.as_dict())
-        datastore_client.put(notification_entity)
+        return notification_entity
 
     def as_dict(self):
         return {
@@ -32,8 +34,3 @@ class CommentReference(BaseCommentReference, DatastoreBase):
             'reference_read': self.reference_read,
             'created': self.created
         }
-
-    def from_datastore_obj(self, datastore_obj):
-        if not self.connection:
-            datastore_obj = datastore_client.get(self.key.parent)
-            self.connection = Connection._build_obj(datastore_obj) # pylint: disable=protected-access
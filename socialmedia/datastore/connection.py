@@ -8,8 +8,10 @@ from .profile import Profile
 
 class Connection(BaseConnection, DatastoreBase):
     kind = 'Connection'
+    parent_attr = 'profile'
+    parent_cls = Profile
 
-    def save(self):
+    def _entity(self):
         if not hasattr(self,'key'):
             key = datastore_client.key('Connection', self.id,
                 parent=getattr(self.profile, 'key')
@@ -19,9 +21,11 @@ class Connection(BaseConnection, DatastoreBase):
             setattr(self, 'key', key)
         else:
             key = getattr(self, 'key')
-        connection_entity = datastore.Entity(key=key, exclude_from_indexes=('public_key',))
+        connection_entity = datastore.Entity(key=key, exclude_from_indexes=(
+            'public_key', 'ec_public_key', 'session_key', 'prev_session_key',
+        ))
         connection_entity.update(self.as_dict())
-        datastore_client.put(connection_entity)
+        return connection_entity
 
     def as_dict(self):
         return {
@@ -30,13 +34,15 @@ class Connection(BaseConnection, DatastoreBase):
             'handle': self.handle,
             'display_name': self.display_name,
             'public_key': self.public_key,
+            'ec_public_key': self.ec_public_key,
             'status': self.status,
             'created': self.created,
             'updated': self.updated,
             'read': self.read,
+            'session_id': self.session_id,
+            'session_key': self.session_key,
+            'session_expires': self.session_expires,
+            'prev_session_id': self.prev_session_id,
+            'prev_session_key': self.prev_session_key,
+            'prev_session_expires': self.prev_session_expires,
         }
-
-    def from_datastore_obj(self, datastore_obj):
-        if not self.profile:
-            datastore_obj = datastore_client.get(self.key.parent)
-            self.profile = Profile._build_obj(datastore_obj) # pylint: disable=protected-access
@@ -0,0 +1,112 @@
+'''
+Sharded counters - the number of entities of a kind stored under a parent
+(such as a profile's posts), kept in CounterShard entities under the parent so
+counting doesn't have to read every key.
+
+Shard 0 is the base, written when a counter is initialized or repaired.
+Entities being created or deleted add to one of the other shards, picked at
+random, in the same transaction as the write so concurrent writes rarely
+touch the same shard. A counter without a base hasn't been initialized -
+writes leave it alone and it's initialized the first time it's read.
+'''
+import os
+import random
+
+from google.api_core.exceptions import Conflict
+from google.cloud import datastore
+
+from socialmedia import request_stats
+
+from .dataclient import datastore_client
+
+KIND = 'CounterShard'
+NUM_SHARDS = int(os.environ.get('COUNTER_SHARDS', '10'))
+TRANSACTION_RETRIES = 3
+
+def _round_trips(count=1):
+    request_stats.increment('datastore_round_trips', count)
+
+def _shard_key(parent_key, counted_kind, shard):
+    return datastore_client.key(KIND, f'{counted_kind}-{shard}', parent=parent_key)
+
+def _shard_entity(key, counted_kind, count):
+    shard = datastore.Entity(key=key)
+    shard.update({'counted_kind': counted_kind, 'count': count})
+    return shard
+
+def _shards_query(parent_key, counted_kind):
+    query = datastore_client.query(kind=KIND)
+    query.ancestor = parent_key
+    query.add_filter('counted_kind', '=', counted_kind)
+    return query
+
+def run_in_transaction(func):
+    '''
+    runs func in a transaction, retrying it when the transaction conflicts
+    with another one
+    '''
+    for attempt in range(TRANSACTION_RETRIES):
+        try:
+            with datastore_client.transaction():
+                result = func()
+            _round_trips(2) # begin and commit
+            return result
+        except Conflict:
+            _round_trips(2)
+            if attempt == TRANSACTION_RETRIES - 1:
+                raise
+            print(f'[counter] transaction conflict, retrying ({attempt + 1})')
+
+def add(parent_key, counted_kind, amount):
+    '''
+    adds amount to a random shard of the counter - must be called in a
+    transaction
+    '''
+    base_key = _shard_key(parent_key, counted_kind, 0)
+    shard_key = _shard_key(parent_key, counted_kind, random.randint(1, max(NUM_SHARDS - 1, 1)))
+    shards = {shard.key: shard for shard in datastore_client.get_multi([base_key, shard_key])}
+    _round_trips()
+    if base_key not in shards:
+        return
+    shard = shards.get(shard_key) or _shard_entity(shard_key, counted_kind, 0)
+    shard['count'] += amount
+    datastore_client.put(shard)
+
+def read(parent_key, counted_kind):
+    ''' returns the counter's value, or None if it hasn't been initialized '''
+    shards = list(_shards_query(parent_key, counted_kind).fetch())
+    _round_trips()
+    base_key = _shard_key(parent_key, counted_kind, 0)
+    if not any(shard.key == base_key for shard in shards):
+        return None
+    return sum(shard['count'] for shard in shards)
+
+def aggregate_count(query):
+    ''' counts query's results with an aggregation query '''
+    aggregation_query = datastore_client.aggregation_query(query)
+    aggregation_query.count(alias='count')
+    results = list(aggregation_query.fetch())
+    _round_trips()
+    return results[0][0].value if results and results[0] else 0
+
+def reset(parent_key, counted_kind, query):
+    '''
+    recounts query (which must be an ancestor query on parent_key) and
+    replaces the counter's shards with a base holding the count, unless the
+    counter already matches. Returns (counter value before, count).
+    '''
+    def _reset():
+        count = aggregate_count(query)
+        shards = list(_shards_query(parent_key, counted_kind).fetch())
+        _round_trips()
+        base_key = _shard_key(parent_key, counted_kind, 0)
+        counted = None
+        if any(shard.key == base_key for shard in shards):
+            counted = sum(shard['count'] for shard in shards)
+        if counted != count:
+            stale_keys = [shard.key for shard in shards if shard.key != base_key]
+            if stale_keys:
+                datastore_client.delete_multi(stale_keys)
+            datastore_client.put(_shard_entity(base_key, counted_kind, count))
+        return counted, count
+    return run_in_transaction(_reset)
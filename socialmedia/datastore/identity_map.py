@@ -0,0 +1,88 @@
+import copy
+
+from flask import g, has_app_context
+
+from socialmedia import request_stats
+
+class IdentityMap():
+    '''
+    Request-scoped cache in front of the datastore. Entities are tracked by
+    key so each one is built at most once per request, and query results are
+    cached by kind and keyword arguments. Any write drops every cached query
+    result since there is no cheap way to tell which queries it affects.
+    Every caller in a request gets the same instance of an entity, so an
+    unsaved change made by one is seen by the others. Only writes made
+    through DatastoreBase invalidate the cache - anything writing with the
+    datastore client directly isn't seen by queries already cached.
+    '''
+
+    def __init__(self):
+        self.entities = {}
+        self.queries = {}
+
+    @classmethod
+    def current(cls):
+        ''' returns the identity map for the current request, if there is one '''
+        if not has_app_context():
+            return None
+        if 'datastore_identity_map' not in g:
+            g.datastore_identity_map = cls()
+        return g.datastore_identity_map
+
+    @classmethod
+    def query_key(cls, kind, method, kwargs):
+        '''
+        builds a hashable key for a query, or None if the query can't be cached
+        '''
+        items = []
+        for name, value in sorted(kwargs.items()):
+            if hasattr(value, 'key') and hasattr(value, 'as_dict'):
+                # ancestor queries are keyed on the ancestor's key
+                value = ('ancestor', value.key)
+            elif isinstance(value, list):
+                value = tuple(value)
+            elif isinstance(value, set):
+                value = frozenset(value)
+            try:
+                hash(value)
+            except TypeError:
+                return None
+            items.append((name, value))
+        return (kind, method, tuple(items))
+
+    def get_query(self, query_key):
+        if query_key in self.queries:
+            request_stats.increment('identity_map_hits')
+            # shallow copy so callers can't change the cached list (this
+            # also keeps ResultPage.next_cursor)
+            return copy.copy(self.queries[query_key])
+        request_stats.increment('identity_map_misses')
+        return None
+
+    def set_query(self, query_key, results):
+        self.queries[query_key] = copy.copy(results)
+
+    def get_entity(self, key):
+        return self.entities.get(key)
+
+    def get_entities(self, keys):
+        '''
+        returns a dict of key -> object for keys already loaded and
+        a list of the keys that still need to be fetched
+        '''
+        found = {key: self.entities[key] for key in keys if key in self.entities}
+        missing = [key for key in keys if key not in found]
+        request_stats.increment('identity_map_hits', len(found))
+        request_stats.increment('identity_map_misses', len(missing))
+        return found, missing
+
+    def add_entity(self, obj):
+        self.entities[obj.key] = obj
+
+    def saved(self, obj):
+        self.queries.clear()
+        self.entities[obj.key] = obj
+
+    def deleted(self, obj):
+        self.queries.clear()
+        self.entities.pop(obj.key, None)
@@ -8,8 +8,10 @@ from .profile import Profile
 
 class Message(BaseMessage, DatastoreBase):
     kind = 'Message'
+    parent_attr = 'profile'
+    parent_cls = Profile
 
-    def save(self):
+    def _entity(self):
         if not hasattr(self,'key'):
             key = datastore_client.key('Message', self.id,
                 parent=getattr(self.profile, 'key')
@@ -21,7 +23,7 @@ class Message(BaseMessage, DatastoreBase):
             key = getattr(self, 'key')
         message_entity = datastore.Entity(key=key)
         message_entity.update(self.as_dict())
-        datastore_client.put(message_entity)
+        return message_entity
 
     def as_dict(self):
         return {
@@ -30,8 +32,3 @@ class Message(BaseMessage, DatastoreBase):
             'files': self.files,
             'created': self.created,
         }
-
-    def from_datastore_obj(self, datastore_obj):
-        if not self.profile:
-            datastore_obj = datastore_client.get(self.key.parent)
-            self.profile = Profile._build_obj(datastore_obj) # pylint: disable=protected-access
@@ -1,17 +1,145 @@
+import binascii
+
+from collections import defaultdict
 from datetime import datetime
 
+from google.api_core.exceptions import BadRequest
+
+from socialmedia import request_stats
+from socialmedia.models import ResultPage
+
+from . import counter
 from .dataclient import datastore_client
+from .identity_map import IdentityMap
+
+# most entities a single commit may write
+MAX_BATCH_SIZE = 500
+# keyword suffixes that filter with another operator than =
+# e.g. list(created__lte=watermark, post_id__in=post_ids)
+FILTER_OPERATORS = {
+    'lt': '<',
+    'lte': '<=',
+    'gt': '>',
+    'gte': '>=',
+    'ne': '!=',
+    'in': 'IN',
+}
+# most values a single IN filter may have - longer lists are split across
+# several queries
+IN_FILTER_LIMIT = 30
+
+def _round_trip():
+    request_stats.increment('datastore_round_trips')
 
 class DatastoreBase:
-    def save(self):
-        """ save method to implement """
+    # attribute holding the entity this kind is stored under and the
+    # class used to build it (e.g. posts are stored under their profile)
+    parent_attr = None
+    parent_cls = None
+    # whether the number of entities of this kind under each parent is kept
+    # in a sharded counter (see counter.py)
+    counted = False
+
+    def _entity(self):
+        """ method to implement that returns the object as a datastore
+            entity, setting its key if it doesn't have one yet """
 
     def as_dict(self):
         """ method to implement that returns object as dictionary """
 
+    def save(self):
+        created = not hasattr(self, 'key')
+        self._put(self._entity(), created=created)
+
+    def _put(self, entity, created=False):
+        parent_key = entity.key.parent
+        if created and self.counted and parent_key is not None:
+            def _put_counted():
+                datastore_client.put(entity)
+                counter.add(parent_key, self.kind, 1)
+            counter.run_in_transaction(_put_counted)
+        else:
+            datastore_client.put(entity)
+            _round_trip()
+        identity_map = IdentityMap.current()
+        if identity_map:
+            identity_map.saved(self)
+
     def delete(self):
         if hasattr(self, 'key'):
-            datastore_client.delete(getattr(self, 'key'))
+            key = getattr(self, 'key')
+            if self.counted and key.parent is not None:
+                def _delete_counted():
+                    datastore_client.delete(key)
+                    counter.add(key.parent, self.kind, -1)
+                counter.run_in_transaction(_delete_counted)
+            else:
+                datastore_client.delete(key)
+                _round_trip()
+            identity_map = IdentityMap.current()
+            if identity_map:
+                identity_map.deleted(self)
+
+    @classmethod
+    def save_many(cls, objs):
+        '''
+        saves objs with one put_multi per MAX_BATCH_SIZE objects rather than
+        one put per object
+        '''
+        objs = list(objs)
+        # counter shards are written in the same commit for counted kinds
+        batch_size = MAX_BATCH_SIZE // 2 if cls.counted else MAX_BATCH_SIZE
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            created = defaultdict(int)
+            entities = []
+            for obj in batch:
+                is_new = not hasattr(obj, 'key')
+                entity = obj._entity()
+                if is_new and entity.key.parent is not None:
+                    created[entity.key.parent] += 1
+                entities.append(entity)
+            if cls.counted and created:
+                def _put_counted():
+                    datastore_client.put_multi(entities)
+                    for parent_key, amount in created.items():
+                        counter.add(parent_key, cls.kind, amount)
+                counter.run_in_transaction(_put_counted)
+            else:
+                datastore_client.put_multi(entities)
+                _round_trip()
+        identity_map = IdentityMap.current()
+        if identity_map:
+            for obj in objs:
+                identity_map.saved(obj)
+
+    @classmethod
+    def delete_many(cls, objs):
+        '''
+        deletes objs with one delete_multi per MAX_BATCH_SIZE objects rather
+        than one delete per object
+        '''
+        objs = [obj for obj in objs if hasattr(obj, 'key')]
+        batch_size = MAX_BATCH_SIZE // 2 if cls.counted else MAX_BATCH_SIZE
+        for start in range(0, len(objs), batch_size):
+            keys = [getattr(obj, 'key') for obj in objs[start:start + batch_size]]
+            deleted = defaultdict(int)
+            for key in keys:
+                if key.parent is not None:
+                    deleted[key.parent] += 1
+            if cls.counted and deleted:
+                def _delete_counted():
+                    datastore_client.delete_multi(keys)
+                    for parent_key, amount in deleted.items():
+                        counter.add(parent_key, cls.kind, -amount)
+                counter.run_in_transaction(_delete_counted)
+            else:
+                datastore_client.delete_multi(keys)
+                _round_trip()
+        identity_map = IdentityMap.current()
+        if identity_map:
+            for obj in objs:
+                identity_map.deleted(obj)
 
     @classmethod
     def get(cls, **kwargs):
@@ -20,16 +148,26 @@ class DatastoreBase:
         the first one foud if any
         '''
         _timer = datetime.now()
-        query = datastore_client.query(kind=cls.kind)
-        for key, value in kwargs.items():
-            if isinstance(value, DatastoreBase) and hasattr(value, 'key'):
-                query.ancestor=getattr(value, 'key')
-            else:
-                query.add_filter(key, '=', value)
-        results = list(query.fetch(limit=1))
+        identity_map = IdentityMap.current()
+        query_key = IdentityMap.query_key(cls.kind, 'get', kwargs) if identity_map else None
+        if query_key:
+            cached = identity_map.get_query(query_key)
+            if cached is not None:
+                return cached[0] if cached else None
+        kwarg_objects = {key: value for (key, value) in kwargs.items() if isinstance(value, DatastoreBase)}
+        results = []
+        for chunk_kwargs in cls._split_in_filter(kwargs):
+            query = datastore_client.query(kind=cls.kind)
+            cls._add_filters(query, chunk_kwargs)
+            results = list(query.fetch(limit=1))
+            _round_trip()
+            if results:
+                break
         obj = None
         if results:
-            obj = cls._build_obj(results[0])
+            obj = cls._build_objs(results, kwarg_objects)[0]
+        if query_key:
+            identity_map.set_query(query_key, [obj] if obj else [])
         print(f'[datastore] get({cls.kind}, {kwargs}): {(datetime.now() - _timer).total_seconds()}')
         return obj
 
@@ -38,50 +176,196 @@ class DatastoreBase:
         '''
         executes a search using provided keywords
         if 'order' exists in kwargs, the value will be used as sort
+        if 'limit' exists in kwargs, at most that many results are returned
+        as a ResultPage, and 'cursor' can be used to get the following page
         '''
         _timer = datetime.now()
+        identity_map = IdentityMap.current()
+        query_key = IdentityMap.query_key(cls.kind, 'list', kwargs) if identity_map else None
+        limit = kwargs.pop('limit', None)
+        cursor = kwargs.pop('cursor', None)
+        if query_key:
+            cached = identity_map.get_query(query_key)
+            if cached is not None:
+                return cached
+        chunks = cls._split_in_filter(kwargs)
+        if len(chunks) != 1:
+            if limit and chunks:
+                raise ValueError(
+                    f'Paged queries take at most {IN_FILTER_LIMIT} values in an IN filter'
+                )
+            # values beyond the IN limit are queried separately and merged
+            results = [obj for chunk_kwargs in chunks for obj in cls.list(**chunk_kwargs)]
+            orders = kwargs.get('order') or []
+            for order in reversed([orders] if isinstance(orders, str) else orders):
+                results.sort(key=lambda obj: getattr(obj, order.lstrip('-')), reverse=order.startswith('-'))
+            if limit:
+                results = ResultPage(results)
+            if query_key:
+                identity_map.set_query(query_key, results)
+            return results
         query = datastore_client.query(kind=cls.kind)
         kwarg_objects = {key: value for (key, value) in kwargs.items() if isinstance(value, DatastoreBase)}
         if 'order' in kwargs:
             query.order = kwargs.pop('order')
-        for key, value in kwargs.items():
-            if isinstance(value, DatastoreBase) and hasattr(value, 'key'):
-                query.ancestor=getattr(value, 'key')
-            else:
-                query.add_filter(key, '=', value)
-        results = [cls._build_obj(i) for i in list(query.fetch())]
-        for key, value in kwarg_objects.items():
-            for result in results:
-                if hasattr(result, key):
-                    setattr(result, key, value)
+        cls._add_filters(query, kwargs)
+        if limit:
+            query_iter = query.fetch(limit=limit, start_cursor=cursor)
+            try:
+                entities = list(next(query_iter.pages))
+            except (binascii.Error, BadRequest) as e:
+                raise ValueError(f'Invalid cursor {cursor}') from e
+            next_cursor = None
+            # a short page means there's nothing left
+            if len(entities) == limit and query_iter.next_page_token:
+                next_cursor = query_iter.next_page_token.decode()
+            results = ResultPage(cls._build_objs(entities, kwarg_objects), next_cursor)
+        else:
+            results = cls._build_objs(list(query.fetch()), kwarg_objects)
+        _round_trip()
+        if query_key:
+            identity_map.set_query(query_key, results)
         print(f'[datastore] list({cls.kind}, {kwargs}): {(datetime.now() - _timer).total_seconds()}')
         return results
 
     @classmethod
     def count(cls, **kwargs):
         '''
-        executes a search using provided keywords
-        if 'order' exists in kwargs, the value will be used as sort
+        counts the results of a search using provided keywords
+        counting a counted kind by its parent alone reads the parent's
+        counter, initializing it on first use. Anything else is counted
+        with an aggregation query.
+        '''
+        parent = kwargs.get(cls.parent_attr) if cls.parent_attr else None
+        if (
+            cls.counted and len(kwargs) == 1 and
+            isinstance(parent, DatastoreBase) and hasattr(parent, 'key')
+        ):
+            count = counter.read(getattr(parent, 'key'), cls.kind)
+            if count is None:
+                _, count = counter.reset(getattr(parent, 'key'), cls.kind, cls._count_query(kwargs))
+            return count
+        return sum(
+            counter.aggregate_count(cls._count_query(chunk_kwargs))
+            for chunk_kwargs in cls._split_in_filter(kwargs)
+        )
+
+    @classmethod
+    def repair_count(cls, **kwargs):
         '''
+        recounts the entities under the parent passed in (as in
+        count(profile=profile)) and fixes the parent's counter if it has
+        drifted. Returns (counter value before, actual count) - the counter
+        value is None if it hadn't been initialized.
+        '''
+        parent = kwargs.get(cls.parent_attr) if cls.parent_attr else None
+        if not cls.counted or len(kwargs) != 1 or not hasattr(parent, 'key'):
+            raise ValueError(f'{cls.kind} is not counted by {", ".join(kwargs)}')
+        return counter.reset(getattr(parent, 'key'), cls.kind, cls._count_query(kwargs))
+
+    @classmethod
+    def _count_query(cls, kwargs):
         query = datastore_client.query(kind=cls.kind)
-        kwarg_objects = {key: value for (key, value) in kwargs.items() if isinstance(value, DatastoreBase)}
-        if 'order' in kwargs:
-            query.order = kwargs.pop('order')
+        cls._add_filters(query, {key: value for key, value in kwargs.items() if key != 'order'})
+        return query
+
+    @classmethod
+    def _add_filters(cls, query, kwargs):
+        '''
+        objects become the query's ancestor, anything else a filter - with
+        the operator from the keyword's suffix if it has one of
+        FILTER_OPERATORS
+        '''
         for key, value in kwargs.items():
             if isinstance(value, DatastoreBase) and hasattr(value, 'key'):
                 query.ancestor=getattr(value, 'key')
+                continue
+            name, _, operator = key.partition('__')
+            if operator in FILTER_OPERATORS:
+                query.add_filter(name, FILTER_OPERATORS[operator], list(value) if operator == 'in' else value)
             else:
                 query.add_filter(key, '=', value)
-        query.keys_only()
-        return len(list(query.fetch()))
+
+    @staticmethod
+    def _split_in_filter(kwargs):
+        '''
+        splits an IN filter with more than IN_FILTER_LIMIT values into one set
+        of keywords per IN_FILTER_LIMIT values. An empty IN filter can't match
+        anything, so there's nothing to query.
+        '''
+        in_keys = [key for key in kwargs if key.endswith('__in')]
+        if not in_keys:
+            return [kwargs]
+        values = list(kwargs[in_keys[0]])
+        return [
+            {**kwargs, in_keys[0]: values[start:start + IN_FILTER_LIMIT]}
+            for start in range(0, len(values), IN_FILTER_LIMIT)
+        ]
+
+    @classmethod
+    def _get_multi(cls, keys):
+        '''
+        fetches entities for all keys in a single round trip and
+        returns a dict of key -> object
+        objects already loaded during this request are not fetched again
+        '''
+        objs = {}
+        identity_map = IdentityMap.current()
+        if identity_map:
+            objs, keys = identity_map.get_entities(keys)
+        if keys:
+            entities = datastore_client.get_multi(list(keys))
+            _round_trip()
+            objs.update({obj.key: obj for obj in cls._build_objs(entities)})
+        return objs
+
+    @classmethod
+    def _build_objs(cls, datastore_objs, known_objects=None):
+        '''
+        builds objects from datastore entities
+        known_objects are objects the caller already has (such as the profile
+        passed in to list) and are set directly on every result. Any parent not
+        in known_objects is loaded once per distinct key for the whole batch.
+        Entities already built during this request are returned as-is.
+        '''
+        known_objects = known_objects or {}
+        identity_map = IdentityMap.current()
+        existing = {}
+        if identity_map:
+            for datastore_obj in datastore_objs:
+                obj = identity_map.get_entity(datastore_obj.key)
+                if obj is not None:
+                    existing[datastore_obj.key] = obj
+        load_parents = cls.parent_attr and cls.parent_attr not in known_objects
+        parents = {}
+        if load_parents:
+            parent_keys = {
+                datastore_obj.key.parent for datastore_obj in datastore_objs
+                if datastore_obj.key.parent is not None
+                and datastore_obj.key not in existing
+            }
+            if parent_keys:
+                parents = cls.parent_cls._get_multi(parent_keys)
+        objs = []
+        for datastore_obj in datastore_objs:
+            if datastore_obj.key in existing:
+                objs.append(existing[datastore_obj.key])
+                continue
+            obj = cls.__new__(cls)
+            obj.__init__(
+                **dict(datastore_obj.items())
+            )
+            setattr(obj, 'key', datastore_obj.key)
+            for key, value in known_objects.items():
+                if hasattr(obj, key):
+                    setattr(obj, key, value)
+            if load_parents:
+                setattr(obj, cls.parent_attr, parents.get(datastore_obj.key.parent))
+            if identity_map:
+                identity_map.add_entity(obj)
+            objs.append(obj)
+        return objs
 
     @classmethod
     def _build_obj(cls, datastore_obj):
-        obj = cls.__new__(cls)
-        obj.__init__(
-            **dict(datastore_obj.items())
-        )
-        setattr(obj, 'key', datastore_obj.key)
-        if hasattr(obj, 'from_datastore_obj'):
-            obj.from_datastore_obj(datastore_obj)
-        return obj
+        return cls._build_objs([datastore_obj])[0]
@@ -8,8 +8,11 @@ from .profile import Profile
 
 class Post(BasePost, DatastoreBase):
     kind = 'Post'
+    parent_attr = 'profile'
+    parent_cls = Profile
+    counted = True
 
-    def save(self):
+    def _entity(self):
         if not hasattr(self,'key'):
             key = datastore_client.key('Post', self.id,
                 parent=getattr(self.profile, 'key')
@@ -19,19 +22,16 @@ class Post(BasePost, DatastoreBase):
             setattr(self, 'key', key)
         else:
             key = getattr(self, 'key')
-        post_entity = datastore.Entity(key=key)
+        post_entity = datastore.Entity(key=key, exclude_from_indexes=('variants',))
         post_entity.update(self.as_dict())
-        datastore_client.put(post_entity)
+        return post_entity
 
     def as_dict(self):
         return {
             'id': self.id,
             'text': self.text,
             'files': self.files,
+            'variants': self.variants,
             'created': self.created,
+            'updated': self.updated,
         }
-
-    def from_datastore_obj(self, datastore_obj):
-        if not self.profile:
-            datastore_obj = datastore_client.get(self.key.parent)
-            self.profile = Profile._build_obj(datastore_obj) # pylint: disable=protected-access
@@ -9,17 +9,19 @@ class Profile(BaseProfile, DatastoreBase):
 
     kind = 'Profile'
 
-    def save(self):
+    def _entity(self):
         if not hasattr(self, 'key'):
             key = datastore_client.key('Profile', self.user_id)
             setattr(self, 'key', key)
         else:
             key = getattr(self, 'key')
         profile_entity = datastore.Entity(
-            key=key, exclude_from_indexes=('public_key', 'private_key')
+            key=key, exclude_from_indexes=(
+                'public_key', 'private_key', 'ec_public_key', 'ec_private_key',
+            )
         )
         profile_entity.update(self.as_dict())
-        datastore_client.put(profile_entity)
+        return profile_entity
 
     def as_dict(self):
         return {
@@ -28,5 +30,7 @@ class Profile(BaseProfile, DatastoreBase):
             'user_id': self.user_id,
             'public_key': self.public_key,
             'private_key': self.private_key,
+            'ec_public_key': self.ec_public_key,
+            'ec_private_key': self.ec_private_key,
             'created': self.created,
         }
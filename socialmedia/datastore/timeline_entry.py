@@ -0,0 +1,35 @@
+from google.cloud import datastore
+
+from socialmedia.models import TimelineEntry as BaseTimelineEntry
+from socialmedia.datastore.mixins import DatastoreBase
+
+from .dataclient import datastore_client
+from .profile import Profile
+
+class TimelineEntry(BaseTimelineEntry, DatastoreBase):
+    kind = 'TimelineEntry'
+    parent_attr = 'profile'
+    parent_cls = Profile
+
+    def _entity(self):
+        if not hasattr(self,'key'):
+            # keyed on the connection and post so a repeated notification
+            # overwrites the entry instead of adding another one
+            key = datastore_client.key('TimelineEntry', f'{self.connection_id}:{self.post_id}',
+                parent=getattr(self.profile, 'key')
+                if self.profile and hasattr(self.profile, 'key')
+                else None
+            )
+            setattr(self, 'key', key)
+        else:
+            key = getattr(self, 'key')
+        timeline_entry_entity = datastore.Entity(key=key)
+        timeline_entry_entity.update(self.as_dict())
+        return timeline_entry_entity
+
+    def as_dict(self):
+        return {
+            'connection_id': self.connection_id,
+            'post_id': self.post_id,
+            'created': self.created,
+        }
@@ -9,7 +9,7 @@ class User(BaseUser, DatastoreBase):
 
     kind = 'User'
 
-    def save(self):
+    def _entity(self):
         if not hasattr(self,'key'):
             key = datastore_client.key('User', self.id)
             setattr(self, 'key', key)
@@ -17,7 +17,7 @@ class User(BaseUser, DatastoreBase):
             key = getattr(self, 'key')
         user_entity = datastore.Entity(key=key)
         user_entity.update(self.as_dict())
-        datastore_client.put(user_entity)
+        return user_entity
 
     def as_dict(self):
         return {
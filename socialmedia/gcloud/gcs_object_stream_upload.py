@@ -1,15 +1,34 @@
 ## flat-out stolen from https://dev.to/sethmichaellarson/python-data-streaming-to-google-cloud-storage-with-resumable-uploads-458h
+import os
+
 from google.auth.transport.requests import AuthorizedSession
 from google.resumable_media import requests, common
 from google.cloud import storage
 
 from werkzeug.utils import secure_filename
 
+from socialmedia.composite_upload import ParallelCompositeUpload
+
+# requests at least this big upload their files as parallel composite uploads
+# (0 turns them off). The request size is used since the file's own size
+# isn't known until it's been read
+COMPOSITE_UPLOAD_THRESHOLD = int(os.environ.get('COMPOSITE_UPLOAD_THRESHOLD', '0'))
+COMPOSITE_UPLOAD_PART_SIZE = int(os.environ.get('COMPOSITE_UPLOAD_PART_SIZE', str(8 * 1024 * 1024)))
+COMPOSITE_UPLOAD_PARALLELISM = int(os.environ.get('COMPOSITE_UPLOAD_PARALLELISM', '4'))
+
 def gcs_stream_factory(
     total_content_length, filename, content_type, content_length=None
 ):
     storage_client = storage.Client()
     filename = secure_filename(filename)
+    if COMPOSITE_UPLOAD_THRESHOLD and (total_content_length or 0) >= COMPOSITE_UPLOAD_THRESHOLD:
+        return ParallelCompositeUpload(
+            GCSObjectStore(storage_client.bucket(f'{storage_client.project}.appspot.com')),
+            filename,
+            content_type,
+            part_size=COMPOSITE_UPLOAD_PART_SIZE,
+            parallelism=COMPOSITE_UPLOAD_PARALLELISM,
+        )
     upload_stream = GCSObjectStreamUpload(
         client=storage_client,
         bucket_name='{}.appspot.com'.format(storage_client.project),
@@ -20,6 +39,28 @@ def gcs_stream_factory(
     upload_stream.start()
     return upload_stream
 
+class GCSObjectStore():
+    ''' object store (see socialmedia.composite_upload) backed by a GCS bucket '''
+
+    def __init__(self, bucket):
+        self._bucket = bucket
+
+    def upload(self, name, data, content_type=None):
+        self._bucket.blob(name).upload_from_string(data, content_type=content_type)
+
+    def read(self, name):
+        return self._bucket.blob(name).download_as_bytes()
+
+    def compose(self, name, part_names, content_type=None):
+        blob = self._bucket.blob(name)
+        blob.content_type = content_type
+        blob.compose([self._bucket.blob(part_name) for part_name in part_names])
+
+    def delete(self, names):
+        self._bucket.delete_blobs(
+            [self._bucket.blob(name) for name in names], on_error=lambda blob: None
+        )
+
 class GCSObjectStreamUpload():
     def __init__(
             self,
@@ -34,7 +75,9 @@ class GCSObjectStreamUpload():
         self._blob = self._bucket.blob(blob_name)
         self._content_type = content_type
 
-        self._buffer = b''
+        # unread data is _buffer[_buffer_offset:]
+        self._buffer = bytearray()
+        self._buffer_offset = 0
         self._buffer_size = 0
         self._chunk_size = chunk_size
         self._read = 0
@@ -72,6 +115,7 @@ class GCSObjectStreamUpload():
     def write(self, data: bytes) -> int:
         data_len = len(data)
         self._buffer_size += data_len
+        # extends the bytearray in place rather than copying the buffer
         self._buffer += data
         del data
         while self._buffer_size >= self._chunk_size:
@@ -82,14 +126,21 @@ class GCSObjectStreamUpload():
         return data_len
 
     def read(self, chunk_size: int) -> bytes:
-        # I'm not good with efficient no-copy buffering so if this is
-        # wrong or there's a better way to do this let me know! :-)
+        # chunks have to be bytes - requests treats any other body (memoryviews
+        # included) as an iterable stream. That's one copy per chunk, while the
+        # rest of the buffer stays put until the data read from the front of it
+        # is at least half the buffer, which keeps compacting it linear
         to_read = min(chunk_size, self._buffer_size)
-        memview = memoryview(self._buffer)
-        self._buffer = memview[to_read:].tobytes()
+        start = self._buffer_offset
+        with memoryview(self._buffer) as view:
+            chunk = view[start:start + to_read].tobytes()
+        self._buffer_offset += to_read
         self._read += to_read
         self._buffer_size -= to_read
-        return memview[:to_read].tobytes()
+        if self._buffer_offset * 2 >= len(self._buffer):
+            del self._buffer[:self._buffer_offset]
+            self._buffer_offset = 0
+        return chunk
 
     def tell(self) -> int:
         return self._read
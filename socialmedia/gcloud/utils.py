@@ -1,6 +1,9 @@
 import datetime
 import json
 import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 # pip install requests
 import requests
@@ -11,36 +14,79 @@ from google.auth.transport.requests import Request
 from google.oauth2 import service_account
 from google.cloud import secretmanager, storage, tasks_v2
 
+from socialmedia import metrics
+from socialmedia.cache import LRUCache
+
+# signed urls are handed out again until SIGNED_URL_MARGIN seconds before
+# they expire (or halfway through their life for short lived urls)
+signed_url_cache = LRUCache(maxsize=int(os.environ.get('SIGNED_URL_CACHE_SIZE', '10000')))
+metrics.register('signed_url_cache', signed_url_cache.stats)
+SIGNED_URL_MARGIN = int(os.environ.get('SIGNED_URL_MARGIN', '300'))
+# most urls signed at once
+SIGNING_CONCURRENCY = int(os.environ.get('SIGNING_CONCURRENCY', '8'))
+
+# credentials and bucket are set up once per process
+_signing = {}
+_signing_lock = threading.Lock()
+
+def _signing_context():
+    with _signing_lock:
+        if not _signing:
+            credentials, _ = auth_default()
+            storage_client = storage.Client()
+            _signing['credentials'] = credentials
+            _signing['bucket'] = storage_client.bucket(f'{storage_client.project}.appspot.com')
+        credentials = _signing['credentials']
+        # access tokens only last an hour
+        if not credentials.valid:
+            credentials.refresh(Request())
+        return credentials, _signing['bucket']
+
 def generate_signed_urls(files, expiration=3000):
     if expiration > 604800:
         raise Exception('Expiration Time can\'t be longer than 604800 seconds (7 days).')
-    credentials, project_id = auth_default()
-    if credentials.token is None:
-        credentials.refresh(Request())
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(f'{storage_client.project}.appspot.com')
-
-    signed_urls = []
-    for file in files:
-        blob = bucket.blob(file)
-        signed_url = blob.generate_signed_url(
-            version='v4',
-            expiration=datetime.timedelta(seconds=expiration),
-            service_account_email=credentials.service_account_email,
-            access_token=credentials.token,
-            method="GET"
-        )
-        signed_urls.append(signed_url)
-
-    return signed_urls
+    cache_ttl = expiration - min(SIGNED_URL_MARGIN, expiration // 2)
+    signed_urls = {}
+    unsigned = []
+    for file in dict.fromkeys(files):
+        signed_url = signed_url_cache.get((file, expiration))
+        if signed_url is None:
+            unsigned.append(file)
+        else:
+            signed_urls[file] = signed_url
+    if unsigned:
+        credentials, bucket = _signing_context()
+        def sign(file):
+            return bucket.blob(file).generate_signed_url(
+                version='v4',
+                expiration=datetime.timedelta(seconds=expiration),
+                service_account_email=credentials.service_account_email,
+                access_token=credentials.token,
+                method="GET"
+            )
+        # signing with an access token is a request to the IAM API per url,
+        # so a batch of them is signed concurrently
+        if len(unsigned) > 1:
+            with ThreadPoolExecutor(max_workers=min(SIGNING_CONCURRENCY, len(unsigned))) as executor:
+                new_urls = list(executor.map(sign, unsigned))
+        else:
+            new_urls = [sign(unsigned[0])]
+        for file, signed_url in zip(unsigned, new_urls):
+            signed_url_cache.set((file, expiration), signed_url, ttl=cache_ttl)
+            signed_urls[file] = signed_url
+
+    return [signed_urls[file] for file in files]
 
 class TaskManager():
 
-    def __init__(self, project, queue_location, use_async=True):
+    def __init__(self, project, queue_location, use_async=True, http_client=None):
         self.task_client = tasks_v2.CloudTasksClient()
         self.project = project
         self.queue_location = queue_location
         self.use_async = use_async
+        # used to call the workers directly when not async (create_app
+        # shares the app's client if this isn't set)
+        self.http_client = http_client
         print(f'TaskManager use_async={self.use_async}')
 
     def queue_task(self, payload, queue_name, relative_uri):
@@ -58,7 +104,7 @@ class TaskManager():
             }
             self.task_client.create_task(parent=parent, task=task)
         else:
-            requests.post(
+            (self.http_client or requests).post(
                 'http://localhost:8080{}'.format(relative_uri),
                 json=payload
             )
@@ -0,0 +1,81 @@
+import threading
+import time
+
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+class HttpClient():
+    '''
+    Shared HTTP client for requests to other hosts. Wraps a requests.Session
+    so connections to each host are pooled and kept alive between requests,
+    applies a default timeout, and retries failed connections with backoff.
+    Only connection failures are retried for POSTs, since a POST that reached
+    the other host may already have taken effect.
+    Keeps per-host request counts and timings for reporting.
+    '''
+
+    def __init__(
+        self, timeout=10, retries=3, backoff_factor=0.5,
+        pool_connections=20, pool_maxsize=20,
+    ):
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=(502, 503, 504),
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self._host_stats = defaultdict(lambda: {'requests': 0, 'errors': 0, 'seconds': 0.0})
+        self._lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlsplit(url).netloc
+        _timer = time.monotonic()
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self._host_stats[host]['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                self._host_stats[host]['requests'] += 1
+                self._host_stats[host]['seconds'] += time.monotonic() - _timer
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        '''
+        per host request counts and timings, plus how many connections each
+        host's pool has had to open (fewer connections than requests means
+        keep-alive is doing its job)
+        '''
+        with self._lock:
+            stats = {host: dict(host_stats) for host, host_stats in self._host_stats.items()}
+        pools = self.adapter.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            host = pool.host if pool.port in (None, 80, 443) else f'{pool.host}:{pool.port}'
+            host_stats = stats.setdefault(host, {'requests': 0, 'errors': 0, 'seconds': 0.0})
+            host_stats['connections_opened'] = host_stats.get('connections_opened', 0) \
+                + pool.num_connections
+        return stats
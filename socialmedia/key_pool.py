@@ -0,0 +1,128 @@
+'''
+Pre-generated RSA key pairs for new profiles. Generating a 2048-bit key takes
+hundreds of milliseconds, so worker processes keep a small stock of key pairs
+ready and signup takes one of those. Keys are only generated on the request
+thread when the stock has run out.
+'''
+import multiprocessing
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from functools import partial
+
+from socialmedia.models import Profile
+
+class KeyPool():
+    '''
+    Keeps up to size (public key, private key) pairs made by generate, which
+    runs in worker processes. Processes aren't started until start() or the
+    first take(), so they're created after the web server has forked.
+    executor replaces the process pool (tests use a thread pool).
+    '''
+
+    def __init__(self, size=4, workers=1, generate=Profile.generate_keys, executor=None):
+        self.size = size
+        self.workers = workers
+        self._generate = generate
+        self._executor = executor
+        self._keys = deque()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.taken = 0
+        self.generated_sync = 0
+        self.refills = 0
+        self.refill_errors = 0
+        self._refill_seconds = 0.0
+        self.last_refill_seconds = None
+
+    def start(self):
+        # spawned worker processes import the app's module again - they don't
+        # need pools of their own
+        if multiprocessing.parent_process() is not None:
+            return
+        self._refill()
+
+    def take(self):
+        '''
+        returns a (public key, private key) pair from the pool, or a newly
+        generated one if the pool is empty
+        '''
+        with self._lock:
+            self.taken += 1
+            keys = self._keys.popleft() if self._keys else None
+            if keys is None:
+                self.generated_sync += 1
+        self._refill()
+        if keys is None:
+            keys = self._generate()
+        return keys
+
+    def _refill(self):
+        if self.size <= 0:
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+            executor = self._executor
+            needed = self.size - len(self._keys) - self._pending
+            self._pending += max(needed, 0)
+        for submitted in range(max(needed, 0)):
+            try:
+                future = executor.submit(self._generate)
+            except BrokenExecutor as e:
+                # a pool whose process died won't run anything else - the
+                # next refill starts a new one
+                print(f'[key_pool] worker pool broken: {e}')
+                with self._lock:
+                    self._pending -= needed - submitted
+                    if self._executor is executor:
+                        self._executor = None
+                return
+            future.add_done_callback(partial(self._refilled, executor, time.perf_counter()))
+
+    def _refilled(self, executor, submitted, future):
+        elapsed = time.perf_counter() - submitted
+        if future.cancelled():
+            with self._lock:
+                self._pending -= 1
+            return
+        try:
+            keys = future.result()
+        except Exception as e:
+            print(f'[key_pool] key generation failed: {e}')
+            with self._lock:
+                self._pending -= 1
+                self.refill_errors += 1
+                if isinstance(e, BrokenExecutor) and self._executor is executor:
+                    self._executor = None
+            return
+        with self._lock:
+            self._pending -= 1
+            self._keys.append(keys)
+            self.refills += 1
+            self._refill_seconds += elapsed
+            self.last_refill_seconds = elapsed
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            'depth': len(self._keys),
+            'size': self.size,
+            'pending': self._pending,
+            'taken': self.taken,
+            'generated_sync': self.generated_sync,
+            'refills': self.refills,
+            'refill_errors': self.refill_errors,
+            'last_refill_seconds': self.last_refill_seconds,
+            'avg_refill_seconds': self._refill_seconds / self.refills if self.refills else None,
+        }
@@ -0,0 +1,86 @@
+'''
+Image post-processing - uploaded images are rewritten without their metadata
+(EXIF, XMP, comments) and resized copies are made for narrower screens.
+Needs Pillow - without it images are left as they were uploaded.
+'''
+import io
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError: # pragma: no cover
+    Image = None
+
+# formats images are processed in (Pillow format names) - anything else,
+# including animations, is left alone
+SUPPORTED_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+def available():
+    return Image is not None
+
+def variant_name(filename, width):
+    stem, ext = os.path.splitext(filename)
+    return f'{stem}_{width}w{ext}'
+
+def process_image(store, filename, widths):
+    '''
+    Rewrites filename in store without metadata and stores a copy at each of
+    widths that's narrower than the original. Returns a dict of width (as a
+    string, since it ends up as a datastore property name) to variant name,
+    or None if filename isn't an image that can be processed.
+    '''
+    try:
+        image = Image.open(io.BytesIO(store.read(filename)))
+        image_format = image.format
+        if image_format not in SUPPORTED_FORMATS or getattr(image, 'is_animated', False):
+            return None
+        image.load()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # not an image, a broken one or one too big to decode safely - none
+        # of which retrying would fix
+        return None
+    icc_profile = image.info.get('icc_profile')
+    # apply the orientation before the EXIF data holding it is dropped
+    image = ImageOps.exif_transpose(image)
+    content_type = Image.MIME[image_format]
+    store.upload(filename, _encode(image, image_format, icc_profile), content_type)
+    variants = {}
+    for width in sorted(widths):
+        if width >= image.width:
+            break
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), Image.LANCZOS)
+        name = variant_name(filename, width)
+        store.upload(name, _encode(resized, image_format, icc_profile), content_type)
+        variants[str(width)] = name
+    return variants
+
+def _encode(image, image_format, icc_profile):
+    # only the pixels and the colour profile are written
+    image.info = {}
+    options = {}
+    if icc_profile:
+        options['icc_profile'] = icc_profile
+    if image_format == 'JPEG':
+        options['quality'] = 85
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+    out = io.BytesIO()
+    image.save(out, format=image_format, **options)
+    return out.getvalue()
+
+def select_file(filename, variants, width):
+    '''
+    returns the narrowest variant of filename that's at least width wide, or
+    filename itself if there isn't one (or no width was given)
+    '''
+    file_variants = (variants or {}).get(filename)
+    if not width or not file_variants:
+        return filename
+    wide_enough = sorted(int(w) for w in file_variants if int(w) >= width)
+    if not wide_enough:
+        return filename
+    return file_variants[str(wide_enough[0])]
+
+def select_files(filenames, variants, width):
+    return [select_file(filename, variants, width) for filename in filenames]
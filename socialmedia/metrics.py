@@ -0,0 +1,15 @@
+'''
+Registry of process-wide metrics. Components register a function returning
+their current numbers (cache hit rates, pool sizes, ...) and the admin-only
+/metrics/ endpoint reports all of them.
+'''
+_providers = {}
+
+def register(name, provider):
+    _providers[name] = provider
+
+def unregister(name):
+    _providers.pop(name, None)
+
+def collect():
+    return {name: provider() for name, provider in sorted(_providers.items())}
@@ -14,6 +14,8 @@ class Comment(UuidMixin):
         self.created = kwargs.get('created', now)
         self.text = kwargs.get('text', '')
         self.files = kwargs.get('files', [])
+        # resized copies of image files - { filename: { width: variant filename } }
+        self.variants = kwargs.get('variants') or {}
 
     def __str__(self):
         return f'id: {self.id}, post_id: {self.post_id}, profile: {{ {str(self.profile)} }}, ' \
@@ -15,10 +15,22 @@ class Connection(UuidMixin):
         self.handle = kwargs.get('handle')
         self.display_name = kwargs.get('display_name')
         self.public_key = kwargs.get('public_key')
+        # the connection's EC public key, if it advertised one when connecting
+        self.ec_public_key = kwargs.get('ec_public_key')
         self.status = kwargs.get('status')
         self.created = kwargs.get('created', now)
         self.updated = kwargs.get('updated', now)
         self.read = kwargs.get('read')
+        # optional symmetric session shared with the connection's host, used
+        # in place of RSA until session_expires
+        self.session_id = kwargs.get('session_id')
+        self.session_key = kwargs.get('session_key')
+        self.session_expires = kwargs.get('session_expires')
+        # the session the current one replaced - still accepted until
+        # prev_session_expires so messages already sent under it get through
+        self.prev_session_id = kwargs.get('prev_session_id')
+        self.prev_session_key = kwargs.get('prev_session_key')
+        self.prev_session_expires = kwargs.get('prev_session_expires')
         if self.status not in connection_status.ALL:
             raise Exception(f'Connection status must be one of [{", ".join(connection_status.ALL)}]')
 
@@ -40,6 +52,7 @@ class Connection(UuidMixin):
             hasattr(other, 'handle') and self.handle == other.handle,
             hasattr(other, 'display_name') and self.display_name == other.display_name,
             hasattr(other, 'public_key') and self.public_key == other.public_key,
+            hasattr(other, 'ec_public_key') and self.ec_public_key == other.ec_public_key,
             hasattr(other, 'status') and self.status == other.status,
             hasattr(other, 'created') and self.created == other.created,
             hasattr(other, 'updated') and self.updated == other.updated,
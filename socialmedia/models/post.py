@@ -12,8 +12,14 @@ class Post(UuidMixin):
         self.profile = kwargs.get('profile')
         self.id = kwargs.get('id', self.__class__.generate_uuid())
         self.created = kwargs.get('created', now)
+        # when anything a connection sees of the post last changed (a comment
+        # was added, its images were processed...) - posts from before this
+        # was tracked count as unchanged since they were created
+        self.updated = kwargs.get('updated') or self.created
         self.text = kwargs.get('text', '')
         self.files = kwargs.get('files', [])
+        # resized copies of image files - { filename: { width: variant filename } }
+        self.variants = kwargs.get('variants') or {}
         # allows for a list of comments sorted by created date descending
         # might want to move this out into a mixin for posts instead of having
         # it directly in the base class
@@ -47,6 +53,7 @@ class Post(UuidMixin):
             'id': self.id,
             'text': self.text,
             'created': str(self.created),
+            'updated': str(self.updated),
             'files': self.files,
             'comments': [comment.as_json() for comment in self.comments]
         }
@@ -2,6 +2,9 @@ from datetime import datetime
 
 from Crypto import Random
 from Crypto.PublicKey import RSA
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 from dateutil import tz
 
 class Profile():
@@ -12,6 +15,10 @@ class Profile():
         self.user_id = kwargs.get('user_id')
         self.public_key = kwargs.get('public_key')
         self.private_key = kwargs.get('private_key')
+        # optional Ed25519 (signatures) and X25519 (key wrapping) keys, used in
+        # place of RSA with connections that have them too
+        self.ec_public_key = kwargs.get('ec_public_key')
+        self.ec_private_key = kwargs.get('ec_private_key')
         self.created = kwargs.get('created', now)
         if not any((self.public_key, self.private_key)):
             self.public_key, self.private_key = self.generate_keys()
@@ -22,6 +29,22 @@ class Profile():
         crypto_key = RSA.generate(2048, random_generator)
         return crypto_key.publickey().exportKey(), crypto_key.exportKey()
 
+    @classmethod
+    def generate_ec_keys(cls):
+        '''
+        returns (public key, private key) as hex - each is the Ed25519 key
+        followed by the X25519 key, 32 bytes apiece
+        '''
+        keys = (Ed25519PrivateKey.generate(), X25519PrivateKey.generate())
+        public_key = b''.join(key.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw
+        ) for key in keys)
+        private_key = b''.join(key.private_bytes(
+            serialization.Encoding.Raw, serialization.PrivateFormat.Raw,
+            serialization.NoEncryption(),
+        ) for key in keys)
+        return public_key.hex(), private_key.hex()
+
     def __str__(self):
         return f'display_name: {self.display_name}, handle: {self.handle}, user_id: {self.user_id}, ' \
             f'created: {self.created}'
@@ -38,6 +61,8 @@ class Profile():
             hasattr(other, 'user_id') and self.user_id == other.user_id,
             hasattr(other, 'public_key') and self.public_key == other.public_key,
             hasattr(other, 'private_key') and self.private_key == other.private_key,
+            hasattr(other, 'ec_public_key') and self.ec_public_key == other.ec_public_key,
+            hasattr(other, 'ec_private_key') and self.ec_private_key == other.ec_private_key,
             hasattr(other, 'created') and self.created == other.created,
         ])
 
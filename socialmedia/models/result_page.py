@@ -0,0 +1,10 @@
+class ResultPage(list):
+    '''
+    A page of query results. next_cursor is an opaque string that can be
+    passed back to list() to get the following page, or None if this is
+    the last page.
+    '''
+
+    def __init__(self, results=(), next_cursor=None):
+        super().__init__(results)
+        self.next_cursor = next_cursor
@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from dateutil import tz
+
+class TimelineEntry():
+    '''
+    A post a connection has notified a profile of, kept under the profile so
+    its home timeline can be read newest first in a single query.
+    '''
+
+    def __init__(self, **kwargs):
+        self.profile = kwargs.get('profile')
+        self.connection_id = kwargs.get('connection_id')
+        self.post_id = kwargs.get('post_id')
+        self.created = kwargs.get('created', datetime.now().astimezone(tz.UTC))
+
+    def __str__(self):
+        return f'profile: {{ {self.profile} }}, connection_id: {self.connection_id}, ' \
+            f'post_id: {self.post_id}, created: {self.created}'
+
+    def __repr__(self):
+        return f'TimelineEntry(profile: {{ {repr(self.profile)} }}, ' \
+            f'connection_id: {self.connection_id}, post_id: {self.post_id}, ' \
+            f'created: {self.created})'
+
+    def __eq__(self, other):
+        return all([
+            isinstance(other, self.__class__),
+            hasattr(other, 'profile') and self.profile == other.profile,
+            hasattr(other, 'connection_id') and self.connection_id == other.connection_id,
+            hasattr(other, 'post_id') and self.post_id == other.post_id,
+        ])
+
+    def as_json(self):
+        return {
+            'connection_id': self.connection_id,
+            'post_id': self.post_id,
+            'created': str(self.created),
+        }
@@ -0,0 +1,22 @@
+'''
+Counters scoped to the current request. They live on flask.g, so each
+request (and each queue worker call) starts from zero. Outside of an app
+context (scripts, background threads) increments are dropped.
+'''
+from flask import g, has_app_context
+
+def increment(name, amount=1):
+    if not has_app_context():
+        return
+    stats = g.setdefault('request_stats', {})
+    stats[name] = stats.get(name, 0) + amount
+
+def get(name):
+    if not has_app_context():
+        return 0
+    return g.get('request_stats', {}).get(name, 0)
+
+def get_all():
+    if not has_app_context():
+        return {}
+    return dict(g.get('request_stats', {}))
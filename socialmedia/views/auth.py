@@ -1,3 +1,4 @@
+import copy
 import os
 import traceback
 
@@ -148,7 +149,11 @@ def _get_profile(user_id):
     )
     if not user_profile:
         raise Exception('User without profile found')
+    # copy so the private keys are only cleared on this copy and not on the
+    # profile shared with the rest of the request
+    user_profile = copy.copy(user_profile)
     user_profile.private_key = None
+    user_profile.ec_private_key = None
     return user_profile
 
 def load_user(user_id):
@@ -3,12 +3,12 @@ import dateparser
 import json
 import requests
 
-from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil import tz
 from flask import Blueprint, current_app, jsonify, request, url_for
 
 from socialmedia import connection_status, models
+from socialmedia.media import select_files
 from socialmedia.views.validation_decorators import (
     json_request,
     validate_request,
@@ -17,9 +17,13 @@ from socialmedia.views.validation_decorators import (
     validate_connection,
 )
 from socialmedia.views.utils import (
-    decrypt_payload,
-    enc_and_sign_payload,
+    get_comment_references,
+    get_display_width,
+    get_page_size,
     get_post_comments,
+    rotate_session,
+    secure_envelope,
+    sign_files,
 )
 
 
@@ -39,6 +43,7 @@ def request_connection(request_data, connectee):
           'requestor_handle': 'requestor handle',
           'requestor_display_name': 'display name',
           'requestor_public_key': 'valid public key',
+          'requestor_ec_public_key': 'optional EC public key',
         }
     '''
     # because this is the first time we've talked with this user, they are unable
@@ -65,6 +70,7 @@ def request_connection(request_data, connectee):
         handle=request_payload['requestor_handle'],
         display_name=request_payload['requestor_display_name'],
         public_key=request_payload['requestor_public_key'],
+        ec_public_key=request_payload.get('requestor_ec_public_key'),
         status=connection_status.PENDING,
         read=False,
     )
@@ -88,6 +94,7 @@ def ack_connection(request_data, connectee, request_payload):
           'ack_handle': 'acknowledger handle',
           'ack_display_name': 'acknowledger name',
           'ack_public_key': 'acknowledger public key',
+          'ack_ec_public_key': 'optional acknowledger EC public key',
         }
     '''
     connection = current_app.datamodels.Connection.get(
@@ -102,11 +109,62 @@ def ack_connection(request_data, connectee, request_payload):
     now = datetime.now().astimezone(tz.UTC)
     connection.display_name = request_payload['ack_display_name']
     connection.public_key = request_payload['ack_public_key']
+    connection.ec_public_key = request_payload.get('ack_ec_public_key')
     connection.status =connection_status.CONNECTED
     connection.updated = now
     connection.save()
     return 'Request completed', 200
 
+@blueprint.route('/establish-session', methods=['POST'])
+@json_request
+@validate_request
+@validate_handle
+@validate_payload(
+    fields=(
+        'host', 'handle', 'session_id', 'session_key', 'session_expires',
+    )
+)
+@validate_connection
+def establish_session(request_data, connectee, request_payload, requestor):
+    ''' Sets up a session key to use in place of RSA for this connection
+        request should be JSON:
+        {
+          'host': 'requestor hostname',
+          'handle': 'requestor handle',
+          'session_id': 'id for the session',
+          'session_key': 'hex encoded 256 bit key',
+          'session_expires': 'ISO 8601 expiration time',
+        }
+        session_expires is held to at most SESSION_KEY_TTL seconds from now.
+        The session this one replaces is still accepted until it expires.
+    '''
+    try:
+        session_key = bytes.fromhex(request_payload['session_key'])
+    except ValueError:
+        return 'Invalid session key', 400
+    if len(session_key) != 32:
+        return 'Invalid session key', 400
+    session_expires = dateparser.parse(
+        request_payload['session_expires'], settings={'TIMEZONE': 'UTC'}
+    )
+    if not session_expires:
+        return 'Invalid session expiration', 400
+    if not session_expires.tzinfo:
+        session_expires = session_expires.replace(tzinfo=tz.UTC)
+    now = datetime.now().astimezone(tz.UTC)
+    if session_expires <= now:
+        return 'Invalid session expiration', 400
+    session_expires = min(
+        session_expires,
+        now + timedelta(seconds=current_app.config.get('SESSION_KEY_TTL', 86400)),
+    )
+    rotate_session(
+        requestor, request_payload['session_id'], request_payload['session_key'],
+        session_expires,
+    )
+    requestor.save()
+    return 'Session established', 200
+
 @blueprint.route('/get-profile-info', methods=['POST'])
 @json_request
 @validate_request
@@ -124,16 +182,7 @@ def get_profile_info(request_data, connectee, request_payload, requestor):
     '''
     post_count = current_app.datamodels.Post.count(profile=connectee)
 
-    enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
-        connectee, requestor, { 'post_count': post_count }
-    )
-    return jsonify(
-        enc_payload=enc_payload,
-        enc_key=enc_key,
-        signature=signature,
-        nonce=nonce,
-        tag=tag
-    ), 200
+    return jsonify(secure_envelope(connectee, requestor, { 'post_count': post_count })), 200
 
 @blueprint.route('/retrieve-posts', methods=['POST'])
 @json_request
@@ -147,34 +196,119 @@ def retrieve_posts(request_data, connectee, request_payload, requestor):
         {
           'host': 'requestor hostname',
           'handle': 'requestor handle',
+          'limit': 'optional page size',
+          'cursor': 'optional cursor from a previous response',
+          'width': 'optional width images will be shown at',
+          'version': 'optional version from a previous response',
         }
-        returns posts
+        If limit or cursor was sent, returns one page of posts as
+        { 'posts': [posts], 'next_cursor': 'cursor for next page or null',
+          'version': 'version of the posts' }
+        (version is null for pages past the first unless a version was sent)
+        otherwise it is the list of all posts (for hosts that don't page)
+        If the version sent is still current the response is
+        { 'not_modified': true, 'version': 'version' }
+        and if posts have only changed since (no new posts) it is
+        { 'delta': true, 'posts': [changed posts], 'version': 'version' }
+        Requests can also send 'accept_compression' (a list of algorithms)
+        next to the envelope to have the response compressed.
     '''
-    posts = current_app.datamodels.Post.list(profile=connectee, order=['-created'])
-    # probably could be pretty significantly optimized in some way
+    paged = 'limit' in request_payload or 'cursor' in request_payload
+    # replies are compressed if the requestor said how it accepts them
+    accept_compression = request_data.get('accept_compression')
+    try:
+        page_size = get_page_size(request_payload.get('limit'))
+        width = get_display_width(request_payload.get('width'))
+    except ValueError as e:
+        return f'Invalid paging parameters: {e}', 400
+    since = request_payload.get('version') if paged else None
+    # later pages only need the version if they're checking it
+    version = None
+    if paged and (since is not None or not request_payload.get('cursor')):
+        version = _posts_version(connectee)
+    if since is not None and since == version:
+        return jsonify(secure_envelope(connectee, requestor, {
+            'not_modified': True,
+            'version': version,
+        }, accept_compression=accept_compression)), 200
+    if since:
+        changed = _posts_changed_since(connectee, since, page_size)
+        if changed is not None:
+            return jsonify(secure_envelope(connectee, requestor, {
+                'delta': True,
+                'posts': _posts_json(changed, width),
+                'version': version,
+            }, accept_compression=accept_compression)), 200
+    if not paged:
+        # hosts that don't page have no way to ask for anything past the first page
+        posts = current_app.datamodels.Post.list(profile=connectee, order=['-created'])
+    else:
+        try:
+            posts = current_app.datamodels.Post.list(
+                profile=connectee,
+                order=['-created'],
+                limit=page_size,
+                cursor=request_payload.get('cursor'),
+            )
+        except ValueError as e:
+            return f'Invalid paging parameters: {e}', 400
 
-    comment_references = defaultdict(list)
-    for post in posts:
-        for comment_reference in current_app.datamodels.CommentReference.list(
-            post_id=post.id
-        ):
-            comment_references[post.id].append(comment_reference)
-        if post.files:
-            post.files = current_app.url_signer(post.files)
+    response_payload = _posts_json(posts, width)
+    if paged:
+        response_payload = {
+            'posts': response_payload,
+            'next_cursor': posts.next_cursor,
+            'version': version,
+        }
+    return jsonify(secure_envelope(
+        connectee, requestor, response_payload, accept_compression=accept_compression,
+    )), 200
 
-    get_post_comments(posts, comment_references, request.host)
+def _posts_version(profile):
+    ''' the version of profile's posts - when any of them last changed '''
+    latest = current_app.datamodels.Post.list(
+        profile=profile,
+        order=['-updated'],
+        limit=1,
+    )
+    return latest[0].updated.isoformat() if latest else ''
 
-    enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
-        connectee, requestor, [m.as_json() for m in posts]
+def _posts_changed_since(profile, since, limit):
+    '''
+    returns profile's posts updated after version since, or None if a full
+    page has to be sent instead - the version isn't valid, there are new
+    posts (which would change what's on each page) or too many changes
+    Posts saved before updated was stored aren't indexed on it, but every
+    change to a post saves updated, so only unchanged posts are missed.
+    Deleting a post doesn't change the version - anything that removes
+    Post entities has to update another post, or connections keep showing
+    the deleted one until they fetch a full page.
+    '''
+    try:
+        since = datetime.fromisoformat(since)
+    except (TypeError, ValueError):
+        return None
+    if not since.tzinfo:
+        # versions are always sent with a timezone, so this isn't one of ours
+        return None
+    # one past the limit is enough to tell there are too many changes
+    changed = current_app.datamodels.Post.list(
+        profile=profile, updated__gt=since, limit=limit + 1,
     )
-    return jsonify(
-        enc_payload=enc_payload,
-        enc_key=enc_key,
-        signature=signature,
-        nonce=nonce,
-        tag=tag
-    ), 200
+    if len(changed) > limit or any(post.created > since for post in changed):
+        return None
+    return changed
+
+def _posts_json(posts, width):
+    ''' posts as JSON, with their comments and signed URLs for their files '''
+    comment_references = get_comment_references(posts)
+    for post in posts:
+        post.files = select_files(post.files, post.variants, width)
+    sign_files(posts)
 
+    get_post_comments(posts, comment_references, request.host)
+
+    return [m.as_json() for m in posts]
 
 @blueprint.route('/post-notify', methods=['POST'])
 @json_request
@@ -202,8 +336,86 @@ def post_notify(request_data, connectee, request_payload, requestor):
         read=False
     )
     post_reference.save()
+    _add_timeline_entries(connectee, requestor, [request_payload['post_id']])
+    return '', 200
+
+def _add_timeline_entries(profile, connection, post_ids):
+    '''
+    adds profile's timeline entries for connection's posts - posts already
+    on the timeline keep their entry, so a repeated notification doesn't move
+    them back to the top
+    '''
+    existing = {
+        entry.post_id for entry in current_app.datamodels.TimelineEntry.list(
+            profile=profile, connection_id=connection.id, post_id__in=post_ids,
+        )
+    }
+    current_app.datamodels.TimelineEntry.save_many(
+        current_app.datamodels.TimelineEntry(
+            profile=profile,
+            connection_id=connection.id,
+            post_id=post_id,
+        ) for post_id in dict.fromkeys(post_ids) if post_id not in existing
+    )
+
+@validate_request
+@validate_handle
+@validate_payload(
+    fields=(
+        'post_host', 'post_handle', 'post_ids',
+    )
+)
+@validate_connection(host_key='post_host', handle_key='post_handle')
+def _notify_posts(request_data, connectee, request_payload, requestor):
+    current_app.datamodels.PostReference.save_many(
+        current_app.datamodels.PostReference(
+            connection=requestor,
+            post_id=post_id,
+            reference_read=False,
+            read=False
+        ) for post_id in request_payload['post_ids']
+    )
+    _add_timeline_entries(connectee, requestor, request_payload['post_ids'])
     return '', 200
 
+@blueprint.route('/post-notify-batch', methods=['POST'])
+@json_request
+@validate_request(fields=('notifications',))
+def post_notify_batch(request_data):
+    ''' Batched version of post-notify for a host with several of our
+        users' connections. Each notification is validated and handled the
+        same way a single post-notify request is.
+        request should be JSON:
+        {
+          'notifications': [{
+            'handle': 'handle of user to notify',
+            ...encrypted fields as for post-notify, with enc_payload:
+            {
+              'post_host': 'hostname',
+              'post_handle': 'requestor handle',
+              'post_ids': ['ids of new posts'],
+            }
+          }]
+        }
+        returns { 'results': [{ 'handle': handle, 'status': status code }] }
+        in the same order as the notifications
+    '''
+    if not isinstance(request_data['notifications'], list):
+        return 'Invalid request - notifications must be a list', 400
+    results = []
+    for notification in request_data['notifications']:
+        if not isinstance(notification, dict):
+            results.append({'handle': None, 'status': 400})
+            continue
+        try:
+            _, status = _notify_posts(request_data=notification)
+        except Exception as e:
+            # one bad notification shouldn't fail the rest of the batch
+            print(f'Post notify failed for {notification.get("handle")}: {e!r}')
+            status = 500
+        results.append({'handle': notification.get('handle'), 'status': status})
+    return jsonify(results=results), 200
+
 @blueprint.route('/comment-created', methods=['POST'])
 @json_request
 @validate_request
@@ -233,6 +445,9 @@ def comment_created(request_data, connectee, request_payload, requestor):
         post_id=request_payload['post_id'],
     )
     comment_reference.save()
+    # connections with the post cached need to pick up the new comment
+    post.updated = datetime.now().astimezone(tz.UTC)
+    post.save()
     return '', 200
 
 @blueprint.route('/retrieve-comments', methods=['POST'])
@@ -252,21 +467,40 @@ def retrieve_comments(request_data, connectee, request_payload, requestor):
           'host': 'requestor host',
           'handle': 'requestor handle',
           'post_ids': ['array of post ids'],
+          'since': {
+            'post id': 'optional - only comments created after this time',
+          },
         }
+        Requests can also send 'accept_compression' like retrieve_posts.
     '''
-    all_comments = []
-    for msg_id in request_payload['post_ids']:
-        comments = current_app.datamodels.Comment.list(post_id=msg_id)
-        for comment in comments:
-            comment.files = current_app.url_signer(comment.files)
-        all_comments.extend([c.as_json() for c in comments])
-    enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
-        connectee, requestor, all_comments
-    )
-    return jsonify(
-        enc_payload=enc_payload,
-        enc_key=enc_key,
-        signature=signature,
-        nonce=nonce,
-        tag=tag
-    ), 200
+    if not isinstance(request_payload.get('since') or {}, dict):
+        return 'Invalid payload - since must be an object', 400
+    since = {}
+    for post_id, timestamp in (request_payload.get('since') or {}).items():
+        try:
+            since[post_id] = datetime.fromisoformat(timestamp)
+        except (TypeError, ValueError):
+            # send them all rather than fail the whole request
+            continue
+        if not since[post_id].tzinfo:
+            since[post_id] = since[post_id].replace(tzinfo=tz.UTC)
+    post_ids = request_payload['post_ids']
+    comments = []
+    all_post_ids = [post_id for post_id in post_ids if post_id not in since]
+    if all_post_ids:
+        comments.extend(current_app.datamodels.Comment.list(post_id__in=all_post_ids))
+    since_post_ids = [post_id for post_id in post_ids if post_id in since]
+    if since_post_ids:
+        # one query from the earliest watermark, then each post's own
+        comments.extend(
+            comment for comment in current_app.datamodels.Comment.list(
+                post_id__in=since_post_ids,
+                created__gt=min(since[post_id] for post_id in since_post_ids),
+            ) if comment.created > since[comment.post_id]
+        )
+    sign_files(comments)
+    all_comments = [c.as_json() for c in comments]
+    return jsonify(secure_envelope(
+        connectee, requestor, all_comments,
+        accept_compression=request_data.get('accept_compression'),
+    )), 200
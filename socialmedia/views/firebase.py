@@ -33,6 +33,7 @@ def check_user(user_id):
         return 'Not Found', 404
     # removing private_key from user object in session
     profiles[0]['private_key'] = None
+    profiles[0]['ec_private_key'] = None
     # adding id to use for key creation later
     profiles[0]['id'] = profiles[0].id
     session['user'] = profiles[0]
@@ -1,4 +1,3 @@
-from collections import defaultdict
 from dateparser import parse
 from datetime import datetime
 from dateutil import tz
@@ -12,17 +11,27 @@ from flask import (
 )
 from flask_login import logout_user
 
-import asyncio
 import json
-import requests
+import time
 from werkzeug import formparser
 from werkzeug.utils import secure_filename
 
 from socialmedia import connection_status
+from socialmedia.media import select_files
 from socialmedia.views.utils import (
-    enc_and_sign_payload,
-    decrypt_payload,
+    accepted_compressions,
+    fan_out,
+    FanOutTimeout,
+    get_comment_references,
+    get_display_width,
+    get_page_size,
     get_post_comments,
+    NEXT_CURSOR_HEADER,
+    open_envelope,
+    queue_media_processing,
+    remote_posts_cache,
+    secure_envelope,
+    sign_files,
 )
 from socialmedia.views.auth_decorators import verify_user
 
@@ -49,16 +58,64 @@ def sign_out():
 @verify_user
 def get_posts(user_id):
     current_profile = current_app.datamodels.Profile.get(user_id=session['user']['user_id'])
-    comment_references = defaultdict(list)
-    posts = current_app.datamodels.Post.list(profile=current_profile, order=['-created'])
+    try:
+        posts = current_app.datamodels.Post.list(
+            profile=current_profile,
+            order=['-created'],
+            limit=get_page_size(request.args.get('limit')),
+            cursor=request.args.get('cursor'),
+        )
+        width = get_display_width(request.args.get('width'))
+    except ValueError as e:
+        return f'Invalid paging parameters: {e}', 400
     for post in posts:
-        post.files = current_app.url_signer(post.files)
-        for comment_reference in current_app.datamodels.CommentReference.list(
-            post_id=post.id
-        ):
-            comment_references[post.id].append(comment_reference)
-    get_post_comments(posts, comment_references, request.host)
+        post.files = select_files(post.files, post.variants, width)
+    sign_files(posts)
+    get_post_comments(posts, get_comment_references(posts), request.host)
     response = jsonify([m.as_json() for m in posts])
+    if posts.next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = posts.next_cursor
+    return response
+
+@blueprint.route('/get-timeline')
+@verify_user
+def get_timeline(user_id):
+    '''
+    Returns the posts connections have notified this user of, newest first,
+    each with the connection it came from. Paged like get-posts - the cursor
+    for the next page is returned in the X-Next-Cursor header.
+    Entries are deleted when their connection is declined or deleted, so
+    pages are only short if that happens while they're being read.
+    '''
+    current_profile = current_app.datamodels.Profile.get(user_id=user_id)
+    try:
+        entries = current_app.datamodels.TimelineEntry.list(
+            profile=current_profile,
+            order=['-created'],
+            limit=get_page_size(request.args.get('limit')),
+            cursor=request.args.get('cursor'),
+        )
+    except ValueError as e:
+        return f'Invalid paging parameters: {e}', 400
+    # only the connections on this page are looked up
+    connections = {
+        connection.id: connection
+        for connection in current_app.datamodels.Connection.list(
+            profile=current_profile,
+            id__in={entry.connection_id for entry in entries},
+        )
+    }
+    timeline = []
+    for entry in entries:
+        connection = connections.get(entry.connection_id)
+        if not connection:
+            continue
+        entry_json = entry.as_json()
+        entry_json['connection'] = connection.as_json()
+        timeline.append(entry_json)
+    response = jsonify(timeline)
+    if entries.next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = entries.next_cursor
     return response
 
 @blueprint.route('/get-connection-posts/<connection_id>')
@@ -69,13 +126,39 @@ def get_connection_posts(user_id, connection_id):
     if not connection:
         return f'No connection found ({connection_id})', 404
 
+    try:
+        page_size = get_page_size(request.args.get('limit'))
+        width = get_display_width(request.args.get('width'))
+    except ValueError as e:
+        return f'Invalid paging parameters: {e}', 400
     request_payload = {
         'host': request.host,
-        'handle': current_profile.handle
+        'handle': current_profile.handle,
+        'limit': page_size,
     }
+    if request.args.get('cursor'):
+        request_payload['cursor'] = request.args['cursor']
+    if width:
+        request_payload['width'] = width
+    cache_key = (
+        current_profile.user_id, connection.id, request.args.get('cursor'), page_size, width
+    )
+    cached = remote_posts_cache.get(cache_key)
+    if cached:
+        request_payload['version'] = cached['version']
     request_url = f'{connection.host}{url_for("external_comms.retrieve_posts")}'
     try:
-        posts = _perform_secure_request(request_url, current_profile, request_payload, connection)
+        response_payload = _perform_secure_request(
+            request_url, current_profile, request_payload, connection
+        )
+        next_cursor = None
+        if isinstance(response_payload, dict):
+            posts, next_cursor = _cache_connection_posts(cache_key, cached, response_payload)
+        else:
+            # hosts that don't support paging return a plain list of posts
+            posts = response_payload
+        # copies, so the read flags don't end up in the cache
+        posts = [dict(post) for post in posts]
         post_reference_map = {
             pr.post_id: pr
             for pr in current_app.datamodels.PostReference.list(
@@ -87,13 +170,46 @@ def get_connection_posts(user_id, connection_id):
             post_reference = post_reference_map.get(post['id'])
             if post_reference:
                 post['read'] = post_reference.read
-        return jsonify(posts)
+        response = jsonify(posts)
+        if next_cursor:
+            response.headers[NEXT_CURSOR_HEADER] = next_cursor
+        return response
     except SecureRequestException as sre:
         print(sre.response.content)
         return 'Failed to retrieve connection posts', sre.response.status_code
     except Exception as e:
         return f'Failed to decode response: {e}', 500
 
+def _cache_connection_posts(cache_key, cached, response_payload):
+    '''
+    returns the posts and next cursor from a retrieve-posts response - the
+    cached page if it wasn't modified, the cached page with the changed posts
+    swapped in for a delta - and caches the result
+    '''
+    if response_payload.get('not_modified') and cached:
+        return cached['posts'], cached['next_cursor']
+    if response_payload.get('delta') and cached:
+        changed = {post['id']: post for post in response_payload['posts']}
+        posts = [changed.get(post['id'], post) for post in cached['posts']]
+        next_cursor = cached['next_cursor']
+        # unchanged posts still have the signed URLs from the first response
+        fetched = cached['fetched']
+    else:
+        posts = response_payload['posts']
+        next_cursor = response_payload.get('next_cursor')
+        fetched = time.time()
+    # hosts that don't version their posts can't be cached
+    if response_payload.get('version') is not None:
+        ttl = current_app.config.get('REMOTE_POSTS_CACHE_TTL', 240) - (time.time() - fetched)
+        if ttl > 0:
+            remote_posts_cache.set(cache_key, {
+                'version': response_payload['version'],
+                'posts': posts,
+                'next_cursor': next_cursor,
+                'fetched': fetched,
+            }, ttl=ttl)
+    return posts, next_cursor
+
 @blueprint.route('/create-post', methods=['POST'])
 @verify_user
 def create_post(user_id):
@@ -110,6 +226,7 @@ def create_post(user_id):
         files = [secure_filename(f.filename) for f in files.values()]
     )
     post.save()
+    queue_media_processing('post', post)
 
     # reset filenames to signed urls to return to UI
     file_list = current_app.url_signer([filename for filename in post.files])
@@ -149,14 +266,24 @@ def manage_connection(user_id):
         connection.read = True
         connection.save()
     elif request.form['action'] == 'delete':
+        _delete_timeline_entries(connection)
         connection.delete()
     elif request.form['action'] == 'decline':
+        _delete_timeline_entries(connection)
         connection.status = connection_status.DECLINED
         connection.save()
     else:
         return f'Invalid action requested - {request.form["action"]}', 400
     return '{} completed'.format(request.form['action']), 200
 
+def _delete_timeline_entries(connection):
+    ''' removes connection's posts from the timeline '''
+    current_app.datamodels.TimelineEntry.delete_many(
+        current_app.datamodels.TimelineEntry.list(
+            profile=connection.profile, connection_id=connection.id
+        )
+    )
+
 @blueprint.route('/request-connection', methods=['POST'])
 @verify_user
 def request_connection(user_id):
@@ -176,34 +303,47 @@ def request_connection(user_id):
 @blueprint.route('/get-connection-info')
 @verify_user
 def get_connection_info(user_id):
+    '''
+    Returns connections with their post references and total post counts.
+    Post counts are requested from all connected hosts concurrently. Hosts
+    that haven't answered by CONNECTION_INFO_DEADLINE are marked stale.
+    '''
     current_profile = current_app.datamodels.Profile.get(user_id=session['user']['user_id'])
-    async def get_post_count(connection):
+    connections = current_app.datamodels.Connection.list(profile=current_profile)
+    connected = [c for c in connections if c.status == connection_status.CONNECTED]
+    for connection in connected:
         post_references = current_app.datamodels.PostReference.list(
             connection=connection
         )
-        total_post_count = 0
-        request_payload = {
-            'host': request.host,
-            'handle': current_profile.handle
-        }
-        request_url = f'{connection.host}{url_for("external_comms.get_profile_info")}'
-        try:
-            response = _perform_secure_request(
-                request_url, current_profile, request_payload, connection
-            )
-            total_post_count = response['post_count']
-        except SecureRequestException as sre:
-            print(sre)
         setattr(connection, 'post_references', [m.as_json() for m in post_references])
-        setattr(connection, 'total_post_count', total_post_count)
-    connections = current_app.datamodels.Connection.list(profile=current_profile)
-    async def get_connections(connections):
-        gather = asyncio.gather()
-        for connection in connections:
-            if connection.status == connection_status.CONNECTED:
-                asyncio.gather(get_post_count(connection))
-        await gather
-    asyncio.run(get_connections(connections))
+    request_payload = {
+        'host': request.host,
+        'handle': current_profile.handle
+    }
+    # no request context on the worker threads, so build the path up front
+    request_path = url_for('external_comms.get_profile_info')
+    timeout = current_app.config.get('FAN_OUT_TIMEOUT', 5)
+
+    def get_post_count(connection):
+        response = _perform_secure_request(
+            f'{connection.host}{request_path}', current_profile, request_payload,
+            connection, timeout=timeout,
+        )
+        return response['post_count']
+
+    post_counts = fan_out(
+        get_post_count,
+        connected,
+        current_app.config.get('FAN_OUT_CONCURRENCY', 10),
+        deadline=current_app.config.get('CONNECTION_INFO_DEADLINE', 5),
+    )
+    for connection, post_count in zip(connected, post_counts):
+        if isinstance(post_count, FanOutTimeout):
+            setattr(connection, 'stale', True)
+        elif isinstance(post_count, Exception):
+            print(post_count)
+        else:
+            setattr(connection, 'total_post_count', post_count)
     response = {
         'connections': [],
         'post_references': []
@@ -216,6 +356,7 @@ def get_connection_info(user_id):
             continue
         c_json = c.as_json()
         c_json['total_post_count'] = getattr(c, 'total_post_count', 0)
+        c_json['stale'] = getattr(c, 'stale', False)
         c_json['post_references'] = getattr(c, 'post_references', [])
         response['connections'].append(c_json)
         response['post_references'].extend(getattr(c, 'post_references', []))
@@ -261,6 +402,111 @@ def mark_post_reference_read(user_id, post_id):
     post_reference.save()
     return f'post_reference {user_id}:{post_id} marked read', 200
 
+@blueprint.route('/mark-posts-read', methods=['POST'])
+@verify_user
+def mark_posts_read(user_id):
+    '''
+    Batch version of mark-post-read. Marks either the posts listed or every
+    post received up to a timestamp, from one connection or all of them.
+    JSON body
+        {
+            'post_ids': ['post id', ...],
+            - or -
+            'before': 'timestamp',
+            'connection_id': 'optional - only posts from this connection',
+        }
+    '''
+    return _mark_post_references_read(user_id, mark_post_read=True)
+
+@blueprint.route('/mark-post-references-read', methods=['POST'])
+@verify_user
+def mark_post_references_read(user_id):
+    '''
+    Batch version of mark-post-reference-read, taking the same JSON body as
+    mark-posts-read
+    '''
+    return _mark_post_references_read(user_id, mark_post_read=False)
+
+@blueprint.route('/mark-connections-read', methods=['POST'])
+@verify_user
+def mark_connections_read(user_id):
+    '''
+    Batch version of mark-connection-read. Marks either the connections
+    listed or every connection updated up to a timestamp.
+    JSON body
+        {
+            'connection_ids': ['connection id', ...],
+            - or -
+            'before': 'timestamp',
+        }
+    '''
+    current_profile = current_app.datamodels.Profile.get(user_id=user_id)
+    request_json = request.get_json(silent=True) or {}
+    try:
+        filters = _mark_read_filters(request_json, 'connection_ids', 'id', 'updated')
+    except ValueError as e:
+        return str(e), 400
+    connections = [
+        connection for connection in current_app.datamodels.Connection.list(
+            profile=current_profile, **filters
+        ) if not connection.read
+    ]
+    for connection in connections:
+        connection.read = True
+    current_app.datamodels.Connection.save_many(connections)
+    return jsonify({'marked_read': [connection.id for connection in connections]})
+
+def _mark_post_references_read(user_id, mark_post_read):
+    current_profile = current_app.datamodels.Profile.get(user_id=user_id)
+    request_json = request.get_json(silent=True) or {}
+    try:
+        filters = _mark_read_filters(request_json, 'post_ids', 'post_id', 'created')
+    except ValueError as e:
+        return str(e), 400
+    if request_json.get('connection_id'):
+        connection = current_app.datamodels.Connection.get(
+            id=request_json['connection_id'], profile=current_profile
+        )
+        if not connection:
+            return f'No such connection ({request_json["connection_id"]})', 404
+        filters['connection'] = connection
+    else:
+        filters['profile'] = current_profile
+    post_references = [
+        post_reference for post_reference
+        in current_app.datamodels.PostReference.list(**filters)
+        if not post_reference.reference_read or (mark_post_read and not post_reference.read)
+    ]
+    for post_reference in post_references:
+        post_reference.reference_read = True
+        if mark_post_read:
+            post_reference.read = True
+    current_app.datamodels.PostReference.save_many(post_references)
+    return jsonify({
+        'marked_read': [post_reference.post_id for post_reference in post_references]
+    })
+
+def _mark_read_filters(request_json, ids_key, id_attr, timestamp_attr):
+    '''
+    list() keywords selecting either the ids in request_json[ids_key] or
+    everything with timestamp_attr up to request_json['before']
+    '''
+    if ids_key in request_json and 'before' in request_json:
+        raise ValueError(f'Only one of {ids_key} or before may be given')
+    if ids_key in request_json:
+        ids = request_json[ids_key]
+        if not isinstance(ids, list):
+            raise ValueError(f'{ids_key} must be a list')
+        return {f'{id_attr}__in': ids}
+    if 'before' in request_json:
+        before = parse(str(request_json['before']))
+        if not before:
+            raise ValueError(f'Invalid timestamp {request_json["before"]}')
+        if not before.tzinfo:
+            before = before.replace(tzinfo=tz.UTC)
+        return {f'{timestamp_attr}__lte': before}
+    raise ValueError(f'One of {ids_key} or before is required')
+
 @blueprint.route('/add-comment/<post_id>', methods=['POST'])
 @verify_user
 def add_comment(user_id, post_id):
@@ -280,6 +526,7 @@ def add_comment(user_id, post_id):
         files=[secure_filename(f.filename) for f in files.values()],
     )
     comment.save()
+    queue_media_processing('comment', comment)
     if connection:
         payload = {
             'user_key': current_profile.user_id,
@@ -297,33 +544,26 @@ class SecureRequestException(Exception):
         self.response = response
         super().__init__(response.content)
 
-def _perform_secure_request(url, current_profile, payload, connection):
+def _perform_secure_request(url, current_profile, payload, connection, timeout=None):
     _timer = datetime.now()
-    enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
-        current_profile, connection, payload
-    )
+    envelope = secure_envelope(current_profile, connection, payload)
     protocol = 'https'
     if connection.host == 'localhost:8080': # pragma: no cover
         protocol = 'http'
-    response = requests.post(
+    # without a timeout of its own the request gets the http client's default
+    kwargs = {} if timeout is None else {'timeout': timeout}
+    response = current_app.http_client.post(
         f'{protocol}://{url}',
         json={
-            'enc_payload': enc_payload,
-            'enc_key': enc_key,
-            'signature': signature,
-            'nonce': nonce,
-            'tag': tag,
+            **envelope,
             'handle': connection.handle,
-        }
+            'accept_compression': accepted_compressions(),
+        },
+        **kwargs,
     )
     if response.status_code == 200:
-        response_data = json.loads(response.content)
-        response_payload = decrypt_payload(
-            current_profile,
-            response_data['enc_key'],
-            response_data['enc_payload'],
-            response_data['nonce'],
-            response_data['tag'],
+        response_payload = open_envelope(
+            current_profile, connection, json.loads(response.content)
         )
         print(f'_perform_secure_request({url}): {(datetime.now() - _timer).total_seconds()}')
         return response_payload
@@ -0,0 +1,20 @@
+from flask import (
+    Blueprint,
+    jsonify,
+    session,
+)
+from flask_login import current_user
+
+from socialmedia import metrics
+
+blueprint = Blueprint('metrics', __name__)
+
+@blueprint.route('/')
+def get_metrics():
+    ''' Reports process-wide metrics for this instance. Admin only. '''
+    if not current_user.is_authenticated:
+        return 'Not authorized', 401
+    requesting_user = session.get('authenticated_user')
+    if not requesting_user or not requesting_user.get('admin'):
+        return 'Not authorized', 401
+    return jsonify(metrics.collect())
@@ -1,18 +1,21 @@
 import base64
 import json
+from collections import defaultdict
 from datetime import datetime
 
-import requests
-
 from dateutil import tz
-from flask import current_app, Blueprint, request, url_for
+from flask import current_app, Blueprint, jsonify, request, url_for
 
-from socialmedia import connection_status
+from socialmedia import connection_status, media
 from socialmedia.views.validation_decorators import (
     json_request,
     validate_request,
 )
-from socialmedia.views.utils import enc_and_sign_payload
+from socialmedia.views.utils import (
+    enc_and_sign_payload,
+    ensure_session,
+    secure_envelope,
+)
 
 blueprint = Blueprint('queue_workers', __name__)
 
@@ -43,6 +46,9 @@ def ack_connection(request_data):
       'ack_display_name': profile.display_name,
       'ack_public_key': profile.public_key.decode(),
     }
+    # advertise EC keys - the requestor uses them if it has EC keys too
+    if profile.ec_public_key:
+        request_payload['ack_ec_public_key'] = profile.ec_public_key
     enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
         profile, connection, request_payload
     )
@@ -51,7 +57,7 @@ def ack_connection(request_data):
         protocol = 'http'
     request_url = f'{protocol}://{connection.host}{url_for("external_comms.ack_connection")}'
     # send request to connection's host
-    response = requests.post(
+    response = current_app.http_client.post(
         request_url,
         json={
             'enc_payload': enc_payload,
@@ -94,12 +100,14 @@ def request_connection(request_data):
       'requestor_display_name': profile.display_name,
       'requestor_public_key': profile.public_key.decode(),
     }
+    if profile.ec_public_key:
+        request_payload['requestor_ec_public_key'] = profile.ec_public_key
     protocol = 'https'
     if request_data['host'] == 'localhost:8080': # pragma: no cover
         protocol = 'http'
     request_url = f'{protocol}://{request_data["host"]}{url_for("external_comms.request_connection")}'
     # send request to connection's host
-    response = requests.post(
+    response = current_app.http_client.post(
         request_url, json={
             'enc_payload': base64.b64encode(
                 json.dumps(request_payload).encode()
@@ -128,8 +136,9 @@ def request_connection(request_data):
 @json_request
 @validate_request(fields=('post_id',))
 def post_created(request_data):
-    ''' Finds all connections and puts a task on the post-notify queue
-        for each to notify that a new post has been created
+    ''' Groups connections by host and puts a task on the post-notify queue
+        for each host to notify all of its connections that a new post has
+        been created
         payload should be JSON
         {
             'post_id': 'post id'
@@ -140,18 +149,112 @@ def post_created(request_data):
         print(f'post {request_data["post_id"]} not found')
         return f'post {request_data["post_id"]} not found', 404
     connections = current_app.datamodels.Connection.list(profile=post.profile)
+    connection_keys = defaultdict(list)
+    for connection in connections:
+        # nothing to notify until the connection has been acknowledged
+        if connection.status == connection_status.CONNECTED:
+            connection_keys[connection.host].append(connection.id)
+    batch_size = current_app.config.get('POST_NOTIFY_BATCH_SIZE', 100)
+    for host, keys in connection_keys.items():
+        for i in range(0, len(keys), batch_size):
+            payload = {
+                'user_key': post.profile.user_id,
+                'post_id': request_data['post_id'],
+                'host': host,
+                'connection_keys': keys[i:i + batch_size],
+            }
+            current_app.task_manager.queue_task(
+                payload,
+                'post-notify',
+                url_for('queue_workers.post_notify_batch')
+            )
+    return 'Notification tasks created', 200
+
+def _queue_post_notify(profile, post_id, connections):
     for connection in connections:
-        payload = {
-            'user_key': post.profile.user_id,
-            'post_id': request_data['post_id'],
-            'connection_key': connection.id,
-        }
         current_app.task_manager.queue_task(
-            payload,
+            {
+                'user_key': profile.user_id,
+                'post_id': post_id,
+                'connection_key': connection.id,
+            },
             'post-notify',
             url_for('queue_workers.post_notify')
         )
-    return 'Notification tasks created', 200
+
+@blueprint.route('/post-notify-batch', methods=['POST'])
+@json_request
+@validate_request(fields=(
+    'user_key',
+    'post_id',
+    'host',
+    'connection_keys',
+))
+def post_notify_batch(request_data):
+    '''
+        Notifies all of a host's connections that a new post has been posted
+        with a single request. Hosts that don't accept batches, and any
+        connections the batch failed for, get individual post-notify tasks.
+        payload should be JSON
+        {
+            'user_key': 'user key for datastore', # post creator
+            'post_id': 'post id'
+            'host': 'host the connections live on',
+            'connection_keys': ['connection keys'], # connections to notify
+        }
+    '''
+    profile = current_app.datamodels.Profile.get(user_id=request_data['user_key'])
+    connection_keys = set(request_data['connection_keys'])
+    connections = [
+        connection
+        for connection in current_app.datamodels.Connection.list(profile=profile)
+        if connection.id in connection_keys
+    ]
+    if not connections:
+        return f'No connections found on {request_data["host"]}', 404
+    notifications = []
+    for connection in connections:
+        request_payload = {
+          'post_host': request.host,
+          'post_handle': profile.handle,
+          'post_ids': [request_data['post_id']],
+        }
+        ensure_session(profile, connection, request.host)
+        notifications.append({
+            **secure_envelope(profile, connection, request_payload),
+            'handle': connection.handle,
+        })
+    host = request_data['host']
+    protocol = 'https'
+    if host == 'localhost:8080': # pragma: no cover
+        protocol = 'http'
+    request_url = f'{protocol}://{host}{url_for("external_comms.post_notify_batch")}'
+    # send request to connections' host
+    response = current_app.http_client.post(request_url, json={'notifications': notifications})
+    if response.status_code == 404:
+        print(f'{host} does not accept batched post notifications')
+        _queue_post_notify(profile, request_data['post_id'], connections)
+        return f'Notifications for {host} queued individually', 200
+    if response.status_code != 200:
+        print('Post notify batch failed {}:{}'.format(response.status_code, response.content))
+        return (
+            'Post notify batch failed {}:{}'.format(response.status_code, response.content),
+            response.status_code
+        )
+    results = json.loads(response.content).get('results')
+    if not isinstance(results, list):
+        results = []
+    # connections without a result of their own count as failed, so a short
+    # or malformed results list doesn't drop anyone
+    failed = [
+        connection for i, connection in enumerate(connections)
+        if i >= len(results) or not isinstance(results[i], dict)
+            or results[i].get('status') != 200
+    ]
+    if failed:
+        print(f'Post notify failed for {[c.handle for c in failed]} on {host}, retrying individually')
+        _queue_post_notify(profile, request_data['post_id'], failed)
+    return f'{len(connections) - len(failed)} connections on {host} notified', 200
 
 @blueprint.route('/post-notify', methods=['POST'])
 @json_request
@@ -176,22 +279,17 @@ def post_notify(request_data):
       'post_handle': connection.profile.handle,
       'post_id': request_data['post_id'],
     }
-    enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
-        connection.profile, connection, request_payload
-    )
+    ensure_session(connection.profile, connection, request.host)
+    envelope = secure_envelope(connection.profile, connection, request_payload)
     protocol = 'https'
     if connection.host == 'localhost:8080': # pragma: no cover
         protocol = 'http'
     request_url = f'{protocol}://{connection.host}{url_for("external_comms.post_notify")}'
     # send request to connection's host
-    response = requests.post(
+    response = current_app.http_client.post(
         request_url,
         json={
-            'enc_payload': enc_payload,
-            'enc_key': enc_key,
-            'signature': signature,
-            'nonce': nonce,
-            'tag': tag,
+            **envelope,
             'handle': connection.handle,
         }
     )
@@ -234,22 +332,17 @@ def comment_created(request_data):
       'post_id': request_data['post_id'],
       'comment_id': request_data['comment_id'],
     }
-    enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
-        profile, connection, request_payload
-    )
+    ensure_session(profile, connection, request_data['user_host'])
+    envelope = secure_envelope(profile, connection, request_payload)
     protocol = 'https'
     if connection.host == 'localhost:8080': # pragma: no cover
         protocol = 'http'
     request_url = f'{protocol}://{connection.host}{url_for("external_comms.comment_created")}'
     # send request to connection's host
-    response = requests.post(
+    response = current_app.http_client.post(
         request_url,
         json={
-            'enc_payload': enc_payload,
-            'enc_key': enc_key,
-            'signature': signature,
-            'nonce': nonce,
-            'tag': tag,
+            **envelope,
             'handle': connection.handle,
         }
     )
@@ -265,3 +358,62 @@ def comment_created(request_data):
         request_data['post_id'],
         request_data['comment_id']
     ), 200
+
+@blueprint.route('/process-media', methods=['POST'])
+@json_request
+@validate_request(fields=('kind', 'id'))
+def process_media(request_data):
+    ''' Strips metadata from a post's or comment's images and makes resized
+        copies of them, recorded in the post's or comment's variants
+        payload should be JSON
+        {
+            'kind': 'post' or 'comment',
+            'id': 'post or comment id',
+        }
+    '''
+    if current_app.object_store is None or not media.available():
+        # nothing to do it with - retrying won't help
+        print('Media processing is not available')
+        return 'Media processing is not available', 200
+    model = {
+        'post': current_app.datamodels.Post,
+        'comment': current_app.datamodels.Comment,
+    }.get(request_data['kind'])
+    if not model:
+        return f'Unknown kind {request_data["kind"]}', 400
+    obj = model.get(id=request_data['id'])
+    if not obj:
+        return f'{request_data["kind"]} {request_data["id"]} not found', 404
+    variants = dict(obj.variants)
+    for filename in obj.files:
+        if filename in variants:
+            continue
+        # files that aren't images get an empty entry so they're skipped
+        # if the task is retried
+        variants[filename] = media.process_image(
+            current_app.object_store,
+            filename,
+            current_app.config.get('MEDIA_VARIANT_WIDTHS', [320, 640, 1280]),
+        ) or {}
+    obj.variants = variants
+    if request_data['kind'] == 'post':
+        # connections with the post cached need to pick up the new files
+        obj.updated = datetime.now().astimezone(tz.UTC)
+    obj.save()
+    return f'Processed {len(obj.files)} files for {request_data["kind"]} {obj.id}', 200
+
+@blueprint.route('/repair-counters')
+def repair_counters():
+    ''' Recounts every profile's posts and fixes post counters that have
+        drifted (a post written while its counter was being initialized,
+        say). Run by cron.
+    '''
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        return 'Not authorized', 401
+    repaired = []
+    for profile in current_app.datamodels.Profile.list():
+        counted, count = current_app.datamodels.Post.repair_count(profile=profile)
+        if counted != count:
+            print(f'Repaired post count for {profile.handle}: {counted} -> {count}')
+            repaired.append({'handle': profile.handle, 'was': counted, 'count': count})
+    return jsonify({'repaired': repaired}), 200
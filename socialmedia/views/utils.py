@@ -2,35 +2,168 @@ import asyncio
 import base64
 import dateparser
 import json
+import os
 import requests
+import time
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 from Crypto import Random
 from Crypto.Cipher import AES, PKCS1_OAEP
-from Crypto.Hash import SHA256
+from Crypto.Hash import HMAC, SHA256
+from Crypto.Protocol.KDF import HKDF
 from Crypto.PublicKey import RSA
 from Crypto.Signature import pkcs1_15
-from flask import current_app, url_for
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import (
+    Ed25519PrivateKey,
+    Ed25519PublicKey,
+)
+from cryptography.hazmat.primitives.asymmetric.x25519 import (
+    X25519PrivateKey,
+    X25519PublicKey,
+)
+from dateutil import tz
+from flask import current_app, has_app_context, url_for
 # using this instead of json.dumps because it handles datetimes
 from flask.json import dumps
 
-from socialmedia import models
+from socialmedia import compression, metrics, models
+from socialmedia.cache import LRUCache
 
-def enc_and_sign_payload(profile, connection, payload, json_default=None):
-    # profile is requesting profile and must have a private key
-    # connection is requested connection which will only have public key
+# response header used to hand the next page cursor back to the browser
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+MAX_PAGE_SIZE = 100
+
+# key suites payloads can be signed and have their keys wrapped with - RSA
+# (PKCS#1 v1.5 signatures, OAEP) or Ed25519 signatures with X25519 ECIES.
+# EC_SUITE is used with connections when both profiles have EC keys.
+RSA_SUITE = 'rsa'
+EC_SUITE = 'ec25519'
+EC_KEY_SIZE = 32
+
+# parsed RSA keys keyed by a digest of their PEM - parsing a PEM costs more
+# than the RSA operation it's used for. Parsed EC keys are kept here too,
+# keyed by a digest of their hex. A replaced key is never looked up again
+# (its digest changes with it), so it's left for the LRU to evict.
+key_cache = LRUCache(maxsize=int(os.environ.get('KEY_CACHE_SIZE', '256')))
+metrics.register('key_cache', key_cache.stats)
+
+# pages of connections' posts, decrypted, with the version the connection's
+# host gave them so it can answer with just what's changed. They can't be
+# kept longer than the signed URLs in them stay valid (REMOTE_POSTS_CACHE_TTL)
+remote_posts_cache = LRUCache(maxsize=int(os.environ.get('REMOTE_POSTS_CACHE_SIZE', '1000')))
+metrics.register('remote_posts_cache', remote_posts_cache.stats)
+
+# comments fetched from commentors' hosts, per post owner, commentor and
+# post, so later requests only ask for comments newer than the latest one
+# cached. Like remote_posts_cache, entries hold signed URLs so they expire
+# after REMOTE_COMMENTS_CACHE_TTL.
+remote_comments_cache = LRUCache(
+    maxsize=int(os.environ.get('REMOTE_COMMENTS_CACHE_SIZE', '10000'))
+)
+metrics.register('remote_comments_cache', remote_comments_cache.stats)
+
+def _key_digest(pem):
+    if isinstance(pem, str):
+        pem = pem.encode()
+    return SHA256.new(pem).hexdigest()
+
+def import_key(pem):
+    ''' returns the parsed RSA key for pem, from key_cache if possible '''
+    digest = _key_digest(pem)
+    key = key_cache.get(digest)
+    if key is None:
+        key = RSA.importKey(pem)
+        key_cache.set(digest, key)
+    return key
+
+def import_ec_keys(key_hex, private=False):
+    '''
+    returns the (Ed25519, X25519) keys for a profile's EC public or private
+    key, from key_cache if possible
+    '''
+    digest = _key_digest(key_hex)
+    keys = key_cache.get(digest)
+    if keys is None:
+        raw = bytes.fromhex(key_hex)
+        signing, exchange = raw[:EC_KEY_SIZE], raw[EC_KEY_SIZE:]
+        if private:
+            keys = (
+                Ed25519PrivateKey.from_private_bytes(signing),
+                X25519PrivateKey.from_private_bytes(exchange),
+            )
+        else:
+            keys = (
+                Ed25519PublicKey.from_public_bytes(signing),
+                X25519PublicKey.from_public_bytes(exchange),
+            )
+        key_cache.set(digest, keys)
+    return keys
+
+def _raw_public_key(key):
+    return key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+def supported_suites(profile):
+    ''' key suites profile can receive, most preferred first '''
+    if getattr(profile, 'ec_private_key', None):
+        return (EC_SUITE, RSA_SUITE)
+    return (RSA_SUITE,)
+
+def ec_suite_supported(profile, connection):
+    ''' True if messages between profile and connection can use EC_SUITE '''
+    return bool(
+        getattr(profile, 'ec_private_key', None)
+        and getattr(connection, 'ec_public_key', None)
+    )
+
+def _ecies_key(shared_secret, ephemeral_public, recipient_public):
+    # binds the AES key to both X25519 public keys
+    return HKDF(
+        shared_secret, 16, ephemeral_public + recipient_public, SHA256,
+        context=b'socialmedia-ecies',
+    )
+
+def run_crypto(func, *args):
+    '''
+    runs func(*args) on the app's crypto executor, or on this thread outside
+    an app (scripts, benchmarks)
+    '''
+    executor = getattr(current_app, 'crypto_executor', None) if has_app_context() else None
+    if executor is None:
+        return func(*args)
+    return executor.run(func, *args)
+
+# the _rsa/_ec/_session functions below do the crypto work for the helpers
+# after them. They take keys as PEM/hex and payloads as bytes so they can be
+# sent to a crypto executor's worker processes.
+
+def _compressed(payload_as_bytes, compression_name):
+    if not compression_name:
+        return payload_as_bytes
+    return compression.compress(compression_name, payload_as_bytes)
+
+def _decompressed(payload_as_bytes, compression_name):
+    if not compression_name:
+        return payload_as_bytes
+    return compression.decompress(compression_name, payload_as_bytes)
+
+def _rsa_enc_and_sign(private_key, public_key, payload_as_bytes, compression_name=None):
     key = Random.get_random_bytes(16)
-    user_key = RSA.importKey(profile.private_key)
+    user_key = import_key(private_key)
     # connection's key
-    conn_key = RSA.importKey(connection.public_key)
-    # convert json payload to bytes
-    payload_as_bytes = dumps(payload, default=json_default).encode()
+    conn_key = import_key(public_key)
     # get encoding key from connection key
     cipher_rsa = PKCS1_OAEP.new(conn_key)
     enc_key = cipher_rsa.encrypt(key)
     cipher_aes = AES.new(key, AES.MODE_EAX)
-    enc_payload, tag = cipher_aes.encrypt_and_digest(payload_as_bytes)
+    # the signature is over the uncompressed payload
+    enc_payload, tag = cipher_aes.encrypt_and_digest(
+        _compressed(payload_as_bytes, compression_name)
+    )
     signature_hash = SHA256.new(payload_as_bytes)
     signature = pkcs1_15.new(user_key).sign(signature_hash)
     return (
@@ -41,33 +174,507 @@ def enc_and_sign_payload(profile, connection, payload, json_default=None):
         tag.hex(),
     )
 
-def decrypt_payload(user, enc_key, enc_payload, nonce, tag):
-    user_key = RSA.importKey(user.private_key)
-    cipher_rsa = PKCS1_OAEP.new(user_key)
-    encrypt_key = cipher_rsa.decrypt(base64.b64decode(enc_key))
+def _ec_enc_and_sign(private_key, public_key, payload_as_bytes, compression_name=None):
+    signing_key, _ = import_ec_keys(private_key, private=True)
+    _, conn_key = import_ec_keys(public_key)
+    ephemeral_key = X25519PrivateKey.generate()
+    ephemeral_public = _raw_public_key(ephemeral_key.public_key())
+    key = _ecies_key(
+        ephemeral_key.exchange(conn_key), ephemeral_public, _raw_public_key(conn_key)
+    )
+    cipher_aes = AES.new(key, AES.MODE_EAX)
+    enc_payload, tag = cipher_aes.encrypt_and_digest(
+        _compressed(payload_as_bytes, compression_name)
+    )
+    signature = signing_key.sign(payload_as_bytes)
+    return (
+        base64.b64encode(enc_payload).decode(),
+        base64.b64encode(ephemeral_public).decode(),
+        signature.hex(),
+        cipher_aes.nonce.hex(),
+        tag.hex(),
+    )
+
+def _decrypt(suite, private_key, enc_key, enc_payload, nonce, tag, compression_name=None):
+    if suite == EC_SUITE:
+        _, user_key = import_ec_keys(private_key, private=True)
+        ephemeral_public = base64.b64decode(enc_key)
+        encrypt_key = _ecies_key(
+            user_key.exchange(X25519PublicKey.from_public_bytes(ephemeral_public)),
+            ephemeral_public, _raw_public_key(user_key.public_key()),
+        )
+    else:
+        user_key = import_key(private_key)
+        cipher_rsa = PKCS1_OAEP.new(user_key)
+        encrypt_key = cipher_rsa.decrypt(base64.b64decode(enc_key))
     cipher_aes = AES.new(encrypt_key, AES.MODE_EAX, bytes.fromhex(nonce))
-    decrypt_payload = cipher_aes.decrypt_and_verify(
+    return _decompressed(cipher_aes.decrypt_and_verify(
         base64.b64decode(enc_payload), bytes.fromhex(tag)
-    )
-    return json.loads(decrypt_payload)
+    ), compression_name)
 
-def verify_signature(connection, signature, payload):
-    connect_key = RSA.importKey(connection.public_key)
-    payload_as_bytes = dumps(payload).encode()
+def _verify(suite, public_key, signature, payload_as_bytes):
+    if suite == EC_SUITE:
+        connect_key, _ = import_ec_keys(public_key)
+        try:
+            connect_key.verify(bytes.fromhex(signature), payload_as_bytes)
+        except InvalidSignature:
+            # same as a failed RSA verification
+            raise ValueError('Invalid signature')
+        return True
+    connect_key = import_key(public_key)
     signature_hash = SHA256.new(payload_as_bytes)
     pkcs1_15.new(connect_key).verify(signature_hash, bytes.fromhex(signature))
     return True
 
+def _session_keys(session_key):
+    # separate keys for encryption and for the mac, both derived from the
+    # shared session key
+    return HKDF(
+        bytes.fromhex(session_key), 32, b'', SHA256,
+        num_keys=2, context=b'socialmedia-session',
+    )
+
+def _session_encrypt(session_key, payload_as_bytes, compression_name=None):
+    enc_key, mac_key = _session_keys(session_key)
+    cipher_aes = AES.new(enc_key, AES.MODE_EAX)
+    enc_payload, tag = cipher_aes.encrypt_and_digest(
+        _compressed(payload_as_bytes, compression_name)
+    )
+    return (
+        base64.b64encode(enc_payload).decode(),
+        HMAC.new(mac_key, payload_as_bytes, SHA256).hexdigest(),
+        cipher_aes.nonce.hex(),
+        tag.hex(),
+    )
+
+def _session_decrypt(session_key, enc_payload, nonce, tag, compression_name=None):
+    enc_key, _ = _session_keys(session_key)
+    cipher_aes = AES.new(enc_key, AES.MODE_EAX, bytes.fromhex(nonce))
+    return _decompressed(cipher_aes.decrypt_and_verify(
+        base64.b64decode(enc_payload), bytes.fromhex(tag)
+    ), compression_name)
+
+def _session_verify_mac(session_key, mac, payload_as_bytes):
+    _, mac_key = _session_keys(session_key)
+    HMAC.new(mac_key, payload_as_bytes, SHA256).hexverify(mac)
+    return True
+
+def enc_and_sign_payload(profile, connection, payload, json_default=None, compression_name=None):
+    # profile is requesting profile and must have a private key
+    # connection is requested connection which will only have public key
+    # convert json payload to bytes
+    payload_as_bytes = dumps(payload, default=json_default).encode()
+    return run_crypto(
+        _rsa_enc_and_sign, profile.private_key, connection.public_key, payload_as_bytes,
+        compression_name,
+    )
+
+def ec_enc_and_sign_payload(profile, connection, payload, json_default=None, compression_name=None):
+    '''
+    EC_SUITE counterpart of enc_and_sign_payload. The AES key comes from an
+    X25519 exchange between a new ephemeral key and the connection's key, so
+    enc_key is the ephemeral public key, and payloads are signed with Ed25519.
+    '''
+    payload_as_bytes = dumps(payload, default=json_default).encode()
+    return run_crypto(
+        _ec_enc_and_sign, profile.ec_private_key, connection.ec_public_key, payload_as_bytes,
+        compression_name,
+    )
+
+def decrypt_payload(user, enc_key, enc_payload, nonce, tag, suite=RSA_SUITE, compression_name=None):
+    ''' compression_name is the envelope's compression, if the payload was compressed '''
+    private_key = user.ec_private_key if suite == EC_SUITE else user.private_key
+    return json.loads(run_crypto(
+        _decrypt, suite, private_key, enc_key, enc_payload, nonce, tag, compression_name
+    ))
+
+def verify_signature(connection, signature, payload, suite=RSA_SUITE):
+    if suite == EC_SUITE:
+        if not getattr(connection, 'ec_public_key', None):
+            return False
+        public_key = connection.ec_public_key
+    else:
+        public_key = connection.public_key
+    return run_crypto(_verify, suite, public_key, signature, dumps(payload).encode())
+
+def session_active(connection, grace=0):
+    '''
+    True if connection has a session key that hasn't expired (allowing grace
+    seconds past the expiration)
+    '''
+    if not getattr(connection, 'session_key', None) or not connection.session_expires:
+        return False
+    now = datetime.now().astimezone(tz.UTC)
+    return connection.session_expires + timedelta(seconds=grace) > now
+
+def session_key_for(connection, session_id):
+    '''
+    the key for session_id if it's connection's current session or the one
+    it replaced, and hasn't expired (allowing SESSION_KEY_GRACE seconds) -
+    None otherwise
+    '''
+    grace = current_app.config.get('SESSION_KEY_GRACE', 300)
+    if session_id == getattr(connection, 'session_id', None) \
+            and session_active(connection, grace):
+        return connection.session_key
+    prev_session_key = getattr(connection, 'prev_session_key', None)
+    if prev_session_key and session_id == connection.prev_session_id:
+        now = datetime.now().astimezone(tz.UTC)
+        if connection.prev_session_expires + timedelta(seconds=grace) > now:
+            return prev_session_key
+    return None
+
+def rotate_session(connection, session_id, session_key, session_expires):
+    '''
+    replaces connection's session, keeping the session it replaces as the
+    previous session so messages already sent under it can still be opened
+    '''
+    if getattr(connection, 'session_key', None) and connection.session_id != session_id:
+        connection.prev_session_id = connection.session_id
+        connection.prev_session_key = connection.session_key
+        connection.prev_session_expires = connection.session_expires
+    connection.session_id = session_id
+    connection.session_key = session_key
+    connection.session_expires = session_expires
+
+def decrypt_session_payload(session_key, enc_payload, nonce, tag, compression_name=None):
+    ''' raises ValueError if the payload wasn't encrypted with session_key '''
+    return json.loads(run_crypto(
+        _session_decrypt, session_key, enc_payload, nonce, tag, compression_name
+    ))
+
+def verify_mac(session_key, mac, payload):
+    ''' session counterpart of verify_signature - raises ValueError on mismatch '''
+    return run_crypto(
+        _session_verify_mac, session_key, mac, dumps(payload).encode()
+    )
+
+def accepted_compressions():
+    ''' compression this host accepts in replies to its requests, most preferred first '''
+    return [
+        name for name in current_app.config.get('COMPRESSION', [])
+        if name in compression.available()
+    ]
+
+def negotiate_compression(accept_compression):
+    '''
+    the compression to reply with, given the list a requestor sent as
+    accept_compression - None if there's nothing both sides support
+    '''
+    if not isinstance(accept_compression, list):
+        return None
+    for name in accepted_compressions():
+        if name in accept_compression:
+            return name
+    return None
+
+def secure_envelope(profile, connection, payload, json_default=None, accept_compression=None):
+    '''
+    Encrypts and authenticates payload for connection and returns the fields
+    to send. Uses the connection's session key (AES-EAX plus an HMAC) if
+    there is a live one, otherwise EC_SUITE if both sides have EC keys
+    (ec_enc_and_sign_payload) or RSA (enc_and_sign_payload).
+    Payloads of at least COMPRESSION_MIN_SIZE bytes are compressed before
+    they're encrypted if the receiver sent accept_compression, and the
+    envelope says which compression was used.
+    '''
+    payload_as_bytes = dumps(payload, default=json_default).encode()
+    compression_name = None
+    if len(payload_as_bytes) >= current_app.config.get('COMPRESSION_MIN_SIZE', 1024):
+        compression_name = negotiate_compression(accept_compression)
+    if session_active(connection):
+        enc_payload, mac, nonce, tag = run_crypto(
+            _session_encrypt, connection.session_key, payload_as_bytes, compression_name
+        )
+        envelope = {
+            'session_id': connection.session_id,
+            'enc_payload': enc_payload,
+            'mac': mac,
+            'nonce': nonce,
+            'tag': tag,
+        }
+    else:
+        use_ec = ec_suite_supported(profile, connection)
+        if use_ec:
+            enc_payload, enc_key, signature, nonce, tag = run_crypto(
+                _ec_enc_and_sign, profile.ec_private_key, connection.ec_public_key,
+                payload_as_bytes, compression_name,
+            )
+        else:
+            enc_payload, enc_key, signature, nonce, tag = run_crypto(
+                _rsa_enc_and_sign, profile.private_key, connection.public_key,
+                payload_as_bytes, compression_name,
+            )
+        envelope = {
+            'enc_payload': enc_payload,
+            'enc_key': enc_key,
+            'signature': signature,
+            'nonce': nonce,
+            'tag': tag,
+        }
+        # RSA envelopes are left without a suite for hosts that predate suites
+        if use_ec:
+            envelope['suite'] = EC_SUITE
+    if compression_name:
+        envelope['compression'] = compression_name
+    return envelope
+
+def open_envelope(profile, connection, envelope):
+    '''
+    Decrypts (and decompresses) an envelope built by secure_envelope. Session
+    envelopes also have their mac checked. Raises ValueError if a session
+    envelope doesn't match the connection's current or previous session.
+    '''
+    if 'session_id' in envelope:
+        session_key = session_key_for(connection, envelope['session_id'])
+        if not session_key:
+            raise ValueError(f'Unknown session {envelope["session_id"]}')
+        payload = decrypt_session_payload(
+            session_key, envelope['enc_payload'], envelope['nonce'], envelope['tag'],
+            envelope.get('compression'),
+        )
+        verify_mac(session_key, envelope['mac'], payload)
+        return payload
+    return decrypt_payload(
+        profile,
+        envelope['enc_key'],
+        envelope['enc_payload'],
+        envelope['nonce'],
+        envelope['tag'],
+        envelope.get('suite', RSA_SUITE),
+        envelope.get('compression'),
+    )
+
+def ensure_session(profile, connection, own_host):
+    '''
+    Sets up a session key with connection (over RSA or EC_SUITE) if session keys are
+    enabled and there isn't a live one. Only one side of a connection - the
+    one with the lower handle@host - sets sessions up, so the two sides can't
+    replace each other's keys. A peer that turns the session down isn't asked
+    again for SESSION_KEY_TTL seconds.
+    Returns True if there's a live session to use.
+    '''
+    if session_active(connection):
+        return True
+    if not current_app.config.get('SESSION_KEYS'):
+        return False
+    if f'{profile.handle}@{own_host}' > f'{connection.handle}@{connection.host}':
+        return False
+    now = datetime.now().astimezone(tz.UTC)
+    if connection.session_expires and connection.session_expires > now:
+        return False
+    ttl = current_app.config.get('SESSION_KEY_TTL', 86400)
+    session_id = connection.generate_uuid()
+    session_key = Random.get_random_bytes(32).hex()
+    session_expires = now + timedelta(seconds=ttl)
+    envelope = secure_envelope(profile, connection, {
+        'host': own_host,
+        'handle': profile.handle,
+        'session_id': session_id,
+        'session_key': session_key,
+        'session_expires': session_expires.isoformat(),
+    })
+    protocol = 'https'
+    if connection.host == 'localhost:8080': # pragma: no cover
+        protocol = 'http'
+    request_url = f'{protocol}://{connection.host}{url_for("external_comms.establish_session")}'
+    try:
+        response = current_app.http_client.post(
+            request_url,
+            json={**envelope, 'handle': connection.handle},
+            timeout=current_app.config.get('FAN_OUT_TIMEOUT', 5),
+        )
+    except requests.RequestException as e:
+        print(f'Unable to establish session with {connection.host}: {e!r}')
+        return False
+    if response.status_code == 200:
+        rotate_session(connection, session_id, session_key, session_expires)
+    else:
+        # peer doesn't support sessions (or refused) - stick with RSA for now
+        print(f'Session refused by {connection.host}: {response.status_code}')
+        rotate_session(connection, None, None, session_expires)
+    connection.save()
+    return response.status_code == 200
+
+def get_page_size(requested=None):
+    '''
+    returns the number of posts per page - the configured POST_PAGE_SIZE unless
+    a size was requested, which is capped at MAX_PAGE_SIZE
+    raises ValueError if the requested size isn't a positive number
+    '''
+    if requested is None:
+        return current_app.config.get('POST_PAGE_SIZE', 20)
+    try:
+        page_size = int(requested)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid page size {requested}')
+    if page_size < 1:
+        raise ValueError(f'Invalid page size {requested}')
+    return min(page_size, MAX_PAGE_SIZE)
+
+def get_comment_references(posts):
+    '''
+    returns the comment references for all of posts, grouped by post id,
+    with one query (a connection shared by several references is loaded once)
+    '''
+    comment_references = defaultdict(list)
+    if not posts:
+        return comment_references
+    for comment_reference in current_app.datamodels.CommentReference.list(
+        post_id__in=[post.id for post in posts]
+    ):
+        comment_references[comment_reference.post_id].append(comment_reference)
+    return comment_references
+
+def sign_files(objs):
+    '''
+    replaces the file names on each of objs (posts or comments) with signed
+    URLs, signing all of them in a single url_signer call
+    '''
+    files = [filename for obj in objs for filename in obj.files]
+    if not files:
+        return
+    signed_urls = iter(current_app.url_signer(files))
+    for obj in objs:
+        obj.files = [next(signed_urls) for _ in obj.files]
+
+def get_display_width(requested=None):
+    '''
+    returns the width (in pixels) the client will display images at, used to
+    pick resized image variants, or None if it wasn't given
+    raises ValueError if the width isn't a positive number
+    '''
+    if requested is None:
+        return None
+    try:
+        width = int(requested)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid width {requested}')
+    if width < 1:
+        raise ValueError(f'Invalid width {requested}')
+    return width
+
+def queue_media_processing(kind, obj):
+    ''' queues a task to make resized copies of obj's (a post or comment) images '''
+    if obj.files and current_app.object_store is not None:
+        current_app.task_manager.queue_task(
+            {'kind': kind, 'id': obj.id},
+            'process-media',
+            url_for('queue_workers.process_media'),
+        )
+
 def create_profile(user_id, display_name, handle):
+    public_key, private_key = current_app.key_pool.take()
+    ec_public_key = ec_private_key = None
+    if current_app.config.get('EC_KEYS'):
+        ec_public_key, ec_private_key = current_app.datamodels.Profile.generate_ec_keys()
     profile = current_app.datamodels.Profile(
         display_name=display_name,
         handle=handle,
         user_id=user_id,
+        public_key=public_key,
+        private_key=private_key,
+        ec_public_key=ec_public_key,
+        ec_private_key=ec_private_key,
     )
     profile.save()
     return profile
 
+class FanOutTimeout(Exception):
+    pass
+
+def fan_out(func, items, limit, timeout=None, deadline=None):
+    '''
+    Calls func(item) for each item on a thread pool, running at most limit
+    calls at once. Each call runs in its own app context (so current_app and
+    flask.json behave), but not in the request context.
+    Returns results in the same order as items. A call that raised returns its
+    exception instead, and a call that took longer than timeout seconds, or
+    was still running when deadline seconds passed for the whole batch,
+    returns FanOutTimeout. Threads that time out are not waited for.
+    '''
+    if not items:
+        return []
+    app = current_app._get_current_object() # pylint: disable=protected-access
+    executor = ThreadPoolExecutor(max_workers=min(limit, len(items)))
+
+    def call_in_app_context(item):
+        with app.app_context():
+            return func(item)
+
+    async def call(semaphore, item):
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            return await asyncio.wait_for(
+                loop.run_in_executor(executor, call_in_app_context, item), timeout
+            )
+
+    async def call_all():
+        semaphore = asyncio.Semaphore(limit)
+        tasks = [asyncio.ensure_future(call(semaphore, item)) for item in items]
+        await asyncio.wait(tasks, timeout=deadline)
+        results = []
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                results.append(FanOutTimeout())
+            elif isinstance(task.exception(), asyncio.TimeoutError):
+                results.append(FanOutTimeout())
+            elif task.exception():
+                results.append(task.exception())
+            else:
+                results.append(task.result())
+        return results
+
+    try:
+        return asyncio.run(call_all())
+    finally:
+        executor.shutdown(wait=False)
+
+def _merge_cached_comments(connectee, connection, post_ids, cached, new_comments, cache_ttl):
+    '''
+    adds comments just retrieved from connection's host to the ones cached
+    for each of post_ids, caches the result and returns all of them
+    comments are matched on id, so hosts that send every comment regardless
+    of since are handled too
+    '''
+    new_by_post = defaultdict(list)
+    for comment_json in new_comments:
+        new_by_post[comment_json['post_id']].append(comment_json)
+    now = time.time()
+    all_comments = []
+    for post_id in post_ids:
+        entry = cached.get(post_id)
+        comments = {c['id']: c for c in entry['comments']} if entry else {}
+        comments.update({c['id']: c for c in new_by_post[post_id]})
+        comments = list(comments.values())
+        all_comments.extend(comments)
+        # cached comments still have the signed URLs they were first sent with
+        fetched = entry['fetched'] if entry else now
+        ttl = cache_ttl - (now - fetched)
+        if ttl > 0:
+            remote_comments_cache.set((connectee.user_id, connection.id, post_id), {
+                'comments': comments,
+                'since': max(
+                    (c['created'] for c in comments), key=_comment_created, default=None
+                ),
+                'fetched': fetched,
+            }, ttl=ttl)
+    return all_comments
+
+def _comment_created(created):
+    try:
+        return datetime.fromisoformat(created)
+    except ValueError:
+        return dateparser.parse(created, settings={'TIMEZONE': 'UTC'})
+
 def get_post_comments(posts, comment_references, request_host):
+    '''
+    Retrieves comments for posts from each commentor's host and adds them to
+    the posts. Hosts are contacted concurrently (up to FAN_OUT_CONCURRENCY at a
+    time). A host that fails or doesn't answer within FAN_OUT_TIMEOUT seconds
+    gets an 'error retrieving comments' placeholder on each of its posts.
+    '''
     if not posts:
         return
     commentors = defaultdict(list)
@@ -75,88 +682,106 @@ def get_post_comments(posts, comment_references, request_host):
     all_commentors = {}
     # post_dict to be able to look up posts by id later
     post_dict = {}
-    if not len(posts):
-        return
     connectee = posts[0].profile
     for post in posts:
         post_dict[post.id] = post
         for comment_reference in comment_references[post.id]:
-           commentors[comment_reference.connection.id].append(post)
-           all_commentors[comment_reference.connection.id] = comment_reference.connection
+            commentors[comment_reference.connection.id].append(post)
+            all_commentors[comment_reference.connection.id] = comment_reference.connection
+    # no request context on the worker threads, so build the path up front
+    retrieve_comments_path = url_for('external_comms.retrieve_comments')
+    timeout = current_app.config.get('FAN_OUT_TIMEOUT', 5)
+    cache_ttl = current_app.config.get('REMOTE_COMMENTS_CACHE_TTL', 240)
 
-    async def get_comments(connection, posts):
+    def get_comments(connection):
+        post_ids = list({m.id for m in commentors[connection.id]})
+        cached = {
+            post_id: remote_comments_cache.get((connectee.user_id, connection.id, post_id))
+            for post_id in post_ids
+        }
         request_payload = {
           'host': request_host,
           'handle': connectee.handle,
-          'post_ids': list({m.id for m in posts}),
+          'post_ids': post_ids,
+        }
+        since = {
+            post_id: entry['since'] for post_id, entry in cached.items()
+            if entry and entry['since']
         }
-        # enc_and_sign_payload(profile, connection. request_payload)
+        if since:
+            request_payload['since'] = since
+        # secure_envelope(profile, connection, request_payload)
         # profile is connectee and connection is requestor
-        enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
-            connectee, connection, request_payload
-        )
+        envelope = secure_envelope(connectee, connection, request_payload)
         protocol = 'https'
         if connection.host == 'localhost:8080': # pragma: no cover
             protocol = 'http'
-        request_url = f'{protocol}://{connection.host}{url_for("external_comms.retrieve_comments")}'
+        request_url = f'{protocol}://{connection.host}{retrieve_comments_path}'
         payload = {
-            'enc_payload': enc_payload,
-            'enc_key': enc_key,
-            'signature': signature,
-            'nonce': nonce,
-            'tag': tag,
+            **envelope,
             'handle': connection.handle,
+            'accept_compression': accepted_compressions(),
         }
         # send request to connection's host
-        response = requests.post(
+        response = current_app.http_client.post(
             request_url,
             json=payload,
+            timeout=timeout,
         )
-        if response.status_code == 200:
-            response_data = json.loads(response.content)
-            response_payload = decrypt_payload(
-                connectee,
-                response_data['enc_key'],
-                response_data['enc_payload'],
-                response_data['nonce'],
-                response_data['tag'],
-            )
-            for comment_json in response_payload:
-                comment = models.Comment(
-                    profile=models.Profile(
-                        handle=comment_json['profile']['handle'],
-                        display_name=comment_json['profile']['display_name'],
-                        public_key=comment_json['profile']['public_key'],
-                        user_id=comment_json['profile']['user_id'],
-                    ),
-                    post_id=comment_json['post_id'],
-                    text=comment_json['text'],
-                    files=comment_json['files'],
-                    created=dateparser.parse(
-                        comment_json['created'], settings={'TIMEZONE': 'UTC'}
-                    ),
-                )
-                post_dict[comment.post_id].comments.add(comment)
-        else:
-            for post in posts:
-                post_dict[post.id].comments.add(
+        if response.status_code != 200:
+            print(f'Unable to retrieve comments {response.status_code}')
+            print(response.headers)
+            print(response.content)
+            return None
+        response_payload = open_envelope(
+            connectee, connection, json.loads(response.content)
+        )
+        comments = []
+        for comment_json in _merge_cached_comments(
+            connectee, connection, post_ids, cached, response_payload, cache_ttl
+        ):
+            comments.append(models.Comment(
+                profile=models.Profile(
+                    handle=comment_json['profile']['handle'],
+                    display_name=comment_json['profile']['display_name'],
+                    public_key=comment_json['profile']['public_key'],
+                    user_id=comment_json['profile']['user_id'],
+                ),
+                post_id=comment_json['post_id'],
+                text=comment_json['text'],
+                files=comment_json['files'],
+                created=dateparser.parse(
+                    comment_json['created'], settings={'TIMEZONE': 'UTC'}
+                ),
+            ))
+        return comments
+
+    connections = list(all_commentors.values())
+    results = fan_out(
+        get_comments,
+        connections,
+        current_app.config.get('FAN_OUT_CONCURRENCY', 10),
+        timeout=timeout,
+    )
+    for connection, comments in zip(connections, results):
+        if isinstance(comments, Exception):
+            print(f'Unable to retrieve comments from {connection.host}: {comments!r}')
+            comments = None
+        if comments is None:
+            for post in commentors[connection.id]:
+                post.comments.add(
                     models.Comment(
+                        # passing the key keeps Profile from generating one
                         profile=models.Profile(
                             handle=connection.handle,
                             display_name=connection.display_name,
+                            public_key=connection.public_key,
                         ),
                         text='error retrieving comments',
                         post_id=post.id,
                     )
                 )
-            print(f'Unable to retrieve comments {response.status_code}')
-            print(response.headers)
-            print(response.content)
-
-    async def collect_comments():
-        gather = asyncio.gather()
-        for commentor in all_commentors.values():
-            asyncio.gather(get_comments(commentor, commentors[commentor.id]))
-        await gather
-
-    asyncio.run(collect_comments())
+            continue
+        for comment in comments:
+            if comment.post_id in post_dict:
+                post_dict[comment.post_id].comments.add(comment)
@@ -1,9 +1,22 @@
 import functools
 import json
 
-from flask import current_app, request
+from flask import current_app, g, request
 
-from socialmedia.views.utils import decrypt_payload, verify_signature
+from socialmedia.views.utils import (
+    RSA_SUITE,
+    decrypt_payload,
+    decrypt_session_payload,
+    session_key_for,
+    supported_suites,
+    verify_mac,
+    verify_signature,
+)
+
+RSA_FIELDS = ('enc_payload', 'enc_key', 'signature', 'handle', 'nonce', 'tag')
+# requests encrypted with a session key carry a session id and a mac instead
+# of an RSA encrypted key and a signature
+SESSION_FIELDS = ('enc_payload', 'session_id', 'mac', 'handle', 'nonce', 'tag')
 
 def json_request(func=None):
     '''
@@ -17,20 +30,19 @@ def json_request(func=None):
         return func(*args, **kwargs)
     return extract_json
 
-def validate_request(
-    func=None, fields=(
-        'enc_payload', 'enc_key', 'signature', 'handle',
-        'nonce', 'tag'
-    )
-):
+def validate_request(func=None, fields=RSA_FIELDS):
     '''
-    Validates fields exist in request data.
+    Validates fields exist in request data. With the default fields, session
+    encrypted requests are validated against SESSION_FIELDS instead.
     '''
     if func is None:
         return functools.partial(validate_request, fields=fields)
     @functools.wraps(func)
     def _validate_request(*args, **kwargs):
-        if not all(field in kwargs.get('request_data') for field in fields):
+        required = fields
+        if fields == RSA_FIELDS and 'session_id' in kwargs.get('request_data'):
+            required = SESSION_FIELDS
+        if not all(field in kwargs.get('request_data') for field in required):
             return 'Invalid request - missing required fields', 400
         return func(*args, **kwargs)
     return _validate_request
@@ -56,22 +68,58 @@ def validate_payload(func=None, fields=()):
     '''
     Decrypts the encrypted payload and adds it to kwargs as 'request_payload'.
     Also verifies fields exist in the decrypted payload.
+    Session encrypted payloads are decrypted with the key of the session
+    they were sent under (the connection's current session or the one it
+    replaced). The connection and key are kept on g.session_connection and
+    g.session_key for validate_connection.
     '''
     if func is None:
         return functools.partial(validate_payload)
     @functools.wraps(func)
     def _validate_payload(*args, **kwargs):
+        request_data = kwargs['request_data']
         # decrypt and verify payload
-        try:
-            request_payload = decrypt_payload(
-                kwargs['connectee'],
-                kwargs['request_data']['enc_key'],
-                kwargs['request_data']['enc_payload'],
-                kwargs['request_data']['nonce'],
-                kwargs['request_data']['tag'],
+        if 'session_id' in request_data:
+            connection = current_app.datamodels.Connection.get(
+                profile=kwargs['connectee'],
+                session_id=request_data['session_id'],
+            ) or current_app.datamodels.Connection.get(
+                profile=kwargs['connectee'],
+                prev_session_id=request_data['session_id'],
             )
-        except json.JSONDecodeError:
-            return 'Invalid payload - unable to convert to JSON', 400
+            session_key = connection and session_key_for(connection, request_data['session_id'])
+            if not session_key:
+                return 'Unknown session', 401
+            try:
+                request_payload = decrypt_session_payload(
+                    session_key,
+                    request_data['enc_payload'],
+                    request_data['nonce'],
+                    request_data['tag'],
+                    request_data.get('compression'),
+                )
+            except ValueError:
+                return 'Invalid payload - unable to decrypt', 400
+            g.session_connection = connection
+            g.session_key = session_key
+        else:
+            suite = request_data.get('suite', RSA_SUITE)
+            if suite not in supported_suites(kwargs['connectee']):
+                return f'Unsupported key suite {suite}', 400
+            try:
+                request_payload = decrypt_payload(
+                    kwargs['connectee'],
+                    request_data['enc_key'],
+                    request_data['enc_payload'],
+                    request_data['nonce'],
+                    request_data['tag'],
+                    suite,
+                    request_data.get('compression'),
+                )
+            except json.JSONDecodeError:
+                return 'Invalid payload - unable to convert to JSON', 400
+            except ValueError:
+                return 'Invalid payload - unable to decrypt', 400
         # verify request payload
         if not all(field in request_payload for field in fields):
             return 'Invalid request - missing required fields', 400
@@ -83,7 +131,8 @@ def validate_connection(func=None, host_key='host', handle_key='handle'):
     '''
     Validates requestor and requestee have a valid connection. Adds
     requestor to kwargs as 'requestor'. Verifies signature of request
-    against locally stored public key
+    against locally stored public key (RSA or EC, per the request's suite),
+    or the mac of a session encrypted request against the session key
     '''
     if func is None:
         return functools.partial(
@@ -101,11 +150,27 @@ def validate_connection(func=None, host_key='host', handle_key='handle'):
         if not connection:
             return 'No connection found', 404
         requestor = kwargs['requestor'] = connection
+        if 'session_id' in kwargs['request_data']:
+            if g.session_connection.id != connection.id:
+                return 'Invalid request - session does not match connection', 400
+            try:
+                verify_mac(
+                    g.session_key, kwargs['request_data']['mac'],
+                    kwargs['request_payload']
+                )
+            except ValueError:
+                return 'Invalid request - mac does not match', 400
+            return func(*args, **kwargs)
         # verify signature
-        if not verify_signature(
-            requestor, kwargs['request_data']['signature'],
-            kwargs['request_payload']
-        ):
+        try:
+            verified = verify_signature(
+                requestor, kwargs['request_data']['signature'],
+                kwargs['request_payload'],
+                kwargs['request_data'].get('suite', RSA_SUITE),
+            )
+        except ValueError:
+            verified = False
+        if not verified:
             return 'Invalid request - signature does not match', 400
         return func(*args, **kwargs)
     return _validate_connection
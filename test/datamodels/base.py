@@ -1,68 +1,104 @@
+import operator
+
+from socialmedia.models import ResultPage
+
+# the operators DatastoreBase accepts as keyword suffixes (e.g. created__lte)
+FILTER_OPERATORS = {
+    'lt': operator.lt,
+    'lte': operator.le,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'ne': operator.ne,
+    'in': lambda value, values: value in values,
+}
+
 class BaseTestModel():
     _data = []
+    # attribute the datastore builds this kind's keys from - objects passed
+    # in as filters match on it, the way the datastore matches ancestor keys
+    key_attr = 'id'
 
     @classmethod
     def add_data(cls, data):
         cls._data.append(data)
 
+    def _same_entity(self, other):
+        if self == other:
+            return True
+        key = getattr(self, self.key_attr, None)
+        return type(self) == type(other) and key is not None and \
+            key == getattr(other, self.key_attr, None)
+
+    @classmethod
+    def _matches(cls, e, k, v):
+        name, _, op = k.partition('__')
+        if op in FILTER_OPERATORS:
+            return hasattr(e, name) and getattr(e, name) is not None and \
+                FILTER_OPERATORS[op](getattr(e, name), v)
+        if hasattr(e, k) and getattr(e,k) == v:
+            return True
+        if isinstance(v, BaseTestModel) and isinstance(getattr(e, k, None), BaseTestModel):
+            return v._same_entity(getattr(e, k))
+        if isinstance(v, BaseTestModel):
+            # check if child BaseTestModel objects have the expected value
+            obj_attrs = [attr for attr in dir(e) if not attr.startswith('_')]
+            for attr_name in obj_attrs:
+                if (
+                    isinstance(getattr(e, attr_name), BaseTestModel) and
+                    isinstance(getattr(getattr(e, attr_name), k, None), BaseTestModel) and
+                    v._same_entity(getattr(getattr(e, attr_name), k))
+                ):
+                    return True
+        return False
+
     @classmethod
     def get(cls, **kwargs):
         for e in cls._data:
             if type(e) != cls:
                 continue
-            # if no kwargs passed in and type matches, we're good
-            matched = len(kwargs.items()) == 0
-            for k, v in kwargs.items():
-                if hasattr(e, k) and getattr(e,k) == v:
-                    matched = True
-                elif isinstance(v, BaseTestModel):
-                    # check if child BaseTestModel objects have the expected value
-                    obj_attrs = [attr for attr in dir(e) if not attr.startswith('_')]
-                    for attr_name in obj_attrs:
-                        if (
-                            isinstance(getattr(e, attr_name), BaseTestModel) and
-                            hasattr(getattr(e, attr_name), k) and
-                            getattr(getattr(e, attr_name), k) == v
-                        ):
-                            matched = True
-                            continue
-                else:
-                    matched = False
-            if matched:
+            if all(cls._matches(e, k, v) for k, v in kwargs.items()):
                 return e
 
     @classmethod
     def list(cls, **kwargs):
+        limit = kwargs.pop('limit', None)
+        cursor = kwargs.pop('cursor', None)
+        kwargs.pop('order', None)
         response = []
         for e in cls._data:
             if type(e) != cls:
                 continue
-            if 'order' in kwargs:
-                del kwargs['order']
-            matched = len(kwargs.items()) == 0
-            for k, v in kwargs.items():
-                if hasattr(e, k) and getattr(e,k) == v:
-                    matched = True
-                elif isinstance(v, BaseTestModel):
-                    # check if child BaseTestModel objects have the expected value
-                    obj_attrs = [attr for attr in dir(e) if not attr.startswith('_')]
-                    for attr_name in obj_attrs:
-                        if (
-                            isinstance(getattr(e, attr_name), BaseTestModel) and
-                            hasattr(getattr(e, attr_name), k) and
-                            getattr(getattr(e, attr_name), k) == v
-                        ):
-                            matched = True
-                            continue
-                else:
-                    matched = False
-            if matched:
+            if all(cls._matches(e, k, v) for k, v in kwargs.items()):
                 response.append(e)
+        if limit:
+            # cursor is just the offset of the next page
+            start = int(cursor) if cursor else 0
+            end = start + limit
+            return ResultPage(response[start:end], str(end) if end < len(response) else None)
         return response
 
+    @classmethod
+    def count(cls, **kwargs):
+        return len(cls.list(**kwargs))
+
+    @classmethod
+    def repair_count(cls, **kwargs):
+        count = cls.count(**kwargs)
+        return count, count
+
     def save(self):
         self.__class__.add_data(self)
 
+    @classmethod
+    def save_many(cls, objs):
+        for obj in objs:
+            obj.save()
+
+    @classmethod
+    def delete_many(cls, objs):
+        for obj in objs:
+            obj.delete()
+
     def delete(self):
         delIdx = None
         for idx, e in enumerate(self.__class__._data):
@@ -3,4 +3,4 @@ from socialmedia.models import Profile as BaseProfile
 from .base import BaseTestModel
 
 class Profile(BaseProfile, BaseTestModel):
-    pass
+    key_attr = 'user_id'
@@ -0,0 +1,6 @@
+from socialmedia.models import TimelineEntry as BaseTimelineEntry
+
+from .base import BaseTestModel
+
+class TimelineEntry(BaseTimelineEntry, BaseTestModel):
+    pass
@@ -0,0 +1,7 @@
+import os
+
+# the datastore client is built when socialmedia.datastore is imported - the
+# emulator settings let it be built without credentials. Nothing talks to the
+# emulator, the tests replace the client with FakeDatastoreClient.
+os.environ.setdefault('DATASTORE_EMULATOR_HOST', 'localhost:8081')
+os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'test')
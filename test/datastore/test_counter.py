@@ -0,0 +1,138 @@
+from unittest import mock
+
+import pytest
+
+pytest.importorskip('google.cloud.datastore')
+
+from google.api_core.exceptions import Conflict
+
+from socialmedia.datastore import Post, Profile, counter
+
+from .utils import fake_client, profile_entity
+
+def _profile(client, user_id='user'):
+    entity = profile_entity(client, user_id, user_id)
+    client.entities[entity.key] = entity
+    return Profile.get(user_id=user_id)
+
+def _shards(client, parent_key, counted_kind='Post'):
+    return {
+        key.name: entity['count'] for key, entity in client.entities.items()
+        if key.kind == counter.KIND and key.parent == parent_key
+        and entity['counted_kind'] == counted_kind
+    }
+
+def _initialize(client, parent_key, count=0):
+    base = counter._shard_entity(counter._shard_key(parent_key, 'Post', 0), 'Post', count)
+    client.entities[base.key] = base
+
+def test_add_uninitialized(fake_client):
+    parent_key = fake_client.key('Profile', 'user')
+    counter.add(parent_key, 'Post', 1)
+    # left for the first read to initialize
+    assert _shards(fake_client, parent_key) == {}
+
+def test_add(fake_client):
+    parent_key = fake_client.key('Profile', 'user')
+    _initialize(fake_client, parent_key, 5)
+    with mock.patch.object(counter.random, 'randint', side_effect=[3, 3, 7]) as randint:
+        counter.add(parent_key, 'Post', 1)
+        counter.add(parent_key, 'Post', 2)
+        counter.add(parent_key, 'Post', -1)
+    # the base shard is never picked
+    randint.assert_called_with(1, counter.NUM_SHARDS - 1)
+    assert _shards(fake_client, parent_key) == {'Post-0': 5, 'Post-3': 3, 'Post-7': -1}
+    assert counter.read(parent_key, 'Post') == 7
+
+def test_read(fake_client):
+    parent_key = fake_client.key('Profile', 'user')
+    assert counter.read(parent_key, 'Post') is None
+    _initialize(fake_client, parent_key, 2)
+    assert counter.read(parent_key, 'Post') == 2
+    # other kinds and parents have their own counters
+    assert counter.read(parent_key, 'Comment') is None
+    assert counter.read(fake_client.key('Profile', 'other'), 'Post') is None
+
+def test_aggregate_count(fake_client):
+    profile = _profile(fake_client)
+    Post.save_many([Post(profile=profile) for _ in range(3)])
+    query = fake_client.query(kind='Post')
+    query.ancestor = profile.key
+    assert counter.aggregate_count(query) == 3
+    assert counter.aggregate_count(fake_client.query(kind='Comment')) == 0
+
+def test_reset(fake_client):
+    profile = _profile(fake_client)
+    Post.save_many([Post(profile=profile) for _ in range(3)])
+    query = fake_client.query(kind='Post')
+    query.ancestor = profile.key
+    assert counter.reset(profile.key, 'Post', query) == (None, 3)
+    assert _shards(fake_client, profile.key) == {'Post-0': 3}
+    # a counter that's right is left alone
+    puts = fake_client.calls['put']
+    assert counter.reset(profile.key, 'Post', query) == (3, 3)
+    assert fake_client.calls['put'] == puts
+    # a counter that's drifted is replaced by a base with the count
+    with mock.patch.object(counter.random, 'randint', return_value=2):
+        counter.add(profile.key, 'Post', 4)
+    assert counter.reset(profile.key, 'Post', query) == (7, 3)
+    assert _shards(fake_client, profile.key) == {'Post-0': 3}
+
+def test_run_in_transaction_conflict(fake_client):
+    func = mock.Mock(return_value='done')
+    fake_client.transaction_errors = [Conflict('conflict')]
+    assert counter.run_in_transaction(func) == 'done'
+    assert func.call_count == 2
+    fake_client.transaction_errors = [Conflict('conflict')] * counter.TRANSACTION_RETRIES
+    with pytest.raises(Conflict):
+        counter.run_in_transaction(func)
+    assert func.call_count == 2 + counter.TRANSACTION_RETRIES
+
+def test_counted_writes(fake_client):
+    profile = _profile(fake_client)
+    # the first count initializes the counter with an aggregation query
+    assert Post.count(profile=profile) == 0
+    assert fake_client.calls['aggregation_query'] == 1
+    post = Post(profile=profile)
+    post.save()
+    Post.save_many([Post(profile=profile) for _ in range(2)])
+    assert Post.count(profile=profile) == 3
+    # updates aren't counted again
+    post.text = 'changed'
+    post.save()
+    post.delete()
+    assert Post.count(profile=profile) == 2
+    assert fake_client.calls['aggregation_query'] == 1
+
+def test_counted_write_conflict(fake_client):
+    profile = _profile(fake_client)
+    Post.count(profile=profile)
+    fake_client.transaction_errors = [Conflict('conflict')] * counter.TRANSACTION_RETRIES
+    post = Post(profile=profile)
+    with pytest.raises(Conflict):
+        post.save()
+    # neither the post nor its count was written
+    assert Post.count(profile=profile) == 0
+    assert post.key not in fake_client.entities
+
+def test_count_aggregation(fake_client):
+    profile = _profile(fake_client)
+    Post.save_many([Post(profile=profile, text=text) for text in ('a', 'a', 'b')])
+    # anything but a count by parent is an aggregation query
+    assert Post.count(profile=profile, text='a') == 2
+    assert Post.count(text='b') == 1
+    assert fake_client.calls['aggregation_query'] == 2
+    assert _shards(fake_client, profile.key) == {}
+
+def test_repair_count(fake_client):
+    profile = _profile(fake_client)
+    Post.count(profile=profile)
+    Post.save_many([Post(profile=profile) for _ in range(2)])
+    # a post written without its count
+    stray = Post(profile=profile)
+    fake_client.put(stray._entity())
+    assert Post.count(profile=profile) == 2
+    assert Post.repair_count(profile=profile) == (2, 3)
+    assert Post.count(profile=profile) == 3
+    with pytest.raises(ValueError):
+        Post.repair_count(text='a')
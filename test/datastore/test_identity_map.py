@@ -0,0 +1,129 @@
+import pytest
+
+pytest.importorskip('google.cloud.datastore')
+
+from flask import Flask, g
+
+from socialmedia import request_stats
+from socialmedia.datastore import Post, Profile
+from socialmedia.datastore.identity_map import IdentityMap
+
+from .utils import fake_client, profile_entity
+
+@pytest.fixture
+def app():
+    return Flask(__name__)
+
+def _add_profile(client, user_id='user', handle='handle'):
+    entity = profile_entity(client, user_id, handle)
+    client.entities[entity.key] = entity
+    return entity
+
+def test_get_cached(app, fake_client):
+    _add_profile(fake_client)
+    with app.app_context():
+        profile = Profile.get(user_id='user')
+        assert Profile.get(user_id='user') is profile
+        assert fake_client.calls['query'] == 1
+        assert request_stats.get('identity_map_hits') == 1
+        assert request_stats.get('identity_map_misses') == 1
+        # nothing found is cached too
+        assert Profile.get(user_id='nobody') is None
+        assert Profile.get(user_id='nobody') is None
+        assert fake_client.calls['query'] == 2
+
+def test_list_cached(app, fake_client):
+    _add_profile(fake_client)
+    with app.app_context():
+        profile = Profile.get(user_id='user')
+        Post(profile=profile, text='first').save()
+        posts = Post.list(profile=profile)
+        queries = fake_client.calls['query']
+        cached = Post.list(profile=profile)
+        assert fake_client.calls['query'] == queries
+        assert cached == posts
+        assert cached[0] is posts[0]
+        # callers get their own list
+        cached.clear()
+        assert len(Post.list(profile=profile)) == 1
+
+def test_entities_built_once(app, fake_client):
+    _add_profile(fake_client)
+    with app.app_context():
+        profile = Profile.get(user_id='user')
+        Post(profile=profile, text='post').save()
+    fake_client.calls.clear()
+    with app.app_context():
+        posts = Post.list()
+        assert fake_client.calls['get_multi'] == 1
+        # the parent profile was loaded with the posts
+        assert Profile.get(user_id='user') is posts[0].profile
+        # a different query returns the objects already built
+        assert Post.list(text='post')[0] is posts[0]
+        assert fake_client.calls['get_multi'] == 1
+
+def test_save_invalidates_queries(app, fake_client):
+    _add_profile(fake_client)
+    with app.app_context():
+        profile = Profile.get(user_id='user')
+        assert Post.list(profile=profile) == []
+        post = Post(profile=profile, text='new post')
+        post.save()
+        assert Post.list(profile=profile) == [post]
+        post.text = 'changed'
+        post.save()
+        assert Post.list(text='changed') == [post]
+        Post.save_many([Post(profile=profile, text='another post')])
+        assert len(Post.list(profile=profile)) == 2
+
+def test_delete_invalidates_queries(app, fake_client):
+    _add_profile(fake_client)
+    with app.app_context():
+        profile = Profile.get(user_id='user')
+        posts = [Post(profile=profile, text=f'post {i}') for i in range(3)]
+        Post.save_many(posts)
+        assert len(Post.list(profile=profile)) == 3
+        posts[0].delete()
+        assert len(Post.list(profile=profile)) == 2
+        Post.delete_many(posts[1:])
+        assert Post.list(profile=profile) == []
+        assert IdentityMap.current().get_entity(posts[0].key) is None
+
+def test_not_shared_between_requests(app, fake_client):
+    _add_profile(fake_client)
+    with app.app_context():
+        profile = Profile.get(user_id='user')
+        # changed but not saved
+        profile.display_name = 'Changed'
+    with app.app_context():
+        other_profile = Profile.get(user_id='user')
+        assert other_profile is not profile
+        assert other_profile.display_name == 'handle'
+    assert fake_client.calls['query'] == 2
+    with app.test_request_context():
+        assert 'datastore_identity_map' not in g
+        assert Profile.get(user_id='user') is not profile
+
+def test_no_app_context(fake_client):
+    _add_profile(fake_client)
+    assert IdentityMap.current() is None
+    assert Profile.get(user_id='user') is not Profile.get(user_id='user')
+    assert fake_client.calls['query'] == 2
+
+def test_query_key():
+    assert IdentityMap.query_key('Post', 'list', {'id__in': ['a', 'b']}) == \
+        ('Post', 'list', (('id__in', ('a', 'b')),))
+    # keyword order doesn't matter
+    assert IdentityMap.query_key('Post', 'list', {'a': 1, 'b': 2}) == \
+        IdentityMap.query_key('Post', 'list', {'b': 2, 'a': 1})
+    assert IdentityMap.query_key('Post', 'get', {'a': 1}) != \
+        IdentityMap.query_key('Post', 'list', {'a': 1})
+    # values that can't be hashed can't be cached
+    assert IdentityMap.query_key('Post', 'list', {'since': {'a': 1}}) is None
+
+def test_uncacheable_query(app, fake_client):
+    _add_profile(fake_client)
+    with app.app_context():
+        Profile.list(user_id__in={'user': True})
+        Profile.list(user_id__in={'user': True})
+    assert fake_client.calls['query'] == 2
@@ -0,0 +1,151 @@
+import contextlib
+
+from collections import defaultdict
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from google.cloud import datastore
+
+from socialmedia.datastore import counter, mixins
+from socialmedia.datastore.dataclient import datastore_client
+
+OPERATORS = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    'IN': lambda a, b: a in b,
+}
+
+class FakeQuery():
+
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+        self.ancestor = None
+        self.order = []
+        self.filters = []
+
+    def add_filter(self, name, operator, value):
+        self.filters.append((name, operator, value))
+
+    def _matches(self, entity):
+        if entity.key.kind != self.kind:
+            return False
+        if self.ancestor is not None:
+            parent = entity.key.parent
+            while parent is not None and parent != self.ancestor:
+                parent = parent.parent
+            if parent is None:
+                return False
+        return all(
+            name in entity and OPERATORS[operator](entity[name], value)
+            for name, operator, value in self.filters
+        )
+
+    def results(self):
+        results = [entity for entity in self.client.entities.values() if self._matches(entity)]
+        orders = [self.order] if isinstance(self.order, str) else self.order
+        for order in reversed(orders):
+            results.sort(key=lambda entity: entity[order.lstrip('-')], reverse=order.startswith('-'))
+        return results
+
+    def fetch(self, limit=None):
+        self.client.calls['query'] += 1
+        results = self.results()
+        return iter(results[:limit] if limit else results)
+
+class FakeAggregationQuery():
+
+    def __init__(self, client, query):
+        self.client = client
+        self.query = query
+        self.alias = None
+
+    def count(self, alias=None):
+        self.alias = alias
+
+    def fetch(self):
+        self.client.calls['aggregation_query'] += 1
+        return iter([[SimpleNamespace(alias=self.alias, value=len(self.query.results()))]])
+
+class FakeDatastoreClient():
+    '''
+    Stands in for datastore.Client - entities are kept in a dict by key and
+    queries are run against it. Counts calls by method so tests can tell
+    what reached the datastore.
+    '''
+
+    def __init__(self):
+        self.entities = {}
+        self.calls = defaultdict(int)
+        self.in_transaction = False
+        # exceptions the next transactions raise when they commit
+        self.transaction_errors = []
+
+    def key(self, *path, **kwargs):
+        return datastore_client.key(*path, **kwargs)
+
+    def query(self, kind):
+        return FakeQuery(self, kind)
+
+    def aggregation_query(self, query):
+        return FakeAggregationQuery(self, query)
+
+    def put(self, entity):
+        self.calls['put'] += 1
+        self.entities[entity.key] = entity
+
+    def put_multi(self, entities):
+        self.calls['put_multi'] += 1
+        for entity in entities:
+            self.entities[entity.key] = entity
+
+    def delete(self, key):
+        self.calls['delete'] += 1
+        self.entities.pop(key, None)
+
+    def delete_multi(self, keys):
+        self.calls['delete_multi'] += 1
+        for key in keys:
+            self.entities.pop(key, None)
+
+    def get_multi(self, keys):
+        self.calls['get_multi'] += 1
+        return [self.entities[key] for key in keys if key in self.entities]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        ''' writes made in the transaction are dropped if it raises or conflicts '''
+        self.calls['transaction'] += 1
+        snapshot = dict(self.entities)
+        self.in_transaction = True
+        try:
+            yield
+            if self.transaction_errors:
+                raise self.transaction_errors.pop(0)
+        except Exception:
+            self.entities = snapshot
+            raise
+        finally:
+            self.in_transaction = False
+
+@pytest.fixture
+def fake_client():
+    client = FakeDatastoreClient()
+    with mock.patch.object(mixins, 'datastore_client', client), \
+            mock.patch.object(counter, 'datastore_client', client):
+        yield client
+
+def profile_entity(client, user_id, handle):
+    entity = datastore.Entity(key=client.key('Profile', user_id))
+    # keys given so none are generated
+    entity.update({
+        'user_id': user_id, 'handle': handle, 'display_name': handle,
+        'public_key': b'public key', 'private_key': b'private key',
+    })
+    return entity
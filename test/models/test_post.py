@@ -89,6 +89,7 @@ def test_as_json():
         'id': post.id,
         'text': post.text,
         'created': str(post.created),
+        'updated': str(post.created),
         'files': post.files,
         'comments': [comment.as_json() for comment in post.comments]
     }
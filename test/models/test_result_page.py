@@ -0,0 +1,11 @@
+from socialmedia.models import ResultPage
+
+def test_constructor():
+    page = ResultPage(['a', 'b'], 'next')
+    assert page == ['a', 'b']
+    assert page.next_cursor == 'next'
+
+def test_defaults():
+    page = ResultPage()
+    assert page == []
+    assert page.next_cursor is None
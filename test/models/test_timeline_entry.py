@@ -0,0 +1,82 @@
+from datetime import datetime
+
+from socialmedia.models import Profile, TimelineEntry
+
+def test_constructor():
+    profile = Profile(public_key='public_key')
+    timeline_entry = TimelineEntry(
+        profile=profile,
+        connection_id='connection_id',
+        post_id='post_id',
+    )
+    assert timeline_entry.profile == profile
+    assert timeline_entry.connection_id == 'connection_id'
+    assert timeline_entry.post_id == 'post_id'
+    assert type(timeline_entry.created) == datetime
+    assert timeline_entry.created.tzinfo
+
+def test_str():
+    timeline_entry = TimelineEntry(
+        profile=Profile(public_key='public_key'),
+        connection_id='connection_id',
+        post_id='post_id',
+    )
+    expected_str = f'profile: {{ {str(timeline_entry.profile)} }}, ' \
+        f'connection_id: connection_id, post_id: post_id, created: {timeline_entry.created}'
+    assert str(timeline_entry) == expected_str
+
+def test_repr():
+    timeline_entry = TimelineEntry(
+        profile=Profile(public_key='public_key'),
+        connection_id='connection_id',
+        post_id='post_id',
+    )
+    expected_repr = f'TimelineEntry(profile: {{ {repr(timeline_entry.profile)} }}, ' \
+        f'connection_id: connection_id, post_id: post_id, created: {timeline_entry.created})'
+    assert repr(timeline_entry) == expected_repr
+
+def test_eq():
+    profile = Profile(public_key='public_key')
+    timeline_entry_one = TimelineEntry(
+        profile=profile,
+        connection_id='connection_id',
+        post_id='post_id',
+    )
+    timeline_entry_two = TimelineEntry(
+        profile=profile,
+        connection_id='connection_id',
+        post_id='post_id',
+        created=datetime(2000, 1, 1, 0, 0),
+    )
+    # created is not part of the equality check
+    assert timeline_entry_one == timeline_entry_two
+
+def test_not_eq():
+    profile = Profile(public_key='public_key')
+    timeline_entry = TimelineEntry(
+        profile=profile,
+        connection_id='connection_id',
+        post_id='post_id',
+    )
+    assert timeline_entry != TimelineEntry(
+        profile=profile,
+        connection_id='connection_id',
+        post_id='other_post_id',
+    )
+    assert timeline_entry != TimelineEntry(
+        profile=profile,
+        connection_id='other_connection_id',
+        post_id='post_id',
+    )
+
+def test_as_json():
+    timeline_entry = TimelineEntry(
+        profile=Profile(public_key='public_key'),
+        connection_id='connection_id',
+        post_id='post_id',
+    )
+    assert timeline_entry.as_json() == {
+        'connection_id': 'connection_id',
+        'post_id': 'post_id',
+        'created': str(timeline_entry.created),
+    }
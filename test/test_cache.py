@@ -0,0 +1,49 @@
+from unittest import mock
+
+from socialmedia.cache import LRUCache
+
+def test_get_set():
+    cache = LRUCache(maxsize=2)
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.get('b', 'default') == 'default'
+    assert cache.stats() == {
+        'size': 1,
+        'maxsize': 2,
+        'hits': 1,
+        'misses': 2,
+        'hit_rate': 1 / 3,
+    }
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    # touching 'a' makes 'b' the oldest entry
+    cache.get('a')
+    cache.set('c', 3)
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+def test_expiry():
+    cache = LRUCache(maxsize=2, ttl=10)
+    with mock.patch('socialmedia.cache.time') as mock_time:
+        mock_time.time.return_value = 100
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=30)
+        mock_time.time.return_value = 115
+        assert cache.get('a') is None
+        assert cache.get('b') == 2
+        assert len(cache) == 1
+
+def test_pop_and_clear():
+    cache = LRUCache()
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.pop('a') == 1
+    assert cache.pop('a') is None
+    cache.clear()
+    assert len(cache) == 0
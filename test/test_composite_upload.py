@@ -0,0 +1,99 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from werkzeug import formparser
+from werkzeug.test import EnvironBuilder
+
+from socialmedia.composite_upload import (
+    composite_stream_factory,
+    LocalObjectStore,
+    ParallelCompositeUpload,
+)
+
+def _upload(store, data, write_size=7, **kwargs):
+    upload = ParallelCompositeUpload(store, 'file.bin', **kwargs)
+    for i in range(0, len(data), write_size):
+        upload.write(data[i:i + write_size])
+    upload.seek(0)
+    return upload
+
+def _read(store, name):
+    with open(store.path(name), 'rb') as f:
+        return f.read()
+
+def test_single_part(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    upload = _upload(store, b'small file', part_size=100)
+    assert upload.tell() == 10
+    assert _read(store, 'file.bin') == b'small file'
+    assert os.listdir(tmp_path) == ['file.bin']
+
+def test_parts_composed(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    data = os.urandom(1000)
+    _upload(store, data, part_size=64, parallelism=3)
+    assert _read(store, 'file.bin') == data
+    # parts are cleaned up
+    assert os.listdir(tmp_path) == ['file.bin']
+
+def test_compose_rounds(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    # 1100 parts needs more than one round of 32 part composes
+    data = os.urandom(1100 * 10)
+    _upload(store, data, write_size=1000, part_size=10)
+    assert _read(store, 'file.bin') == data
+    assert os.listdir(tmp_path) == ['file.bin']
+
+class _SlowStore(LocalObjectStore):
+    def __init__(self, root, fail_part=None):
+        super().__init__(root)
+        self.uploading = 0
+        self.max_uploading = 0
+        self.fail_part = fail_part
+        self._lock = threading.Lock()
+
+    def upload(self, name, data, content_type=None):
+        with self._lock:
+            self.uploading += 1
+            self.max_uploading = max(self.max_uploading, self.uploading)
+        time.sleep(0.01)
+        with self._lock:
+            self.uploading -= 1
+        if self.fail_part and name.endswith(self.fail_part):
+            raise IOError(f'failed to upload {name}')
+        super().upload(name, data, content_type)
+
+def test_parallelism(tmp_path):
+    store = _SlowStore(str(tmp_path))
+    data = os.urandom(2000)
+    _upload(store, data, write_size=500, part_size=50, parallelism=4)
+    assert _read(store, 'file.bin') == data
+    assert 1 < store.max_uploading <= 4
+
+def test_failed_part(tmp_path):
+    store = _SlowStore(str(tmp_path), fail_part='part-00003')
+    with pytest.raises(IOError):
+        _upload(store, os.urandom(1000), part_size=50)
+    assert os.listdir(tmp_path) == []
+
+def test_stream_factory(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    data = os.urandom(5000)
+    environ = EnvironBuilder(
+        method='POST',
+        data={
+            'text': 'Post Text',
+            'file': (io.BytesIO(data), '../my file.bin'),
+        },
+    ).get_environ()
+    _, form, files = formparser.parse_form_data(
+        environ, stream_factory=composite_stream_factory(store, part_size=1024)
+    )
+    assert form['text'] == 'Post Text'
+    assert files['file'].filename == '../my file.bin'
+    assert _read(store, 'my_file.bin') == data
+    assert os.listdir(tmp_path) == ['my_file.bin']
@@ -0,0 +1,43 @@
+import os
+import zlib
+
+import pytest
+
+from socialmedia import compression
+
+def test_zlib():
+    data = b'{"text": "hello"}' * 100
+    compressed = compression.compress('zlib', data)
+    assert len(compressed) < len(data)
+    assert compression.decompress('zlib', compressed) == data
+
+def test_zstd():
+    if 'zstd' not in compression.available():
+        pytest.skip('zstandard not installed')
+    data = b'{"text": "hello"}' * 100
+    compressed = compression.compress('zstd', data)
+    assert len(compressed) < len(data)
+    assert compression.decompress('zstd', compressed) == data
+    with pytest.raises(ValueError):
+        compression.decompress('zstd', compressed, max_size=len(data) - 1)
+
+def test_available():
+    assert compression.available()[-1] == 'zlib'
+
+def test_decompress_limit():
+    data = bytes(1024)
+    compressed = compression.compress('zlib', data)
+    assert compression.decompress('zlib', compressed, max_size=1024) == data
+    with pytest.raises(ValueError):
+        compression.decompress('zlib', compressed, max_size=1023)
+
+def test_decompress_invalid():
+    with pytest.raises(ValueError):
+        compression.decompress('zlib', os.urandom(64))
+    # truncated
+    with pytest.raises(ValueError):
+        compression.decompress('zlib', zlib.compress(os.urandom(1024))[:-10])
+    with pytest.raises(ValueError):
+        compression.decompress('brotli', b'data')
+    with pytest.raises(ValueError):
+        compression.compress('brotli', b'data')
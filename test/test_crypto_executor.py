@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+
+from socialmedia.crypto_executor import CryptoExecutor
+
+def _fail():
+    raise ValueError('bad signature')
+
+def test_inline():
+    executor = CryptoExecutor()
+    assert executor.run(pow, 2, 10) == 1024
+    with pytest.raises(ValueError):
+        executor.run(_fail)
+    stats = executor.stats()
+    assert stats['kind'] == 'inline'
+    assert stats['calls'] == 2
+    assert stats['errors'] == 1
+    assert stats['queue_depth'] == 0
+    assert stats['running'] == 0
+    assert executor._executor is None
+
+def test_thread_queue_depth():
+    executor = CryptoExecutor(kind='thread', workers=1)
+    release = threading.Event()
+    running = threading.Event()
+    def blocked():
+        running.set()
+        release.wait()
+        return 'done'
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(executor.run(blocked)))
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    running.wait()
+    while executor.in_flight < 3:
+        time.sleep(0.001)
+    stats = executor.stats()
+    # one call runs on the only worker, the others wait for it
+    assert stats['running'] == 1
+    assert stats['queue_depth'] == 2
+    release.set()
+    for thread in threads:
+        thread.join()
+    executor.shutdown()
+    assert results == ['done'] * 3
+    stats = executor.stats()
+    assert stats['calls'] == 3
+    assert stats['queue_depth'] == 0
+    assert stats['max_wait_seconds'] > 0
+
+def test_process():
+    executor = CryptoExecutor(kind='process', workers=1)
+    try:
+        assert executor.run(pow, 2, 10) == 1024
+        with pytest.raises(ValueError):
+            executor.run(_fail)
+    finally:
+        executor.shutdown()
+    assert executor.stats()['calls'] == 2
+    assert executor.stats()['errors'] == 1
+
+def test_invalid_kind():
+    with pytest.raises(ValueError):
+        CryptoExecutor(kind='gpu')
@@ -0,0 +1,139 @@
+from unittest import mock
+
+import pytest
+
+pytest.importorskip('google.cloud.storage')
+
+from google.resumable_media import common
+
+from socialmedia.composite_upload import ParallelCompositeUpload
+from socialmedia.gcloud import gcs_object_stream_upload
+from socialmedia.gcloud.gcs_object_stream_upload import GCSObjectStore, GCSObjectStreamUpload
+
+class RecordingUpload():
+    '''
+    reads chunks from the stream like ResumableUpload and keeps them. The
+    first failures transmits raise InvalidResponse instead
+    '''
+
+    def __init__(self, stream, chunk_size, failures=0):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.failures = failures
+        self.recovered = 0
+
+    def transmit_next_chunk(self, transport):
+        if self.failures:
+            self.failures -= 1
+            raise common.InvalidResponse(mock.Mock(), 'failed')
+        self.chunks.append(self.stream.read(self.chunk_size))
+
+    def recover(self, transport):
+        self.recovered += 1
+
+def _upload(chunk_size, failures=0):
+    with mock.patch.object(gcs_object_stream_upload, 'AuthorizedSession'):
+        upload = GCSObjectStreamUpload(
+            client=mock.Mock(),
+            bucket_name='bucket',
+            blob_name='blob',
+            content_type='image/png',
+            chunk_size=chunk_size,
+        )
+    upload._request = RecordingUpload(upload, chunk_size, failures)
+    return upload
+
+def test_write_several_chunks():
+    upload = _upload(chunk_size=10)
+    data = bytes(range(40))
+    assert upload.write(data[:25]) == 25
+    # every full chunk is sent as soon as it's there
+    assert upload._request.chunks == [data[:10], data[10:20]]
+    assert upload.tell() == 20
+    upload.write(data[25:32])
+    assert upload._request.chunks[-1] == data[20:30]
+    upload.write(data[32:])
+    # flask seeks back to the start once the file's been written
+    upload.seek(0)
+    assert upload._request.chunks == [
+        data[:10], data[10:20], data[20:30], data[30:40], b'',
+    ]
+    assert upload.tell() == 40
+
+def test_write_partial_last_chunk():
+    upload = _upload(chunk_size=10)
+    upload.write(b'a' * 12)
+    upload.seek(0)
+    assert upload._request.chunks == [b'a' * 10, b'a' * 2]
+    assert upload.tell() == 12
+
+def test_write_recovers():
+    upload = _upload(chunk_size=10, failures=1)
+    upload.write(b'a' * 10)
+    assert upload._request.recovered == 1
+    assert upload._request.chunks == [b'a' * 10]
+
+def test_read_after_compaction():
+    # a chunk size nothing reaches, so reads are only made here
+    upload = _upload(chunk_size=1000)
+    data = bytes(range(100))
+    upload.write(data)
+    assert upload.read(30) == data[:30]
+    # less than half the buffer has been read, so it's left in place
+    assert upload._buffer_offset == 30
+    assert len(upload._buffer) == 100
+    assert upload.read(30) == data[30:60]
+    # past half, the data read is dropped from the front
+    assert upload._buffer_offset == 0
+    assert upload._buffer == data[60:]
+    upload.write(data)
+    assert upload.read(50) == data[60:] + data[:10]
+    assert upload.read(1000) == data[10:]
+    assert upload.read(10) == b''
+    assert upload.tell() == 200
+    assert len(upload._buffer) == 0
+
+def test_read_returns_bytes():
+    upload = _upload(chunk_size=1000)
+    upload.write(memoryview(b'abc'))
+    # requests sends anything but bytes as an iterable stream
+    assert type(upload.read(2)) is bytes
+
+@pytest.fixture
+def storage_client():
+    with mock.patch.object(gcs_object_stream_upload.storage, 'Client') as client, \
+            mock.patch.object(gcs_object_stream_upload, 'AuthorizedSession'), \
+            mock.patch.object(GCSObjectStreamUpload, 'start') as start:
+        client.return_value.project = 'project'
+        client.start = start
+        yield client
+
+def test_stream_factory_composite(storage_client):
+    with mock.patch.object(gcs_object_stream_upload, 'COMPOSITE_UPLOAD_THRESHOLD', 100):
+        stream = gcs_object_stream_upload.gcs_stream_factory(
+            100, '../big file.png', 'image/png'
+        )
+    assert isinstance(stream, ParallelCompositeUpload)
+    assert isinstance(stream._store, GCSObjectStore)
+    assert stream.filename == 'big_file.png'
+    storage_client.return_value.bucket.assert_called_with('project.appspot.com')
+    assert storage_client.start.call_count == 0
+
+def test_stream_factory_under_threshold(storage_client):
+    with mock.patch.object(gcs_object_stream_upload, 'COMPOSITE_UPLOAD_THRESHOLD', 100):
+        stream = gcs_object_stream_upload.gcs_stream_factory(99, 'file.png', 'image/png')
+    assert isinstance(stream, GCSObjectStreamUpload)
+    assert stream.filename == 'file.png'
+    assert storage_client.start.call_count == 1
+
+def test_stream_factory_composite_off(storage_client):
+    with mock.patch.object(gcs_object_stream_upload, 'COMPOSITE_UPLOAD_THRESHOLD', 0):
+        stream = gcs_object_stream_upload.gcs_stream_factory(
+            10 * 1024 * 1024 * 1024, 'file.png', 'image/png'
+        )
+    assert isinstance(stream, GCSObjectStreamUpload)
+    # werkzeug doesn't always know the request's length
+    with mock.patch.object(gcs_object_stream_upload, 'COMPOSITE_UPLOAD_THRESHOLD', 100):
+        stream = gcs_object_stream_upload.gcs_stream_factory(None, 'file.png', 'image/png')
+    assert isinstance(stream, GCSObjectStreamUpload)
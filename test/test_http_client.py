@@ -0,0 +1,60 @@
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import pytest
+import requests
+
+from socialmedia.http_client import HttpClient
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive needs HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+def test_reuses_connections(server):
+    client = HttpClient()
+    for _ in range(3):
+        response = client.post(f'http://{server}/test', json={'a': 1})
+        assert response.status_code == 200
+        assert response.content == b'ok'
+    stats = client.stats()[server]
+    assert stats['requests'] == 3
+    assert stats['errors'] == 0
+    assert stats['connections_opened'] == 1
+
+def test_default_timeout():
+    client = HttpClient(timeout=3)
+    with mock.patch.object(client.session, 'request') as request:
+        client.post('https://other_host.com/api', json={})
+        assert request.call_args[1]['timeout'] == 3
+        client.post('https://other_host.com/api', json={}, timeout=1)
+        assert request.call_args[1]['timeout'] == 1
+
+def test_connection_errors():
+    client = HttpClient(retries=1, backoff_factor=0)
+    with pytest.raises(requests.ConnectionError):
+        # nothing listens on port 9
+        client.post('http://127.0.0.1:9/api', json={})
+    stats = client.stats()['127.0.0.1:9']
+    assert stats['requests'] == 1
+    assert stats['errors'] == 1
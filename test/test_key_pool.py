@@ -0,0 +1,84 @@
+import itertools
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from socialmedia.key_pool import KeyPool
+
+def _key_generator():
+    counter = itertools.count()
+    def generate():
+        n = next(counter)
+        return f'public {n}'.encode(), f'private {n}'.encode()
+    return generate
+
+def _wait_for_refills(pool):
+    for _ in range(100):
+        if not pool.stats()['pending']:
+            return
+        time.sleep(0.01)
+    raise AssertionError('pool not refilled')
+
+def test_take_from_pool():
+    executor = ThreadPoolExecutor(max_workers=1)
+    pool = KeyPool(size=2, generate=_key_generator(), executor=executor)
+    pool.start()
+    _wait_for_refills(pool)
+    assert pool.stats()['depth'] == 2
+    assert pool.stats()['refills'] == 2
+    assert pool.stats()['avg_refill_seconds'] is not None
+    assert pool.take() == (b'public 0', b'private 0')
+    stats = pool.stats()
+    assert stats['depth'] == 1
+    assert stats['taken'] == 1
+    assert stats['generated_sync'] == 0
+
+def test_take_refills():
+    executor = ThreadPoolExecutor(max_workers=1)
+    pool = KeyPool(size=2, generate=_key_generator(), executor=executor)
+    pool.start()
+    _wait_for_refills(pool)
+    pool.take()
+    pool.take()
+    _wait_for_refills(pool)
+    # each take tops the pool back up
+    assert pool.stats()['depth'] == 2
+    assert pool.stats()['refills'] == 4
+
+def test_take_empty_pool_generates():
+    release = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+    # keeps the worker busy so nothing reaches the pool
+    executor.submit(release.wait)
+    generate = mock.Mock(return_value=(b'public', b'private'))
+    pool = KeyPool(size=1, generate=generate, executor=executor)
+    assert pool.take() == (b'public', b'private')
+    stats = pool.stats()
+    assert stats['generated_sync'] == 1
+    assert stats['depth'] == 0
+    assert stats['pending'] == 1
+    release.set()
+    executor.shutdown(wait=True)
+    assert pool.stats()['depth'] == 1
+    assert generate.call_count == 2
+
+def test_refill_failure():
+    executor = ThreadPoolExecutor(max_workers=1)
+    generate = mock.Mock(side_effect=ValueError('no entropy'))
+    pool = KeyPool(size=1, generate=generate, executor=executor)
+    pool.start()
+    executor.shutdown(wait=True)
+    stats = pool.stats()
+    assert stats['depth'] == 0
+    assert stats['pending'] == 0
+    assert stats['refill_errors'] == 1
+
+def test_disabled_pool():
+    generate = mock.Mock(return_value=(b'public', b'private'))
+    pool = KeyPool(size=0, generate=generate)
+    pool.start()
+    assert pool.take() == (b'public', b'private')
+    assert pool._executor is None
+    assert pool.stats()['generated_sync'] == 1
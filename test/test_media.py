@@ -0,0 +1,84 @@
+import io
+
+from unittest import mock
+
+from PIL import Image
+
+from socialmedia import media
+from socialmedia.composite_upload import LocalObjectStore
+
+def _jpeg(width, height, orientation=None):
+    image = Image.new('RGB', (width, height), 'red')
+    exif = Image.Exif()
+    exif[0x010f] = 'Test Camera' # make
+    if orientation:
+        exif[0x0112] = orientation
+    out = io.BytesIO()
+    image.save(out, format='JPEG', exif=exif, comment=b'a comment')
+    return out.getvalue()
+
+def test_process_image(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    store.upload('photo.jpg', _jpeg(1000, 500))
+    variants = media.process_image(store, 'photo.jpg', [320, 640, 1280])
+    # no variant wider than the original
+    assert variants == {'320': 'photo_320w.jpg', '640': 'photo_640w.jpg'}
+    original = Image.open(io.BytesIO(store.read('photo.jpg')))
+    assert original.size == (1000, 500)
+    assert not original.getexif()
+    assert 'comment' not in original.info
+    for width, name in variants.items():
+        variant = Image.open(io.BytesIO(store.read(name)))
+        assert variant.size == (int(width), int(width) // 2)
+        assert not variant.getexif()
+
+def test_process_image_orientation(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    # rotated 90 degrees
+    store.upload('photo.jpg', _jpeg(1000, 500, orientation=6))
+    variants = media.process_image(store, 'photo.jpg', [320])
+    original = Image.open(io.BytesIO(store.read('photo.jpg')))
+    assert original.size == (500, 1000)
+    variant = Image.open(io.BytesIO(store.read(variants['320'])))
+    assert variant.size == (320, 640)
+
+def test_process_image_png(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    out = io.BytesIO()
+    Image.new('RGBA', (800, 800)).save(out, format='PNG')
+    store.upload('image.png', out.getvalue())
+    assert media.process_image(store, 'image.png', [320]) == {'320': 'image_320w.png'}
+    assert Image.open(io.BytesIO(store.read('image_320w.png'))).format == 'PNG'
+
+def test_process_image_not_an_image(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    store.upload('file.txt', b'not an image')
+    assert media.process_image(store, 'file.txt', [320]) is None
+    assert store.read('file.txt') == b'not an image'
+
+def test_process_image_decompression_bomb(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    out = io.BytesIO()
+    Image.new('L', (200, 200)).save(out, format='PNG')
+    store.upload('bomb.png', out.getvalue())
+    # more than twice the pixel limit, which Pillow refuses to open
+    with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 10000):
+        assert media.process_image(store, 'bomb.png', [100]) is None
+    assert store.read('bomb.png') == out.getvalue()
+
+def test_process_image_truncated(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    store.upload('photo.jpg', _jpeg(1000, 500)[:1000])
+    assert media.process_image(store, 'photo.jpg', [320]) is None
+
+def test_select_file():
+    variants = {'photo.jpg': {'320': 'photo_320w.jpg', '640': 'photo_640w.jpg'}}
+    assert media.select_file('photo.jpg', variants, None) == 'photo.jpg'
+    assert media.select_file('photo.jpg', variants, 200) == 'photo_320w.jpg'
+    assert media.select_file('photo.jpg', variants, 320) == 'photo_320w.jpg'
+    assert media.select_file('photo.jpg', variants, 500) == 'photo_640w.jpg'
+    assert media.select_file('photo.jpg', variants, 1000) == 'photo.jpg'
+    assert media.select_file('other.jpg', variants, 200) == 'other.jpg'
+    assert media.select_files(['photo.jpg', 'file.txt'], variants, 200) == [
+        'photo_320w.jpg', 'file.txt'
+    ]
@@ -0,0 +1,42 @@
+from unittest.mock import Mock
+
+from flask import Flask
+
+from socialmedia import create_app, request_stats
+from socialmedia.key_pool import KeyPool
+
+def test_increment():
+    app = Flask(__name__)
+    with app.app_context():
+        request_stats.increment('datastore_round_trips')
+        request_stats.increment('datastore_round_trips', 2)
+        request_stats.increment('other')
+        assert request_stats.get('datastore_round_trips') == 3
+        assert request_stats.get_all() == {'datastore_round_trips': 3, 'other': 1}
+    # each app context starts from zero
+    with app.app_context():
+        assert request_stats.get('datastore_round_trips') == 0
+        assert request_stats.get_all() == {}
+
+def test_no_app_context():
+    request_stats.increment('datastore_round_trips')
+    assert request_stats.get('datastore_round_trips') == 0
+    assert request_stats.get_all() == {}
+
+def test_request_stats_log(capsys):
+    app = create_app(
+        None, None, None, Mock(), None, None, None, key_pool=KeyPool(size=0),
+    )
+
+    @app.route('/counted')
+    def counted():
+        request_stats.increment('datastore_round_trips', 2)
+        return ''
+
+    with app.test_client() as client:
+        client.get('/counted')
+        assert '[request_stats]' not in capsys.readouterr().out
+        app.config['REQUEST_STATS_LOG'] = True
+        client.get('/counted')
+        assert "[request_stats] GET /counted: {'datastore_round_trips': 2}" in \
+            capsys.readouterr().out
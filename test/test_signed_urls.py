@@ -0,0 +1,124 @@
+import threading
+
+from unittest import mock
+
+import pytest
+
+pytest.importorskip('google.cloud.secretmanager')
+pytest.importorskip('google.cloud.tasks_v2')
+
+from socialmedia.gcloud import utils
+
+@pytest.fixture
+def signer():
+    ''' signs urls as signed-<file>-<number of times file has been signed> '''
+    signed = []
+    lock = threading.Lock()
+    def generate_signed_url(file, **kwargs):
+        with lock:
+            signed.append(file)
+            return f'signed-{file}-{signed.count(file)}'
+    bucket = mock.Mock()
+    bucket.blob.side_effect = lambda file: mock.Mock(
+        generate_signed_url=lambda **kwargs: generate_signed_url(file, **kwargs)
+    )
+    credentials = mock.Mock(service_account_email='app@example.com', token='token')
+    utils.signed_url_cache.clear()
+    with mock.patch.object(
+        utils, '_signing_context', return_value=(credentials, bucket)
+    ) as signing_context:
+        signing_context.signed = signed
+        yield signing_context
+    utils.signed_url_cache.clear()
+
+def test_cache_hit(signer):
+    urls = utils.generate_signed_urls(['a.png', 'b.png', 'a.png'])
+    # each file is only signed once
+    assert urls == ['signed-a.png-1', 'signed-b.png-1', 'signed-a.png-1']
+    assert sorted(signer.signed) == ['a.png', 'b.png']
+    signer.reset_mock()
+    assert utils.generate_signed_urls(['b.png', 'a.png']) == ['signed-b.png-1', 'signed-a.png-1']
+    # nothing left to sign, so no credentials are needed
+    assert signer.call_count == 0
+    assert len(signer.signed) == 2
+    # urls with another expiration are cached separately
+    assert utils.generate_signed_urls(['a.png'], expiration=60) == ['signed-a.png-2']
+
+def test_resigned_before_expiry(signer):
+    with mock.patch('socialmedia.cache.time.time', return_value=1000):
+        url = utils.generate_signed_urls(['a.png'], expiration=3000)[0]
+    # handed out until SIGNED_URL_MARGIN seconds before it expires
+    resign_at = 1000 + 3000 - utils.SIGNED_URL_MARGIN
+    with mock.patch('socialmedia.cache.time.time', return_value=resign_at - 1):
+        assert utils.generate_signed_urls(['a.png'], expiration=3000) == [url]
+    with mock.patch('socialmedia.cache.time.time', return_value=resign_at):
+        assert utils.generate_signed_urls(['a.png'], expiration=3000) == ['signed-a.png-2']
+
+def test_resigned_short_lived(signer):
+    # urls that expire sooner than twice the margin are cached for half their life
+    with mock.patch('socialmedia.cache.time.time', return_value=1000):
+        url = utils.generate_signed_urls(['a.png'], expiration=60)[0]
+    with mock.patch('socialmedia.cache.time.time', return_value=1029):
+        assert utils.generate_signed_urls(['a.png'], expiration=60) == [url]
+    with mock.patch('socialmedia.cache.time.time', return_value=1030):
+        assert utils.generate_signed_urls(['a.png'], expiration=60) == ['signed-a.png-2']
+
+def test_signed_concurrently(signer):
+    files = [f'{i}.png' for i in range(6)]
+    lock = threading.Lock()
+    running = {'now': 0, 'most': 0}
+    # every signing thread has to be running at once to get past the barrier
+    barrier = threading.Barrier(3, timeout=5)
+    bucket = signer.return_value[1]
+    def generate_signed_url(file):
+        with lock:
+            running['now'] += 1
+            running['most'] = max(running['most'], running['now'])
+        barrier.wait()
+        with lock:
+            running['now'] -= 1
+        return f'signed-{file}'
+    bucket.blob.side_effect = lambda file: mock.Mock(
+        generate_signed_url=lambda **kwargs: generate_signed_url(file)
+    )
+    with mock.patch.object(utils, 'SIGNING_CONCURRENCY', 3):
+        urls = utils.generate_signed_urls(files)
+    # in the order asked for, whatever order they were signed in
+    assert urls == [f'signed-{file}' for file in files]
+    assert running['most'] == 3
+
+def test_signing_error(signer):
+    bucket = signer.return_value[1]
+    bucket.blob.side_effect = lambda file: mock.Mock(
+        generate_signed_url=mock.Mock(side_effect=RuntimeError('signing failed'))
+    )
+    with pytest.raises(RuntimeError):
+        utils.generate_signed_urls(['a.png', 'b.png'])
+    # nothing is cached for a failed batch
+    assert len(utils.signed_url_cache) == 0
+
+def test_expiration_too_long(signer):
+    with pytest.raises(Exception):
+        utils.generate_signed_urls(['a.png'], expiration=604801)
+    assert signer.call_count == 0
+
+def test_signing_context():
+    credentials = mock.Mock(valid=True)
+    with mock.patch.object(utils, '_signing', {}), \
+            mock.patch.object(utils, 'auth_default', return_value=(credentials, 'project')) \
+                as auth_default, \
+            mock.patch.object(utils.storage, 'Client') as storage_client:
+        storage_client.return_value.project = 'project'
+        assert utils._signing_context() == (
+            credentials, storage_client.return_value.bucket.return_value
+        )
+        storage_client.return_value.bucket.assert_called_once_with('project.appspot.com')
+        utils._signing_context()
+        # set up once per process
+        assert auth_default.call_count == 1
+        assert storage_client.call_count == 1
+        assert credentials.refresh.call_count == 0
+        # expired access tokens are refreshed
+        credentials.valid = False
+        utils._signing_context()
+        assert credentials.refresh.call_count == 1
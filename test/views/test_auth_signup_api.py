@@ -137,3 +137,19 @@ def test_signup_post_missing_form_values(client):
     assert result.status_code == 400
     assert result.data == b'Missing required values email, password, name, handle'
     assert session.get('user') is None
+
+def test_signup_uses_key_pool(client):
+    ''' Tests the new profile's keys come from the app's key pool. '''
+    with mock.patch.object(client.application, 'key_pool') as key_pool:
+        key_pool.take.return_value = (b'pooled public key', b'pooled private key')
+        result = client.post('/signup-api', data={
+            'email': 'admin@example.com',
+            'password': 'reallyStrongPassword',
+            'name': 'Admin User',
+            'handle': 'admin_user',
+        })
+    assert result.status_code == 200
+    key_pool.take.assert_called_once()
+    profile = datamodels.Profile._data[1]
+    assert profile.public_key == b'pooled public key'
+    assert profile.private_key == b'pooled private key'
@@ -1,5 +1,6 @@
 import base64
 import json
+import time
 
 from collections import namedtuple
 from datetime import datetime, timedelta
@@ -9,7 +10,14 @@ from unittest import mock
 from uuid import UUID
 
 from socialmedia import connection_status
-from socialmedia.views.utils import enc_and_sign_payload, decrypt_payload
+from socialmedia.views.utils import (
+    EC_SUITE,
+    decrypt_payload,
+    ec_enc_and_sign_payload,
+    enc_and_sign_payload,
+    open_envelope,
+    secure_envelope,
+)
 from test import datamodels
 from .utils import client
 
@@ -57,6 +65,31 @@ def test_request_connection(client):
     assert UUID(connectee_connection.id, version=4) is not None
     assert connectee_connection.profile == requested_profile
 
+def test_request_connection_ec_key(client):
+    requested_profile = datamodels.Profile(
+        display_name='Other User',
+        handle='other_user',
+        user_id=datamodels.User.generate_uuid(),
+    )
+    requested_profile.save()
+    ec_public_key, _ = datamodels.Profile.generate_ec_keys()
+    request_payload = {
+      'requestor_host': 'localhost',
+      'requestor_handle': 'requestor_handle',
+      'requestor_display_name': 'Requestor User',
+      'requestor_public_key': 'public key',
+      'requestor_ec_public_key': ec_public_key,
+    }
+    response = client.post(url_for('external_comms.request_connection'), json={
+        'enc_payload': base64.b64encode(
+            json.dumps(request_payload).encode()
+        ).decode(),
+        'handle': requested_profile.handle
+    })
+    assert response.status_code == 200
+    connectee_connection = datamodels.Connection.get(handle='requestor_handle')
+    assert connectee_connection.ec_public_key == ec_public_key
+
 def test_request_connection_invalid_payload(client):
     requestor_user = datamodels.User(
         email='requestor@example.com',
@@ -406,7 +439,7 @@ def test_retrieve_posts(client):
         requestor_profile, requestor_connection, request_payload
     )
     # send request to connection's host
-    with mock.patch('socialmedia.views.utils.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         def side_effect(*args, **kwargs):
             json_payload = kwargs['json']
             if json_payload['handle'] == requestor_profile.handle:
@@ -592,7 +625,7 @@ def test_retrieve_posts_failed_comment_retrieval(client):
         requestor_profile, requestor_connection, request_payload
     )
     # send request to connection's host
-    with mock.patch('socialmedia.views.utils.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         def side_effect(*args, **kwargs):
             json_payload = kwargs['json']
             if json_payload['handle'] == requestor_profile.handle:
@@ -651,6 +684,359 @@ def test_retrieve_posts_failed_comment_retrieval(client):
         assert third_person_comment['files'] == []
 
 
+def test_retrieve_posts_comment_retrieval_timeout(client):
+    # a commentor host that doesn't answer in time gets the error placeholder
+    # without holding up the comments from other hosts
+    client.application.config['FAN_OUT_TIMEOUT'] = 1
+    requestor_user = datamodels.User(
+        email='requestor@example.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    requestor_profile = datamodels.Profile(
+        display_name='Requestor User',
+        handle='requestor_handle',
+        user_id=requestor_user.id,
+    )
+    requested_user = datamodels.User(
+        email='requestee@testhost.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    requested_user.save()
+    requested_profile = datamodels.Profile(
+        display_name='Requestee',
+        handle='requestee',
+        user_id=requested_user.id,
+    )
+    requested_profile.save()
+    third_profile = datamodels.Profile(
+        display_name='Third Connection',
+        handle='third_connection',
+        user_id=datamodels.User(
+            email='a@b.c', id=datamodels.User.generate_uuid()
+        ).id
+    )
+    requestor_connection = datamodels.Connection(
+        profile=requestor_profile,
+        host='https://other_host.com',
+        handle=requested_profile.handle,
+        display_name=requested_profile.display_name,
+        public_key=requested_profile.public_key,
+        status=connection_status.CONNECTED,
+    )
+    requested_connection = datamodels.Connection(
+        handle=requestor_profile.handle,
+        host='localhost',
+        display_name=requestor_profile.handle,
+        public_key=requestor_profile.public_key,
+        status=connection_status.CONNECTED,
+        profile=requested_profile,
+    )
+    requested_connection.save()
+    third_connection = datamodels.Connection(
+        handle=third_profile.handle,
+        host='localhost',
+        display_name=third_profile.display_name,
+        public_key=third_profile.public_key,
+        status=connection_status.CONNECTED,
+        profile=requested_profile,
+    )
+    third_connection.save()
+    post_one = datamodels.Post(
+        profile=requested_profile,
+        text='This is a post',
+    )
+    post_one.save()
+    datamodels.CommentReference(
+        connection=requested_connection,
+        post_id=post_one.id,
+    ).save()
+    datamodels.CommentReference(
+        connection=third_connection,
+        post_id=post_one.id,
+    ).save()
+
+    request_payload = {
+        'host': requested_connection.host,
+        'handle': requested_connection.handle
+    }
+    enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
+        requestor_profile, requestor_connection, request_payload
+    )
+    with mock.patch.object(client.application, 'http_client') as req:
+        def side_effect(*args, **kwargs):
+            json_payload = kwargs['json']
+            if json_payload['handle'] == third_connection.handle:
+                time.sleep(3)
+            comment = datamodels.Comment(
+                profile=requestor_profile,
+                post_id=post_one.id,
+                text='This is a comment from requestor',
+            )
+            enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
+                requestor_profile, requested_profile, [comment.as_json()]
+            )
+            return MockResponse(200, json.dumps({
+                'enc_payload': enc_payload,
+                'enc_key': enc_key,
+                'signature': signature,
+                'nonce': nonce,
+                'tag': tag
+            }), None)
+        req.post.side_effect = side_effect
+        response = client.post(
+            url_for("external_comms.retrieve_posts"),
+            json={
+                'enc_payload': enc_payload,
+                'enc_key': enc_key,
+                'signature': signature,
+                'nonce': nonce,
+                'tag': tag,
+                'handle': requestor_connection.handle,
+            }
+        )
+    assert response.status_code == 200
+    request_payload = decrypt_payload(
+        requestor_profile,
+        response.json['enc_key'],
+        response.json['enc_payload'],
+        response.json['nonce'],
+        response.json['tag'],
+    )
+    comments = {
+        comment['profile']['handle']: comment
+        for comment in request_payload[0]['comments']
+    }
+    assert comments[requestor_profile.handle]['text'] == 'This is a comment from requestor'
+    assert comments[third_profile.handle]['text'] == 'error retrieving comments'
+
+def test_retrieve_posts_paged(client):
+    requestor_user = datamodels.User(
+        email='requestor@example.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    requestor_profile = datamodels.Profile(
+        display_name='Requestor User',
+        handle='requestor_handle',
+        user_id=requestor_user.id,
+    )
+    requested_user = datamodels.User(
+        email='requestee@testhost.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    requested_user.save()
+    requested_profile = datamodels.Profile(
+        display_name='Requestee',
+        handle='requestee',
+        user_id=requested_user.id,
+    )
+    requested_profile.save()
+    requestor_connection = datamodels.Connection(
+        profile=requestor_profile,
+        host='https://other_host.com',
+        handle=requested_profile.handle,
+        display_name=requested_profile.display_name,
+        public_key=requested_profile.public_key,
+        status=connection_status.CONNECTED,
+    )
+    requested_connection = datamodels.Connection(
+        handle=requestor_profile.handle,
+        host='localhost',
+        display_name=requestor_profile.handle,
+        public_key=requestor_profile.public_key,
+        status=connection_status.CONNECTED,
+        profile=requested_profile,
+    )
+    requested_connection.save()
+    posts = []
+    for i in range(3):
+        post = datamodels.Post(
+            profile=requested_profile,
+            text=f'Post {i}',
+        )
+        post.save()
+        posts.append(post)
+
+    def retrieve_page(cursor=None):
+        request_payload = {
+            'host': requested_connection.host,
+            'handle': requested_connection.handle,
+            'limit': 2,
+        }
+        if cursor:
+            request_payload['cursor'] = cursor
+        enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
+            requestor_profile, requestor_connection, request_payload
+        )
+        response = client.post(
+            url_for("external_comms.retrieve_posts"),
+            json={
+                'enc_payload': enc_payload,
+                'enc_key': enc_key,
+                'signature': signature,
+                'nonce': nonce,
+                'tag': tag,
+                'handle': requestor_connection.handle,
+            }
+        )
+        assert response.status_code == 200
+        return decrypt_payload(
+            requestor_profile,
+            response.json['enc_key'],
+            response.json['enc_payload'],
+            response.json['nonce'],
+            response.json['tag'],
+        )
+
+    first_page = retrieve_page()
+    assert [p['id'] for p in first_page['posts']] == [posts[0].id, posts[1].id]
+    assert first_page['next_cursor']
+    second_page = retrieve_page(first_page['next_cursor'])
+    assert [p['id'] for p in second_page['posts']] == [posts[2].id]
+    assert second_page['next_cursor'] is None
+
+    def retrieve(**paging):
+        envelope = secure_envelope(requestor_profile, requestor_connection, {
+            'host': requested_connection.host,
+            'handle': requested_connection.handle,
+            **paging,
+        })
+        return client.post(
+            url_for("external_comms.retrieve_posts"),
+            json={**envelope, 'handle': requestor_connection.handle},
+        )
+
+    # hosts that don't page get every post, whatever the page size
+    client.application.config['POST_PAGE_SIZE'] = 2
+    response = retrieve()
+    assert response.status_code == 200
+    assert [p['id'] for p in open_envelope(
+        requestor_profile, requestor_connection, response.json
+    )] == [post.id for post in posts]
+
+    for paging in ({'limit': []}, {'limit': {}}, {'limit': 2, 'width': [640]}):
+        response = retrieve(**paging)
+        assert response.status_code == 400
+        assert response.data.startswith(b'Invalid paging parameters')
+
+def test_retrieve_posts_versioned(client):
+    requestor_profile = datamodels.Profile(
+        display_name='Requestor User',
+        handle='requestor_handle',
+        user_id=datamodels.User.generate_uuid(),
+    )
+    requested_user = datamodels.User(
+        email='requestee@testhost.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    requested_user.save()
+    requested_profile = datamodels.Profile(
+        display_name='Requestee',
+        handle='requestee',
+        user_id=requested_user.id,
+    )
+    requested_profile.save()
+    requestor_connection = datamodels.Connection(
+        profile=requestor_profile,
+        host='https://other_host.com',
+        handle=requested_profile.handle,
+        display_name=requested_profile.display_name,
+        public_key=requested_profile.public_key,
+        status=connection_status.CONNECTED,
+    )
+    requested_connection = datamodels.Connection(
+        handle=requestor_profile.handle,
+        host='localhost',
+        display_name=requestor_profile.handle,
+        public_key=requestor_profile.public_key,
+        status=connection_status.CONNECTED,
+        profile=requested_profile,
+    )
+    requested_connection.save()
+    now = datetime.now().astimezone(tz.UTC)
+    # saved newest first since the test backend returns them in saved order
+    posts = []
+    for i in range(3):
+        post = datamodels.Post(
+            profile=requested_profile,
+            text=f'Post {i}',
+            created=now - timedelta(minutes=i + 1),
+        )
+        post.save()
+        posts.append(post)
+
+    def retrieve_page(version=None, cursor=None):
+        request_payload = {
+            'host': requested_connection.host,
+            'handle': requested_connection.handle,
+            'limit': 2,
+        }
+        if version is not None:
+            request_payload['version'] = version
+        if cursor is not None:
+            request_payload['cursor'] = cursor
+        enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
+            requestor_profile, requestor_connection, request_payload
+        )
+        response = client.post(
+            url_for("external_comms.retrieve_posts"),
+            json={
+                'enc_payload': enc_payload,
+                'enc_key': enc_key,
+                'signature': signature,
+                'nonce': nonce,
+                'tag': tag,
+                'handle': requestor_connection.handle,
+            }
+        )
+        assert response.status_code == 200
+        return decrypt_payload(
+            requestor_profile,
+            response.json['enc_key'],
+            response.json['enc_payload'],
+            response.json['nonce'],
+            response.json['tag'],
+        )
+
+    first_page = retrieve_page()
+    version = first_page['version']
+    assert version == posts[0].updated.isoformat()
+    assert retrieve_page(version) == {'not_modified': True, 'version': version}
+    # later pages only look the version up if one was sent
+    next_page = retrieve_page(cursor=first_page['next_cursor'])
+    assert [p['id'] for p in next_page['posts']] == [posts[2].id]
+    assert next_page['version'] is None
+    assert retrieve_page(version, first_page['next_cursor']) == {
+        'not_modified': True, 'version': version,
+    }
+    # a change to an existing post is sent on its own
+    posts[0].updated = now
+    delta = retrieve_page(version)
+    assert delta['delta']
+    assert [p['id'] for p in delta['posts']] == [posts[0].id]
+    assert delta['version'] == now.isoformat()
+    # more changes than fit on a page are sent as a whole page
+    for post in posts[1:]:
+        post.updated = now
+    with mock.patch.object(
+        datamodels.Post, 'list', wraps=datamodels.Post.list
+    ) as post_list:
+        full_page = retrieve_page(version)
+    assert 'delta' not in full_page
+    assert len(full_page['posts']) == 2
+    # no more changes are read than it takes to tell
+    assert mock.call(
+        profile=requested_profile, updated__gt=datetime.fromisoformat(version), limit=3,
+    ) in post_list.call_args_list
+    # a new post changes the pages, so the whole page is sent
+    datamodels.Post(profile=requested_profile, text='New post', created=now).save()
+    full_page = retrieve_page(version)
+    assert 'delta' not in full_page
+    assert len(full_page['posts']) == 2
+    assert full_page['next_cursor']
+    # as is anything that isn't a version
+    assert 'delta' not in retrieve_page('bogus')
+    assert 'delta' not in retrieve_page(now.replace(tzinfo=None).isoformat())
+
 def test_post_notify(client):
     requestor_user = datamodels.User(
         email='requestor@example.com',
@@ -716,6 +1102,99 @@ def test_post_notify(client):
     assert post_reference.connection == requested_connection
     assert post_reference.read is False
     assert post_reference.reference_read is False
+    timeline_entry = datamodels.TimelineEntry.get(post_id='mock_post_id')
+    assert timeline_entry.profile == requested_connection.profile
+    assert timeline_entry.connection_id == requested_connection.id
+
+    # a repeated notification leaves the post where it was on the timeline
+    created = timeline_entry.created
+    response = client.post(
+        url_for("external_comms.post_notify"),
+        json={
+            **secure_envelope(requestor_profile, requestor_connection, request_payload),
+            'handle': requestor_connection.handle,
+        }
+    )
+    assert response.status_code == 200
+    timeline_entries = datamodels.TimelineEntry.list(post_id='mock_post_id')
+    assert len(timeline_entries) == 1
+    assert timeline_entries[0].created == created
+
+def test_post_notify_ec(client):
+    requestor_profile = datamodels.Profile(
+        display_name='Requestor User',
+        handle='requestor_handle',
+        user_id=datamodels.User.generate_uuid(),
+    )
+    requestor_profile.ec_public_key, requestor_profile.ec_private_key = \
+        datamodels.Profile.generate_ec_keys()
+    requested_profile = datamodels.Profile(
+        display_name='Requestee',
+        handle='requestee',
+        user_id=datamodels.User.generate_uuid(),
+    )
+    requested_profile.ec_public_key, requested_profile.ec_private_key = \
+        datamodels.Profile.generate_ec_keys()
+    requested_profile.save()
+    requestor_connection = datamodels.Connection(
+        profile=requestor_profile,
+        host='https://other_host.com',
+        handle=requested_profile.handle,
+        public_key=requested_profile.public_key,
+        ec_public_key=requested_profile.ec_public_key,
+        status=connection_status.CONNECTED,
+    )
+    requested_connection = datamodels.Connection(
+        handle=requestor_profile.handle,
+        host='localhost',
+        public_key=requestor_profile.public_key,
+        ec_public_key=requestor_profile.ec_public_key,
+        status=connection_status.CONNECTED,
+        profile=requested_profile,
+    )
+    requested_connection.save()
+
+    request_payload = {
+      'post_host': 'localhost',
+      'post_handle': requestor_profile.handle,
+      'post_id': 'mock_post_id',
+    }
+    envelope = secure_envelope(requestor_profile, requestor_connection, request_payload)
+    assert envelope['suite'] == EC_SUITE
+    response = client.post(
+        url_for('external_comms.post_notify'),
+        json={**envelope, 'handle': requested_profile.handle},
+    )
+    assert response.status_code == 200
+    assert datamodels.PostReference.get(post_id='mock_post_id').connection == requested_connection
+
+    # signed by a key other than the one the connection advertised
+    requestor_profile.ec_public_key, requestor_profile.ec_private_key = \
+        datamodels.Profile.generate_ec_keys()
+    enc_payload, enc_key, signature, nonce, tag = ec_enc_and_sign_payload(
+        requestor_profile, requestor_connection, request_payload
+    )
+    forged = {
+        'enc_payload': enc_payload,
+        'enc_key': enc_key,
+        'signature': signature,
+        'nonce': nonce,
+        'tag': tag,
+        'suite': EC_SUITE,
+        'handle': requested_profile.handle,
+    }
+    response = client.post(url_for('external_comms.post_notify'), json=forged)
+    assert response.status_code == 400
+    assert response.data == b'Invalid request - signature does not match'
+
+    # a profile without EC keys can't open EC envelopes
+    requested_profile.ec_private_key = None
+    response = client.post(
+        url_for('external_comms.post_notify'),
+        json={**envelope, 'handle': requested_profile.handle},
+    )
+    assert response.status_code == 400
+    assert response.data == f'Unsupported key suite {EC_SUITE}'.encode()
 
 def test_comment_created(client):
     requestor_user = datamodels.User(
@@ -788,6 +1267,8 @@ def test_comment_created(client):
     assert comment_reference is not None
     assert comment_reference.connection == requested_connection
     assert comment_reference.post_id == post.id
+    # connections with the post cached see it has changed
+    assert post.updated > post.created
 
 def test_comment_created_no_post(client):
     requestor_user = datamodels.User(
@@ -894,12 +1375,14 @@ def test_retrieve_comments(client):
     )
     requested_connection.save()
     post_ids = ['post_1', 'post_2']
+    now = datetime.now().astimezone(tz.UTC)
     for i in range(5):
         comment = datamodels.Comment(
             profile=requested_profile,
             post_id=post_ids[0],
             text=f'This is comment number {i+1}',
-            files=[f'file-{i+1}.txt']
+            files=[f'file-{i+1}.txt'],
+            created=now - timedelta(minutes=5 - i),
         )
         comment.save()
     for i in range(5,10):
@@ -919,6 +1402,48 @@ def test_retrieve_comments(client):
         requestor_profile, requestor_connection, request_payload
     )
     # send request to connection's host
+    with mock.patch.object(
+        client.application, 'url_signer', wraps=client.application.url_signer
+    ) as url_signer:
+        response = client.post(
+            url_for("external_comms.retrieve_comments"),
+            json={
+                'enc_payload': enc_payload,
+                'enc_key': enc_key,
+                'signature': signature,
+                'nonce': nonce,
+                'tag': tag,
+                'handle': requestor_connection.handle,
+            }
+        )
+    assert response.status_code == 200
+    # every comment's files are signed at once
+    assert url_signer.call_count == 1
+    request_data = json.loads(response.data)
+    request_payload = decrypt_payload(
+        requestor_profile,
+        request_data['enc_key'],
+        request_data['enc_payload'],
+        request_data['nonce'],
+        request_data['tag'],
+    )
+    assert len(request_payload) == 10
+    assert any(comment['text'] == 'This is comment number 1' for comment in request_payload)
+    assert any(comment['text'] == 'This is comment number 6' for comment in request_payload)
+    assert all(comment['profile']['handle'] == 'requestee' for comment in request_payload)
+    assert sum(comment['post_id'] == post_ids[0] for comment in request_payload) == 5
+    assert sum(comment['post_id'] == post_ids[1] for comment in request_payload) == 5
+
+    # only comments after since are sent for the posts it's given for
+    request_payload = {
+      'host': 'localhost',
+      'handle': requestor_profile.handle,
+      'post_ids': post_ids,
+      'since': {post_ids[0]: str(now - timedelta(minutes=3))},
+    }
+    enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
+        requestor_profile, requestor_connection, request_payload
+    )
     response = client.post(
         url_for("external_comms.retrieve_comments"),
         json={
@@ -931,17 +1456,343 @@ def test_retrieve_comments(client):
         }
     )
     assert response.status_code == 200
-    request_data = json.loads(response.data)
     request_payload = decrypt_payload(
         requestor_profile,
-        request_data['enc_key'],
-        request_data['enc_payload'],
-        request_data['nonce'],
-        request_data['tag'],
+        response.json['enc_key'],
+        response.json['enc_payload'],
+        response.json['nonce'],
+        response.json['tag'],
+    )
+    assert sorted(
+        comment['text'] for comment in request_payload if comment['post_id'] == post_ids[0]
+    ) == ['This is comment number 4', 'This is comment number 5']
+    assert sum(comment['post_id'] == post_ids[1] for comment in request_payload) == 5
+
+    # compressed if the requestor accepts it
+    envelope = secure_envelope(requestor_profile, requestor_connection, {
+      'host': 'localhost',
+      'handle': requestor_profile.handle,
+      'post_ids': post_ids,
+    })
+    response = client.post(
+        url_for("external_comms.retrieve_comments"),
+        json={
+            **envelope,
+            'handle': requestor_connection.handle,
+            'accept_compression': ['brotli', 'zlib'],
+        }
     )
+    assert response.status_code == 200
+    assert response.json['compression'] == 'zlib'
+    request_payload = open_envelope(requestor_profile, requestor_connection, response.json)
     assert len(request_payload) == 10
-    assert any(comment['text'] == 'This is comment number 1' for comment in request_payload)
-    assert any(comment['text'] == 'This is comment number 6' for comment in request_payload)
-    assert all(comment['profile']['handle'] == 'requestee' for comment in request_payload)
-    assert sum(comment['post_id'] == post_ids[0] for comment in request_payload) == 5
-    assert sum(comment['post_id'] == post_ids[1] for comment in request_payload) == 5
+
+def test_retrieve_comments_since(client):
+    requestor_profile = datamodels.Profile(
+        display_name='Requestor User',
+        handle='requestor_handle',
+        user_id=datamodels.User.generate_uuid(),
+    )
+    requested_user = datamodels.User(
+        email='requestee@testhost.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    requested_user.save()
+    requested_profile = datamodels.Profile(
+        display_name='Requestee',
+        handle='requestee',
+        user_id=requested_user.id,
+    )
+    requested_profile.save()
+    requestor_connection = datamodels.Connection(
+        profile=requestor_profile,
+        host='https://other_host.com',
+        handle=requested_profile.handle,
+        display_name=requested_profile.display_name,
+        public_key=requested_profile.public_key,
+        status=connection_status.CONNECTED,
+    )
+    requested_connection = datamodels.Connection(
+        handle=requestor_profile.handle,
+        host='localhost',
+        display_name=requestor_profile.handle,
+        public_key=requestor_profile.public_key,
+        status=connection_status.CONNECTED,
+        profile=requested_profile,
+    )
+    requested_connection.save()
+    now = datetime.now().astimezone(tz.UTC)
+    for i in range(5):
+        datamodels.Comment(
+            profile=requested_profile,
+            post_id='post_1',
+            text=f'This is comment number {i+1}',
+            created=now - timedelta(minutes=5 - i),
+        ).save()
+
+    def retrieve(since):
+        envelope = secure_envelope(requestor_profile, requestor_connection, {
+          'host': 'localhost',
+          'handle': requestor_profile.handle,
+          'post_ids': ['post_1'],
+          'since': since,
+        })
+        return client.post(
+            url_for("external_comms.retrieve_comments"),
+            json={**envelope, 'handle': requestor_connection.handle},
+        )
+
+    # timestamps without a timezone are taken as UTC
+    naive = (now - timedelta(minutes=3)).replace(tzinfo=None)
+    response = retrieve({'post_1': naive.isoformat()})
+    assert response.status_code == 200
+    comments = open_envelope(requestor_profile, requestor_connection, response.json)
+    assert sorted(comment['text'] for comment in comments) == [
+        'This is comment number 4', 'This is comment number 5',
+    ]
+
+    for since in (['post_1'], 'post_1'):
+        response = retrieve(since)
+        assert response.status_code == 400
+        assert response.data == b'Invalid payload - since must be an object'
+
+def test_establish_session(client):
+    requestor_profile = datamodels.Profile(
+        display_name='Requestor User',
+        handle='requestor_handle',
+        user_id=datamodels.User.generate_uuid(),
+    )
+    requested_user = datamodels.User(
+        email='requestee@testhost.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    requested_user.save()
+    requested_profile = datamodels.Profile(
+        display_name='Requestee',
+        handle='requestee',
+        user_id=requested_user.id,
+    )
+    requested_profile.save()
+    requestor_connection = datamodels.Connection(
+        profile=requestor_profile,
+        host='https://other_host.com',
+        handle=requested_profile.handle,
+        display_name=requested_profile.display_name,
+        public_key=requested_profile.public_key,
+        status=connection_status.CONNECTED,
+    )
+    requested_connection = datamodels.Connection(
+        handle=requestor_profile.handle,
+        host='localhost',
+        display_name=requestor_profile.handle,
+        public_key=requestor_profile.public_key,
+        status=connection_status.CONNECTED,
+        profile=requested_profile,
+    )
+    requested_connection.save()
+
+    session_expires = datetime.now().astimezone(tz.UTC) + timedelta(hours=1)
+    envelope = secure_envelope(requestor_profile, requestor_connection, {
+        'host': 'localhost',
+        'handle': requestor_profile.handle,
+        'session_id': 'session_id',
+        'session_key': 'ab' * 32,
+        'session_expires': session_expires.isoformat(),
+    })
+    response = client.post(
+        url_for('external_comms.establish_session'),
+        json={**envelope, 'handle': requestor_connection.handle},
+    )
+    assert response.status_code == 200
+    assert requested_connection.session_id == 'session_id'
+    assert requested_connection.session_key == 'ab' * 32
+    assert requested_connection.session_expires == session_expires
+
+    # later requests only use the session key
+    requestor_connection.session_id = 'session_id'
+    requestor_connection.session_key = 'ab' * 32
+    requestor_connection.session_expires = session_expires
+    envelope = secure_envelope(requestor_profile, requestor_connection, {
+      'post_host': 'localhost',
+      'post_handle': requestor_profile.handle,
+      'post_id': 'mock_post_id',
+    })
+    assert 'enc_key' not in envelope
+    response = client.post(
+        url_for('external_comms.post_notify'),
+        json={**envelope, 'handle': requestor_connection.handle},
+    )
+    assert response.status_code == 200
+    post_reference = datamodels.PostReference.get(post_id='mock_post_id')
+    assert post_reference.connection == requested_connection
+
+    # and responses come back encrypted with it too
+    envelope = secure_envelope(requestor_profile, requestor_connection, {
+        'host': 'localhost',
+        'handle': requestor_profile.handle,
+        'post_ids': [],
+    })
+    response = client.post(
+        url_for('external_comms.retrieve_comments'),
+        json={**envelope, 'handle': requestor_connection.handle},
+    )
+    assert response.status_code == 200
+    response_data = json.loads(response.data)
+    assert response_data['session_id'] == 'session_id'
+    assert open_envelope(
+        requestor_profile, requestor_connection, response_data
+    ) == []
+
+    # tampered mac
+    response = client.post(
+        url_for('external_comms.retrieve_comments'),
+        json={**envelope, 'mac': '00' * 32, 'handle': requestor_connection.handle},
+    )
+    assert response.status_code == 400
+
+    # unknown session
+    requestor_connection.session_id = 'other_session_id'
+    envelope = secure_envelope(requestor_profile, requestor_connection, {
+      'post_host': 'localhost',
+      'post_handle': requestor_profile.handle,
+      'post_id': 'mock_post_id',
+    })
+    response = client.post(
+        url_for('external_comms.post_notify'),
+        json={**envelope, 'handle': requestor_connection.handle},
+    )
+    assert response.status_code == 401
+    requestor_connection.session_id = 'session_id'
+
+    def establish(session_id, session_expires):
+        envelope = secure_envelope(requestor_profile, requestor_connection, {
+            'host': 'localhost',
+            'handle': requestor_profile.handle,
+            'session_id': session_id,
+            'session_key': 'cd' * 32,
+            'session_expires': session_expires.isoformat(),
+        })
+        return client.post(
+            url_for('external_comms.establish_session'),
+            json={**envelope, 'handle': requestor_connection.handle},
+        )
+
+    def notify():
+        envelope = secure_envelope(requestor_profile, requestor_connection, {
+          'post_host': 'localhost',
+          'post_handle': requestor_profile.handle,
+          'post_id': 'mock_post_id',
+        })
+        return client.post(
+            url_for('external_comms.post_notify'),
+            json={**envelope, 'handle': requestor_connection.handle},
+        )
+
+    # expirations in the past are turned down
+    response = establish('new_session_id', datetime.now().astimezone(tz.UTC) - timedelta(seconds=1))
+    assert response.status_code == 400
+    assert requested_connection.session_id == 'session_id'
+
+    # and ones past SESSION_KEY_TTL are cut short
+    client.application.config['SESSION_KEY_TTL'] = 3600
+    response = establish('new_session_id', datetime.now().astimezone(tz.UTC) + timedelta(days=30))
+    assert response.status_code == 200
+    assert requested_connection.session_id == 'new_session_id'
+    assert requested_connection.session_expires <= \
+        datetime.now().astimezone(tz.UTC) + timedelta(seconds=3600)
+
+    # messages sent under the session that was replaced still get through
+    assert requested_connection.prev_session_id == 'session_id'
+    assert notify().status_code == 200
+    requestor_connection.session_id = 'new_session_id'
+    requestor_connection.session_key = 'cd' * 32
+    assert notify().status_code == 200
+
+    # until it's past its expiration plus SESSION_KEY_GRACE
+    requestor_connection.session_id = 'session_id'
+    requestor_connection.session_key = 'ab' * 32
+    requested_connection.prev_session_expires = datetime.now().astimezone(tz.UTC) - timedelta(
+        seconds=client.application.config.get('SESSION_KEY_GRACE', 300) + 1
+    )
+    assert notify().status_code == 401
+
+def test_post_notify_batch(client):
+    requestor_profile = datamodels.Profile(
+        display_name='Requestor User',
+        handle='requestor_handle',
+        user_id=datamodels.User.generate_uuid(),
+    )
+    requested_connections = []
+    notifications = []
+    # test datamodels only match on the last filter (host), so each
+    # connection gets its own host
+    for handle, host in (('requestee_one', 'host_one'), ('requestee_two', 'host_two')):
+        requested_profile = datamodels.Profile(
+            display_name=handle,
+            handle=handle,
+            user_id=datamodels.User.generate_uuid(),
+        )
+        requested_profile.save()
+        requestor_connection = datamodels.Connection(
+            profile=requestor_profile,
+            host='https://other_host.com',
+            handle=requested_profile.handle,
+            public_key=requested_profile.public_key,
+            status=connection_status.CONNECTED,
+        )
+        requested_connection = datamodels.Connection(
+            handle=requestor_profile.handle,
+            host=host,
+            display_name=requestor_profile.handle,
+            public_key=requestor_profile.public_key,
+            status=connection_status.CONNECTED,
+            profile=requested_profile,
+        )
+        requested_connection.save()
+        requested_connections.append(requested_connection)
+        envelope = secure_envelope(requestor_profile, requestor_connection, {
+          'post_host': host,
+          'post_handle': requestor_profile.handle,
+          'post_ids': ['mock_post_id', 'mock_post_id_2'],
+        })
+        notifications.append({**envelope, 'handle': handle})
+    notifications.append({**notifications[0], 'handle': 'no_such_handle'})
+    notifications.append('not a notification')
+    response = client.post(
+        url_for('external_comms.post_notify_batch'),
+        json={'notifications': notifications},
+    )
+    assert response.status_code == 200
+    assert json.loads(response.data)['results'] == [
+        {'handle': 'requestee_one', 'status': 200},
+        {'handle': 'requestee_two', 'status': 200},
+        {'handle': 'no_such_handle', 'status': 404},
+        {'handle': None, 'status': 400},
+    ]
+    post_references = datamodels.PostReference.list()
+    assert sorted(
+        (pr.connection.profile.handle, pr.post_id) for pr in post_references
+    ) == [
+        ('requestee_one', 'mock_post_id'),
+        ('requestee_one', 'mock_post_id_2'),
+        ('requestee_two', 'mock_post_id'),
+        ('requestee_two', 'mock_post_id_2'),
+    ]
+    timeline_entries = datamodels.TimelineEntry.list()
+    assert sorted(
+        (entry.profile.handle, entry.post_id) for entry in timeline_entries
+    ) == [
+        ('requestee_one', 'mock_post_id'),
+        ('requestee_one', 'mock_post_id_2'),
+        ('requestee_two', 'mock_post_id'),
+        ('requestee_two', 'mock_post_id_2'),
+    ]
+
+def test_post_notify_batch_invalid_request(client):
+    response = client.post(
+        url_for('external_comms.post_notify_batch'),
+        json={'notifications': 'bogus'},
+    )
+    assert response.status_code == 400
+    response = client.post(url_for('external_comms.post_notify_batch'), json={})
+    assert response.status_code == 400
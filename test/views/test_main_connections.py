@@ -1,4 +1,5 @@
 import json
+import time
 
 from unittest import mock
 
@@ -141,6 +142,12 @@ def test_manage_connection_delete(client):
         status=connection_status.PENDING,
     )
     connection.save()
+    timeline_entry = datamodels.TimelineEntry(
+        profile=profile,
+        connection_id=connection.id,
+        post_id='post_id',
+    )
+    timeline_entry.save()
     # need to set a user id in the session
     # this will also call socialmedia.views.auth.load_user
     with client.session_transaction() as sess:
@@ -156,6 +163,7 @@ def test_manage_connection_delete(client):
     })
     assert response.status_code == 200
     assert not any([e == connection for e in datamodels.Connection._data])
+    assert not datamodels.TimelineEntry.list()
 
 def test_manage_connection_decline(client):
     user = datamodels.User(
@@ -185,6 +193,11 @@ def test_manage_connection_decline(client):
         status=connection_status.PENDING,
     )
     connection.save()
+    datamodels.TimelineEntry(
+        profile=profile,
+        connection_id=connection.id,
+        post_id='post_id',
+    ).save()
     # need to set a user id in the session
     # this will also call socialmedia.views.auth.load_user
     with client.session_transaction() as sess:
@@ -200,6 +213,8 @@ def test_manage_connection_decline(client):
     })
     assert response.status_code == 200
     assert connection.status == connection_status.DECLINED
+    # posts from declined connections come off the timeline
+    assert not datamodels.TimelineEntry.list()
 
 def test_manage_connection_invalid_action(client):
     user = datamodels.User(
@@ -435,7 +450,7 @@ def test_get_connection_info(client):
         other_profile_two, other_connection_two, {'post_count': 1}
     )
 
-    with mock.patch('socialmedia.views.main.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         req.post.side_effect = [
             MockResponse(
                 200,
@@ -471,6 +486,7 @@ def test_get_connection_info(client):
     }
     for conn in json_response['connections']:
         assert_dict[conn['handle']] = conn
+        assert not conn['stale']
 
     assert not post_reference_dict[post_reference_one.post_id]['read']
     assert not post_reference_dict[post_reference_one.post_id]['reference_read']
@@ -498,3 +514,58 @@ def test_get_connection_info(client):
     assert assert_dict['requesting_user']['id'] == pending_connection.id
     assert assert_dict['requesting_user']['status'] == pending_connection.status
     assert len(assert_dict['requesting_user']['post_references']) == 0
+
+def test_get_connection_info_stale(client):
+    # a host that doesn't answer by the deadline is reported as stale
+    client.application.config['CONNECTION_INFO_DEADLINE'] = 1
+    user = datamodels.User(
+        email='user@example.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    user.save()
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='handle',
+        user_id=user.id,
+    )
+    profile.save()
+    other_profile = datamodels.Profile(
+        display_name='Other User',
+        handle='other_handle',
+        user_id=datamodels.User.generate_uuid(),
+    )
+    connection = datamodels.Connection(
+        profile=profile,
+        host='other_host.com',
+        handle=other_profile.handle,
+        display_name=other_profile.display_name,
+        public_key=other_profile.public_key,
+        status=connection_status.CONNECTED,
+    )
+    connection.save()
+    post_reference = datamodels.PostReference(
+        connection=connection,
+        post_id='mock_post_id',
+        reference_read=False,
+        read=False
+    )
+    post_reference.save()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = user.id
+        sess['authenticated_user'] = user.as_json()
+        sess['user'] = profile.as_json()
+    with mock.patch.object(client.application, 'http_client') as req:
+        def side_effect(*args, **kwargs):
+            time.sleep(3)
+            return MockResponse(500, 'too late')
+        req.post.side_effect = side_effect
+        client.get('/')
+        _timer = time.time()
+        response = client.get(url_for('main.get_connection_info'))
+        assert time.time() - _timer < 3
+    assert response.status_code == 200
+    json_response = json.loads(response.data)
+    assert len(json_response['connections']) == 1
+    assert json_response['connections'][0]['stale']
+    assert json_response['connections'][0]['total_post_count'] == 0
+    assert len(json_response['connections'][0]['post_references']) == 1
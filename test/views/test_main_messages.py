@@ -1,12 +1,15 @@
 import json
 
 from collections import namedtuple
+from datetime import datetime, timedelta
+from dateutil import tz
 from flask import url_for
 from io import BytesIO
 from unittest import mock
 
 from socialmedia import connection_status
-from socialmedia.views.utils import enc_and_sign_payload
+from socialmedia.composite_upload import LocalObjectStore
+from socialmedia.views.utils import enc_and_sign_payload, decrypt_payload
 from test import datamodels
 from .utils import client
 
@@ -49,6 +52,58 @@ def test_get_posts(client):
     assert json_response[0]['files'][0] == 'test_attachment.png'
     assert json_response[0]['profile']['handle'] == profile.handle
 
+def test_get_posts_paged(client):
+    user = datamodels.User(
+        email='user@example.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    user.save()
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='handle',
+        user_id=user.id,
+    )
+    profile.save()
+    posts = []
+    for i in range(3):
+        post = datamodels.Post(
+            text=f'Test Post {i}',
+            profile=profile,
+        )
+        post.save()
+        posts.append(post)
+    with client.session_transaction() as sess:
+        sess['_user_id'] = user.id
+        sess['authenticated_user'] = user.as_json()
+        sess['user'] = profile.as_json()
+    response = client.get('/get-posts?limit=2')
+    assert response.status_code == 200
+    assert [p['id'] for p in response.json] == [posts[0].id, posts[1].id]
+    next_cursor = response.headers['X-Next-Cursor']
+    response = client.get(f'/get-posts?limit=2&cursor={next_cursor}')
+    assert response.status_code == 200
+    assert [p['id'] for p in response.json] == [posts[2].id]
+    assert 'X-Next-Cursor' not in response.headers
+
+def test_get_posts_invalid_limit(client):
+    user = datamodels.User(
+        email='user@example.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    user.save()
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='handle',
+        user_id=user.id,
+    )
+    profile.save()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = user.id
+        sess['authenticated_user'] = user.as_json()
+        sess['user'] = profile.as_json()
+    response = client.get('/get-posts?limit=none')
+    assert response.status_code == 400
+
 def test_create_post(client):
     user = datamodels.User(
         email='user@example.com',
@@ -133,7 +188,7 @@ def test_get_connection_posts(client):
         sess['_user_id'] = user.id
         sess['authenticated_user'] = user.as_json()
         sess['user'] = profile.as_json()
-    with mock.patch('socialmedia.views.main.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         req.post.return_value = MockResponse(
             200,
             json.dumps({
@@ -157,6 +212,177 @@ def test_get_connection_posts(client):
         assert json_post['files'][0] == 'get_connection_posts_attachment.png'
         assert json_post['profile']['handle'] == other_profile.handle
 
+def test_get_connection_posts_paged(client):
+    user = datamodels.User(
+        email='user@example.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    user.save()
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='user_handle',
+        user_id=user.id,
+    )
+    profile.save()
+    other_user = datamodels.User(
+        email='other_user@otherhost.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    other_profile = datamodels.Profile(
+        display_name='Other User',
+        handle='other_handle',
+        user_id=other_user.id,
+    )
+    connection = datamodels.Connection(
+        profile=profile,
+        host='other_host.com',
+        handle=other_profile.handle,
+        display_name=other_profile.display_name,
+        public_key=other_profile.public_key,
+        status=connection_status.CONNECTED,
+    )
+    connection.save()
+    other_connection = datamodels.Connection(
+        profile=other_profile,
+        host='localhost',
+        handle=profile.handle,
+        display_name=profile.display_name,
+        public_key=profile.public_key,
+        status=connection_status.CONNECTED,
+    )
+    post = datamodels.Post(
+        profile=other_profile,
+        text='test_get_connection_posts_paged',
+    )
+    enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
+        other_profile, other_connection, {
+            'posts': [post.as_json()],
+            'next_cursor': 'mock_cursor',
+        }
+    )
+    with client.session_transaction() as sess:
+        sess['_user_id'] = user.id
+        sess['authenticated_user'] = user.as_json()
+        sess['user'] = profile.as_json()
+    with mock.patch.object(client.application, 'http_client') as req:
+        req.post.return_value = MockResponse(
+            200,
+            json.dumps({
+                'enc_payload': enc_payload,
+                'enc_key': enc_key,
+                'signature': signature,
+                'nonce': nonce,
+                'tag': tag
+            })
+        )
+        client.get('/')
+        response = client.get(
+            url_for('main.get_connection_posts', connection_id=connection.id, limit=5, cursor='abc')
+        )
+        request_payload = decrypt_payload(
+            other_profile,
+            req.post.call_args.kwargs['json']['enc_key'],
+            req.post.call_args.kwargs['json']['enc_payload'],
+            req.post.call_args.kwargs['json']['nonce'],
+            req.post.call_args.kwargs['json']['tag'],
+        )
+    assert request_payload['limit'] == 5
+    assert request_payload['cursor'] == 'abc'
+    assert response.status_code == 200
+    assert len(response.json) == 1
+    assert response.json[0]['text'] == post.text
+    assert response.headers['X-Next-Cursor'] == 'mock_cursor'
+
+def test_get_connection_posts_cached(client):
+    user = datamodels.User(
+        email='user@example.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    user.save()
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='user_handle',
+        user_id=user.id,
+    )
+    profile.save()
+    other_profile = datamodels.Profile(
+        display_name='Other User',
+        handle='other_handle',
+        user_id=datamodels.User.generate_uuid(),
+    )
+    connection = datamodels.Connection(
+        profile=profile,
+        host='other_host.com',
+        handle=other_profile.handle,
+        display_name=other_profile.display_name,
+        public_key=other_profile.public_key,
+        status=connection_status.CONNECTED,
+    )
+    connection.save()
+    other_connection = datamodels.Connection(
+        profile=other_profile,
+        host='localhost',
+        handle=profile.handle,
+        display_name=profile.display_name,
+        public_key=profile.public_key,
+        status=connection_status.CONNECTED,
+    )
+    posts = [
+        datamodels.Post(profile=other_profile, text=f'Post {i}') for i in range(2)
+    ]
+    changed_post = posts[1].as_json()
+    changed_post['text'] = 'Changed'
+
+    def mock_response(payload):
+        enc_payload, enc_key, signature, nonce, tag = enc_and_sign_payload(
+            other_profile, other_connection, payload
+        )
+        return MockResponse(200, json.dumps({
+            'enc_payload': enc_payload,
+            'enc_key': enc_key,
+            'signature': signature,
+            'nonce': nonce,
+            'tag': tag
+        }))
+
+    def sent_version(call):
+        return decrypt_payload(
+            other_profile,
+            call.kwargs['json']['enc_key'],
+            call.kwargs['json']['enc_payload'],
+            call.kwargs['json']['nonce'],
+            call.kwargs['json']['tag'],
+        ).get('version')
+
+    with client.session_transaction() as sess:
+        sess['_user_id'] = user.id
+        sess['authenticated_user'] = user.as_json()
+        sess['user'] = profile.as_json()
+    with mock.patch.object(client.application, 'http_client') as req:
+        req.post.side_effect = [
+            mock_response({
+                'posts': [post.as_json() for post in posts],
+                'next_cursor': 'mock_cursor',
+                'version': 'v1',
+            }),
+            mock_response({'not_modified': True, 'version': 'v1'}),
+            mock_response({'delta': True, 'posts': [changed_post], 'version': 'v2'}),
+            mock_response({'not_modified': True, 'version': 'v2'}),
+        ]
+        client.get('/')
+        responses = [
+            client.get(url_for('main.get_connection_posts', connection_id=connection.id))
+            for _ in range(4)
+        ]
+    assert [sent_version(call) for call in req.post.call_args_list] == [
+        None, 'v1', 'v1', 'v2'
+    ]
+    assert all(response.status_code == 200 for response in responses)
+    assert [p['text'] for p in responses[1].json] == ['Post 0', 'Post 1']
+    assert responses[1].headers['X-Next-Cursor'] == 'mock_cursor'
+    assert [p['text'] for p in responses[3].json] == ['Post 0', 'Changed']
+    assert responses[3].headers['X-Next-Cursor'] == 'mock_cursor'
+
 def test_get_connection_posts_no_connection(client):
     user = datamodels.User(
         email='user@example.com',
@@ -214,7 +440,7 @@ def test_get_connection_posts_failed_response(client):
         sess['_user_id'] = user.id
         sess['authenticated_user'] = user.as_json()
         sess['user'] = profile.as_json()
-    with mock.patch('socialmedia.views.main.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         req.post.return_value = MockResponse(404, 'No connection found')
         client.get('/')
         response = client.get(
@@ -223,6 +449,47 @@ def test_get_connection_posts_failed_response(client):
         assert response.status_code == 404
         assert response.data == b'Failed to retrieve connection posts'
 
+def test_get_connection_posts_default_timeout(client):
+    user = datamodels.User(
+        email='user@example.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    user.save()
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='user_handle',
+        user_id=user.id,
+    )
+    profile.save()
+    other_profile = datamodels.Profile(
+        display_name='Other User',
+        handle='other_handle',
+        user_id=datamodels.User.generate_uuid(),
+    )
+    connection = datamodels.Connection(
+        profile=profile,
+        host='other_host.com',
+        handle=other_profile.handle,
+        display_name=other_profile.display_name,
+        public_key=other_profile.public_key,
+        status=connection_status.CONNECTED,
+    )
+    connection.save()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = user.id
+        sess['authenticated_user'] = user.as_json()
+        sess['user'] = profile.as_json()
+    http_client = client.application.http_client
+    with mock.patch.object(http_client.session, 'request') as request:
+        request.return_value = MockResponse(404, 'No connection found')
+        client.get('/')
+        response = client.get(
+            url_for('main.get_connection_posts', connection_id=connection.id)
+        )
+        assert response.status_code == 404
+        # no timeout of its own, so the client's default applies
+        assert request.call_args[1]['timeout'] == http_client.timeout
+
 def test_get_connection_posts_bad_response(client):
     user = datamodels.User(
         email='user@example.com',
@@ -270,7 +537,7 @@ def test_get_connection_posts_bad_response(client):
         sess['_user_id'] = user.id
         sess['authenticated_user'] = user.as_json()
         sess['user'] = profile.as_json()
-    with mock.patch('socialmedia.views.main.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         req.post.return_value = MockResponse(
             200,
             json.dumps(post.as_json())
@@ -351,6 +618,164 @@ def test_mark_post_read_no_notification(client):
     assert response.status_code == 404
     assert response.data == b'No such post id (does not exist)'
 
+def _mark_read_setup(client):
+    user = datamodels.User(
+        email='user@example.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    user.save()
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='user_handle',
+        user_id=user.id,
+    )
+    profile.save()
+    now = datetime.now().astimezone(tz.UTC)
+    connections = []
+    post_references = []
+    for i in range(2):
+        connection = datamodels.Connection(
+            profile=profile,
+            host=f'host{i}.com',
+            handle=f'handle{i}',
+            display_name=f'User {i}',
+            status=connection_status.CONNECTED,
+            updated=now - timedelta(hours=i),
+            read=False,
+        )
+        connection.save()
+        connections.append(connection)
+        for j in range(3):
+            post_reference = datamodels.PostReference(
+                connection=connection,
+                post_id=f'post_{i}_{j}',
+                read=False,
+                reference_read=False,
+                created=now - timedelta(hours=j),
+            )
+            post_reference.save()
+            post_references.append(post_reference)
+    with client.session_transaction() as sess:
+        sess['_user_id'] = user.id
+        sess['authenticated_user'] = user.as_json()
+        sess['user'] = profile.as_json()
+    client.get('/')
+    return now, connections, post_references
+
+def test_mark_posts_read(client):
+    now, connections, post_references = _mark_read_setup(client)
+    response = client.post(url_for('main.mark_posts_read'), json={
+        'post_ids': ['post_0_0', 'post_1_2', 'does not exist'],
+    })
+    assert response.status_code == 200
+    assert sorted(response.json['marked_read']) == ['post_0_0', 'post_1_2']
+    assert [p.post_id for p in post_references if p.read and p.reference_read] == [
+        'post_0_0', 'post_1_2'
+    ]
+    # already read posts aren't written again
+    response = client.post(url_for('main.mark_posts_read'), json={
+        'post_ids': ['post_0_0'],
+    })
+    assert response.json['marked_read'] == []
+
+def test_mark_posts_read_before(client):
+    now, connections, post_references = _mark_read_setup(client)
+    response = client.post(url_for('main.mark_posts_read'), json={
+        'before': (now - timedelta(minutes=30)).isoformat(),
+        'connection_id': connections[0].id,
+    })
+    assert response.status_code == 200
+    assert sorted(response.json['marked_read']) == ['post_0_1', 'post_0_2']
+    assert [p.post_id for p in post_references if p.read] == ['post_0_1', 'post_0_2']
+
+def test_mark_post_references_read(client):
+    now, connections, post_references = _mark_read_setup(client)
+    response = client.post(url_for('main.mark_post_references_read'), json={
+        'before': now.isoformat(),
+    })
+    assert response.status_code == 200
+    assert len(response.json['marked_read']) == 6
+    assert all(p.reference_read and not p.read for p in post_references)
+
+def test_mark_posts_read_invalid(client):
+    now, connections, post_references = _mark_read_setup(client)
+    response = client.post(url_for('main.mark_posts_read'), json={})
+    assert response.status_code == 400
+    response = client.post(url_for('main.mark_posts_read'), json={
+        'post_ids': ['post_0_0'], 'before': now.isoformat(),
+    })
+    assert response.status_code == 400
+    response = client.post(url_for('main.mark_posts_read'), json={
+        'before': 'not a timestamp',
+    })
+    assert response.status_code == 400
+    response = client.post(url_for('main.mark_posts_read'), json={
+        'post_ids': ['post_0_0'], 'connection_id': 'does not exist',
+    })
+    assert response.status_code == 404
+    assert not any(p.read for p in post_references)
+
+def test_mark_connections_read(client):
+    now, connections, post_references = _mark_read_setup(client)
+    response = client.post(url_for('main.mark_connections_read'), json={
+        'before': (now - timedelta(minutes=30)).isoformat(),
+    })
+    assert response.status_code == 200
+    assert response.json['marked_read'] == [connections[1].id]
+    response = client.post(url_for('main.mark_connections_read'), json={
+        'connection_ids': [c.id for c in connections],
+    })
+    assert response.json['marked_read'] == [connections[0].id]
+    assert all(c.read for c in connections)
+
+def test_get_timeline(client):
+    now, connections, post_references = _mark_read_setup(client)
+    profile = connections[0].profile
+    removed = datamodels.Connection(
+        profile=profile,
+        host='removed.com',
+        handle='removed',
+        status=connection_status.CONNECTED,
+    )
+    removed.save()
+    # saved newest first since the test backend returns them in saved order
+    for minutes, connection, post_id in (
+        (1, connections[0], 'post_a'),
+        (2, connections[1], 'post_b'),
+        (3, removed, 'post_c'),
+        (4, connections[0], 'post_d'),
+        (5, removed, 'post_e'),
+    ):
+        datamodels.TimelineEntry(
+            profile=profile,
+            connection_id=connection.id,
+            post_id=post_id,
+            created=now - timedelta(minutes=minutes),
+        ).save()
+    with mock.patch.object(
+        datamodels.Connection, 'list', wraps=datamodels.Connection.list
+    ) as connection_list:
+        response = client.get(url_for('main.get_timeline', limit=2))
+    assert response.status_code == 200
+    assert [(e['post_id'], e['connection']['handle']) for e in response.json] == [
+        ('post_a', 'handle0'), ('post_b', 'handle1'),
+    ]
+    # only the connections on the page are read
+    connection_list.assert_called_once_with(
+        profile=profile, id__in={connections[0].id, connections[1].id},
+    )
+    cursor = response.headers['X-Next-Cursor']
+    response = client.get(url_for('main.get_timeline', limit=2, cursor=cursor))
+    assert [e['post_id'] for e in response.json] == ['post_c', 'post_d']
+    # a connection removed while paging leaves its entries out
+    removed.delete()
+    cursor = response.headers['X-Next-Cursor']
+    response = client.get(url_for('main.get_timeline', limit=2, cursor=cursor))
+    assert response.json == []
+    assert 'X-Next-Cursor' not in response.headers
+    response = client.get(url_for('main.get_timeline', limit=0))
+    assert response.status_code == 400
+
 def test_add_comment(client):
     user = datamodels.User(
         email='user@example.com',
@@ -446,3 +871,76 @@ def test_add_comment_no_connection(client):
     assert response.status_code == 404
     assert response.data == b'Connection id (does not exist) not found'
     assert datamodels.Comment.get() is None
+
+def test_get_posts_width(client):
+    user = datamodels.User(
+        email='user@example.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    user.save()
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='handle',
+        user_id=user.id,
+    )
+    profile.save()
+    post = datamodels.Post(
+        text='Test Post',
+        profile=profile,
+        files=['photo.jpg', 'attachment.txt'],
+        variants={
+            'photo.jpg': {'320': 'photo_320w.jpg', '640': 'photo_640w.jpg'},
+            'attachment.txt': {},
+        },
+    )
+    post.save()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = user.id
+        sess['authenticated_user'] = user.as_json()
+        sess['user'] = profile.as_json()
+    response = client.get('/get-posts?width=400')
+    assert response.status_code == 200
+    assert json.loads(response.data)[0]['files'] == [
+        'test_photo_640w.jpg', 'test_attachment.txt'
+    ]
+    # test datamodels hand back the same (now signed) post object
+    post.files = ['photo.jpg', 'attachment.txt']
+    response = client.get('/get-posts')
+    assert json.loads(response.data)[0]['files'] == [
+        'test_photo.jpg', 'test_attachment.txt'
+    ]
+    response = client.get('/get-posts?width=0')
+    assert response.status_code == 400
+
+def test_create_post_queues_media_processing(client, tmp_path):
+    client.application.object_store = LocalObjectStore(str(tmp_path))
+    user = datamodels.User(
+        email='user@example.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    user.save()
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='user_handle',
+        user_id=user.id,
+    )
+    profile.save()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = user.id
+        sess['authenticated_user'] = user.as_json()
+        sess['user'] = profile.as_json()
+    client.get('/')
+    response = client.post(url_for('main.create_post'), data={
+        'post': 'This is a test post',
+        'file-1': (BytesIO(b'file data'), 'photo.jpg')
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    post = datamodels.Post.get(profile=profile)
+    client.application.task_manager.queue_task.assert_any_call(
+        {
+            'kind': 'post',
+            'id': post.id,
+        },
+        'process-media',
+        url_for('queue_workers.process_media')
+    )
@@ -0,0 +1,36 @@
+import json
+
+from socialmedia import metrics
+from test import datamodels
+from .utils import client
+
+def _sign_in(client, admin):
+    user = datamodels.User(
+        email='admin@example.com',
+        id=2,
+        admin=admin,
+    )
+    with client.session_transaction() as sess:
+        sess['_user_id'] = 2
+        sess['authenticated_user'] = user.as_json()
+
+def test_metrics(client):
+    metrics.register('test_metric', lambda: {'value': 1})
+    try:
+        _sign_in(client, True)
+        response = client.get('/metrics/')
+        assert response.status_code == 200
+        response_json = json.loads(response.data)
+        assert response_json['test_metric'] == {'value': 1}
+        assert 'hit_rate' in response_json['key_cache']
+    finally:
+        metrics.unregister('test_metric')
+
+def test_metrics_not_admin(client):
+    _sign_in(client, False)
+    response = client.get('/metrics/')
+    assert response.status_code == 401
+
+def test_metrics_not_authenticated(client):
+    response = client.get('/metrics/')
+    assert response.status_code == 401
@@ -1,12 +1,19 @@
+import base64
+import io
+import json
+import os
+
 from collections import namedtuple
 from datetime import datetime, timedelta
 from dateutil import tz
 from flask import url_for
+from PIL import Image
 from unittest import mock
 from uuid import UUID
 
 from socialmedia import connection_status
-from socialmedia.views.utils import decrypt_payload
+from socialmedia.composite_upload import LocalObjectStore
+from socialmedia.views.utils import decrypt_payload, open_envelope
 from test import datamodels
 from .utils import client
 
@@ -24,7 +31,7 @@ def test_request_connection(client):
         user_id=user.id,
     )
     profile.save()
-    with mock.patch('socialmedia.views.queue_workers.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         req.post.return_value = MockResponse(200, None)
         response = client.post(url_for('queue_workers.request_connection'), json={
             'user_host': 'localhost',
@@ -43,6 +50,30 @@ def test_request_connection(client):
         assert 'enc_payload' in req.post.call_args[1]['json']
         assert req.post.call_args[1]['json']['handle'] == 'other_user'
 
+def test_request_connection_advertises_ec_key(client):
+    ec_public_key, ec_private_key = datamodels.Profile.generate_ec_keys()
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='handle',
+        user_id=datamodels.User.generate_uuid(),
+        ec_public_key=ec_public_key,
+        ec_private_key=ec_private_key,
+    )
+    profile.save()
+    with mock.patch.object(client.application, 'http_client') as req:
+        req.post.return_value = MockResponse(200, None)
+        response = client.post(url_for('queue_workers.request_connection'), json={
+            'user_host': 'localhost',
+            'user_key': profile.user_id,
+            'host': 'otherhost.com',
+            'handle': 'other_user',
+        })
+        assert response.status_code == 200
+        request_payload = json.loads(
+            base64.b64decode(req.post.call_args[1]['json']['enc_payload'])
+        )
+        assert request_payload['requestor_ec_public_key'] == ec_public_key
+
 def test_request_connection_failed(client):
     user = datamodels.User(
         email='user@example.com',
@@ -55,7 +86,7 @@ def test_request_connection_failed(client):
         user_id=user.id,
     )
     profile.save()
-    with mock.patch('socialmedia.views.queue_workers.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         req.post.return_value = MockResponse(500, 'Something went wrong')
         response = client.post(url_for('queue_workers.request_connection'), json={
             'user_host': 'localhost',
@@ -99,7 +130,7 @@ def test_ack_connection(client):
         updated=(datetime.now() - timedelta(days=1)).astimezone(tz.UTC),
     )
     connection.save()
-    with mock.patch('socialmedia.views.queue_workers.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         req.post.return_value = MockResponse(200, None)
         response = client.post(url_for('queue_workers.ack_connection'), json={
             'user_host': 'localhost',
@@ -146,7 +177,7 @@ def test_ack_connection_no_valid_connection(client):
         handle='other_handle',
         user_id=other_user.id,
     )
-    with mock.patch('socialmedia.views.queue_workers.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         req.post.return_value = MockResponse(200, None)
         response = client.post(url_for('queue_workers.ack_connection'), json={
             'user_host': 'localhost',
@@ -190,7 +221,7 @@ def test_ack_connection_reply_failed(client):
         updated=created,
     )
     connection.save()
-    with mock.patch('socialmedia.views.queue_workers.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         req.post.return_value = MockResponse(404, 'Connection not found')
         response = client.post(url_for('queue_workers.ack_connection'), json={
             'user_host': 'localhost',
@@ -230,6 +261,22 @@ def test_post_created(client):
         status=connection_status.CONNECTED,
     )
     connection_two.save()
+    connection_three = datamodels.Connection(
+        profile=profile,
+        host='other_host.com',
+        handle='another_handle',
+        display_name='Another Name',
+        status=connection_status.CONNECTED,
+    )
+    connection_three.save()
+    # not connected yet, so not notified
+    pending_connection = datamodels.Connection(
+        profile=profile,
+        host='other_host.com',
+        handle='pending_handle',
+        status=connection_status.REQUESTED,
+    )
+    pending_connection.save()
     post = datamodels.Post(
         profile=profile,
         text='Post Text',
@@ -244,21 +291,213 @@ def test_post_created(client):
         {
             'user_key': post.profile.user_id,
             'post_id': post.id,
-            'connection_key': connection_one.id,
+            'host': 'other_host.com',
+            'connection_keys': [connection_one.id, connection_three.id],
         },
         'post-notify',
-        url_for('queue_workers.post_notify')
+        url_for('queue_workers.post_notify_batch')
     )
     client.application.task_manager.queue_task.assert_any_call(
         {
             'user_key': post.profile.user_id,
             'post_id': post.id,
-            'connection_key': connection_two.id,
+            'host': 'different_host.com',
+            'connection_keys': [connection_two.id],
+        },
+        'post-notify',
+        url_for('queue_workers.post_notify_batch')
+    )
+
+def test_post_created_batch_size(client):
+    client.application.config['POST_NOTIFY_BATCH_SIZE'] = 2
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='handle',
+        user_id=datamodels.User.generate_uuid(),
+    )
+    profile.save()
+    connections = []
+    for i in range(5):
+        connection = datamodels.Connection(
+            profile=profile,
+            host='other_host.com',
+            handle=f'other_handle_{i}',
+            status=connection_status.CONNECTED,
+        )
+        connection.save()
+        connections.append(connection)
+    post = datamodels.Post(
+        profile=profile,
+        text='Post Text',
+    )
+    post.save()
+    response = client.post(url_for('queue_workers.post_created'), json={
+        'post_id': post.id,
+    })
+    assert response.status_code == 200
+    queued_keys = [
+        call[0][0]['connection_keys']
+        for call in client.application.task_manager.queue_task.call_args_list
+    ]
+    assert queued_keys == [
+        [connections[0].id, connections[1].id],
+        [connections[2].id, connections[3].id],
+        [connections[4].id],
+    ]
+
+def _batch_test_connections():
+    user = datamodels.User(
+        email='user@example.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    user.save()
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='handle',
+        user_id=user.id,
+    )
+    profile.save()
+    other_profiles = []
+    connections = []
+    for handle in ('other_one', 'other_two'):
+        other_profile = datamodels.Profile(
+            display_name=handle,
+            handle=handle,
+            user_id=datamodels.User.generate_uuid(),
+        )
+        connection = datamodels.Connection(
+            profile=profile,
+            host='other_host.com',
+            handle=handle,
+            status=connection_status.CONNECTED,
+            public_key=other_profile.public_key,
+        )
+        connection.save()
+        other_profiles.append(other_profile)
+        connections.append(connection)
+    return user, connections, other_profiles
+
+def test_post_notify_batch(client):
+    user, connections, other_profiles = _batch_test_connections()
+    with mock.patch.object(client.application, 'http_client') as req:
+        req.post.return_value = MockResponse(200, json.dumps({'results': [
+            {'handle': 'other_one', 'status': 200},
+            {'handle': 'other_two', 'status': 200},
+        ]}))
+        response = client.post(url_for('queue_workers.post_notify_batch'), json={
+            'user_key': user.id,
+            'post_id': 'mock_post_id',
+            'host': 'other_host.com',
+            'connection_keys': [c.id for c in connections],
+        })
+        assert response.status_code == 200
+        assert req.post.call_count == 1
+        assert req.post.call_args[0][0] == \
+            f'https://other_host.com{url_for("external_comms.post_notify_batch")}'
+        notifications = req.post.call_args[1]['json']['notifications']
+        assert [n['handle'] for n in notifications] == ['other_one', 'other_two']
+        for notification, other_profile in zip(notifications, other_profiles):
+            request_payload = decrypt_payload(
+                other_profile,
+                notification['enc_key'],
+                notification['enc_payload'],
+                notification['nonce'],
+                notification['tag'],
+            )
+            assert request_payload == {
+                'post_host': 'localhost',
+                'post_handle': 'handle',
+                'post_ids': ['mock_post_id'],
+            }
+    assert client.application.task_manager.queue_task.call_count == 0
+
+def test_post_notify_batch_not_supported(client):
+    user, connections, other_profiles = _batch_test_connections()
+    with mock.patch.object(client.application, 'http_client') as req:
+        req.post.return_value = MockResponse(404, 'Not Found')
+        response = client.post(url_for('queue_workers.post_notify_batch'), json={
+            'user_key': user.id,
+            'post_id': 'mock_post_id',
+            'host': 'other_host.com',
+            'connection_keys': [c.id for c in connections],
+        })
+        assert response.status_code == 200
+    # falls back to notifying connections one at a time
+    assert client.application.task_manager.queue_task.call_count == 2
+    for connection in connections:
+        client.application.task_manager.queue_task.assert_any_call(
+            {
+                'user_key': user.id,
+                'post_id': 'mock_post_id',
+                'connection_key': connection.id,
+            },
+            'post-notify',
+            url_for('queue_workers.post_notify')
+        )
+
+def test_post_notify_batch_partial_failure(client):
+    user, connections, other_profiles = _batch_test_connections()
+    with mock.patch.object(client.application, 'http_client') as req:
+        req.post.return_value = MockResponse(200, json.dumps({'results': [
+            {'handle': 'other_one', 'status': 200},
+            {'handle': 'other_two', 'status': 404},
+        ]}))
+        response = client.post(url_for('queue_workers.post_notify_batch'), json={
+            'user_key': user.id,
+            'post_id': 'mock_post_id',
+            'host': 'other_host.com',
+            'connection_keys': [c.id for c in connections],
+        })
+        assert response.status_code == 200
+    # only the failed connection is retried
+    client.application.task_manager.queue_task.assert_called_once_with(
+        {
+            'user_key': user.id,
+            'post_id': 'mock_post_id',
+            'connection_key': connections[1].id,
+        },
+        'post-notify',
+        url_for('queue_workers.post_notify')
+    )
+
+def test_post_notify_batch_missing_results(client):
+    user, connections, other_profiles = _batch_test_connections()
+    with mock.patch.object(client.application, 'http_client') as req:
+        req.post.return_value = MockResponse(200, json.dumps({'results': [
+            {'handle': 'other_one', 'status': 200},
+        ]}))
+        response = client.post(url_for('queue_workers.post_notify_batch'), json={
+            'user_key': user.id,
+            'post_id': 'mock_post_id',
+            'host': 'other_host.com',
+            'connection_keys': [c.id for c in connections],
+        })
+        assert response.status_code == 200
+        assert response.data == b'1 connections on other_host.com notified'
+    # the connection with no result is retried
+    client.application.task_manager.queue_task.assert_called_once_with(
+        {
+            'user_key': user.id,
+            'post_id': 'mock_post_id',
+            'connection_key': connections[1].id,
         },
         'post-notify',
         url_for('queue_workers.post_notify')
     )
 
+def test_post_notify_batch_failed(client):
+    user, connections, other_profiles = _batch_test_connections()
+    with mock.patch.object(client.application, 'http_client') as req:
+        req.post.return_value = MockResponse(500, 'Server Error')
+        response = client.post(url_for('queue_workers.post_notify_batch'), json={
+            'user_key': user.id,
+            'post_id': 'mock_post_id',
+            'host': 'other_host.com',
+            'connection_keys': [c.id for c in connections],
+        })
+        assert response.status_code == 500
+    assert client.application.task_manager.queue_task.call_count == 0
+
 def test_post_created_no_such_post(client):
     response = client.post(url_for('queue_workers.post_created'), json={
         'post_id': 'bogus',
@@ -297,7 +536,7 @@ def test_post_notify(client):
         public_key=other_profile.public_key,
     )
     connection.save()
-    with mock.patch('socialmedia.views.queue_workers.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         req.post.return_value = MockResponse(200, None)
         response = client.post(url_for('queue_workers.post_notify'), json={
             'user_key': user.id,
@@ -350,7 +589,7 @@ def test_post_notify_failed(client):
         public_key=other_profile.public_key,
     )
     connection.save()
-    with mock.patch('socialmedia.views.queue_workers.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         req.post.return_value = MockResponse(500, b'Oops')
         response = client.post(url_for('queue_workers.post_notify'), json={
             'user_key': user.id,
@@ -390,7 +629,7 @@ def test_comment_created(client):
         public_key=other_profile.public_key,
     )
     connection.save()
-    with mock.patch('socialmedia.views.queue_workers.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         req.post.return_value = MockResponse(200, None)
         response = client.post(url_for('queue_workers.comment_created'), json={
             'user_key': profile.user_id,
@@ -432,7 +671,7 @@ def test_comment_created_notification_failed(client):
         public_key=other_profile.public_key,
     )
     connection.save()
-    with mock.patch('socialmedia.views.queue_workers.requests') as req:
+    with mock.patch.object(client.application, 'http_client') as req:
         req.post.return_value = MockResponse(404, 'Connection not found')
         response = client.post(url_for('queue_workers.comment_created'), json={
             'user_key': profile.user_id,
@@ -443,3 +682,196 @@ def test_comment_created_notification_failed(client):
         })
         assert response.status_code == 404
         assert response.data == b'New comment notify failed 404:Connection not found'
+
+def _session_test_connection():
+    user = datamodels.User(
+        email='user@example.com',
+        id=datamodels.User.generate_uuid(),
+    )
+    user.save()
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='handle',
+        user_id=user.id,
+    )
+    profile.save()
+    other_profile = datamodels.Profile(
+        display_name='Other User',
+        handle='other_handle',
+        user_id=datamodels.User.generate_uuid(),
+    )
+    connection = datamodels.Connection(
+        profile=profile,
+        host='other_host.com',
+        handle='other_handle',
+        display_name='Other Name',
+        status=connection_status.CONNECTED,
+        public_key=other_profile.public_key,
+    )
+    connection.save()
+    return user, connection, other_profile
+
+def _session_responses(establish_status):
+    # establish-session gets establish_status, everything else succeeds
+    def post(url, **kwargs):
+        if url.endswith(url_for('external_comms.establish_session')):
+            return MockResponse(establish_status, None)
+        return MockResponse(200, None)
+    return post
+
+def _establish_calls(req):
+    return [
+        call for call in req.post.call_args_list
+        if call[0][0].endswith(url_for('external_comms.establish_session'))
+    ]
+
+def test_post_notify_establishes_session(client):
+    client.application.config['SESSION_KEYS'] = True
+    user, connection, other_profile = _session_test_connection()
+    with mock.patch.object(client.application, 'http_client') as req:
+        req.post.side_effect = _session_responses(200)
+        response = client.post(url_for('queue_workers.post_notify'), json={
+            'user_key': user.id,
+            'post_id': 'mock_post_id',
+            'connection_key': connection.id,
+        })
+        assert response.status_code == 200
+        establish_calls = _establish_calls(req)
+        assert len(establish_calls) == 1
+        assert establish_calls[0][0][0] == \
+            f'https://other_host.com{url_for("external_comms.establish_session")}'
+        session_request = establish_calls[0][1]['json']
+        session_payload = decrypt_payload(
+            other_profile,
+            session_request['enc_key'],
+            session_request['enc_payload'],
+            session_request['nonce'],
+            session_request['tag'],
+        )
+        assert session_payload['session_id'] == connection.session_id
+        assert session_payload['session_key'] == connection.session_key
+        assert connection.session_expires > datetime.now().astimezone(tz.UTC)
+
+        request_data = req.post.call_args[1]['json']
+        assert request_data['session_id'] == connection.session_id
+        assert 'enc_key' not in request_data
+        # the other side's view of the connection
+        other_connection = datamodels.Connection(
+            profile=other_profile,
+            host='localhost',
+            handle='handle',
+            status=connection_status.CONNECTED,
+            session_id=connection.session_id,
+            session_key=connection.session_key,
+            session_expires=connection.session_expires,
+        )
+        request_payload = open_envelope(other_profile, other_connection, request_data)
+        assert request_payload['post_id'] == 'mock_post_id'
+
+        # the session is reused for the next notification
+        response = client.post(url_for('queue_workers.post_notify'), json={
+            'user_key': user.id,
+            'post_id': 'mock_post_id_2',
+            'connection_key': connection.id,
+        })
+        assert response.status_code == 200
+        assert len(_establish_calls(req)) == 1
+        assert req.post.call_count == 3
+        assert req.post.call_args[1]['json']['session_id'] == connection.session_id
+
+def test_post_notify_session_refused(client):
+    client.application.config['SESSION_KEYS'] = True
+    user, connection, other_profile = _session_test_connection()
+    with mock.patch.object(client.application, 'http_client') as req:
+        req.post.side_effect = _session_responses(404)
+        for post_id in ('mock_post_id', 'mock_post_id_2'):
+            response = client.post(url_for('queue_workers.post_notify'), json={
+                'user_key': user.id,
+                'post_id': post_id,
+                'connection_key': connection.id,
+            })
+            assert response.status_code == 200
+            request_data = req.post.call_args[1]['json']
+            assert 'enc_key' in request_data
+            assert 'session_id' not in request_data
+        # not asked again until the retry time passes
+        assert len(_establish_calls(req)) == 1
+        assert connection.session_key is None
+        assert connection.session_expires > datetime.now().astimezone(tz.UTC)
+
+def test_process_media(client, tmp_path):
+    store = client.application.object_store = LocalObjectStore(str(tmp_path))
+    image = io.BytesIO()
+    Image.new('RGB', (1000, 1000)).save(image, format='JPEG')
+    store.upload('photo.jpg', image.getvalue())
+    store.upload('file.txt', b'not an image')
+    profile = datamodels.Profile(
+        display_name='User',
+        handle='handle',
+        user_id=datamodels.User.generate_uuid(),
+    )
+    post = datamodels.Post(
+        profile=profile,
+        text='Post Text',
+        files=['photo.jpg', 'file.txt'],
+    )
+    post.save()
+    response = client.post(url_for('queue_workers.process_media'), json={
+        'kind': 'post',
+        'id': post.id,
+    })
+    assert response.status_code == 200
+    assert post.variants == {
+        'photo.jpg': {'320': 'photo_320w.jpg', '640': 'photo_640w.jpg'},
+        'file.txt': {},
+    }
+    assert sorted(os.listdir(tmp_path)) == [
+        'file.txt', 'photo.jpg', 'photo_320w.jpg', 'photo_640w.jpg'
+    ]
+
+def test_process_media_not_found(client, tmp_path):
+    client.application.object_store = LocalObjectStore(str(tmp_path))
+    response = client.post(url_for('queue_workers.process_media'), json={
+        'kind': 'comment',
+        'id': 'bogus',
+    })
+    assert response.status_code == 404
+    response = client.post(url_for('queue_workers.process_media'), json={
+        'kind': 'bogus',
+        'id': 'bogus',
+    })
+    assert response.status_code == 400
+
+def test_process_media_no_object_store(client):
+    response = client.post(url_for('queue_workers.process_media'), json={
+        'kind': 'post',
+        'id': 'bogus',
+    })
+    assert response.status_code == 200
+
+def test_repair_counters(client):
+    profiles = [
+        datamodels.Profile(
+            display_name=f'User {i}',
+            handle=f'handle{i}',
+            user_id=datamodels.User.generate_uuid(),
+        ) for i in range(2)
+    ]
+    for profile in profiles:
+        profile.save()
+    response = client.get(url_for('queue_workers.repair_counters'))
+    assert response.status_code == 401
+    with mock.patch.object(
+        datamodels.Post, 'repair_count', side_effect=[(3, 3), (5, 4)]
+    ) as repair_count:
+        response = client.get(
+            url_for('queue_workers.repair_counters'),
+            headers={'X-Appengine-Cron': 'true'},
+        )
+    assert response.status_code == 200
+    assert response.json == {
+        'repaired': [{'handle': 'handle1', 'was': 5, 'count': 4}]
+    }
+    assert repair_count.call_args_list == [
+        mock.call(profile=profile) for profile in profiles
+    ]
@@ -0,0 +1,315 @@
+import json
+import threading
+import time
+
+from collections import namedtuple
+
+from flask import current_app
+
+import pytest
+
+from datetime import datetime, timedelta
+from dateutil import tz
+from unittest import mock
+from Crypto.PublicKey import RSA
+
+from socialmedia import connection_status
+from socialmedia.crypto_executor import CryptoExecutor
+from socialmedia.views.utils import (
+    EC_SUITE,
+    fan_out,
+    FanOutTimeout,
+    get_comment_references,
+    get_post_comments,
+    import_key,
+    key_cache,
+    open_envelope,
+    remote_comments_cache,
+    rotate_session,
+    secure_envelope,
+    verify_signature,
+)
+from test import datamodels
+from .utils import client
+
+def test_fan_out(client):
+    def double(item):
+        return item * 2
+    assert fan_out(double, [1, 2, 3], 2) == [2, 4, 6]
+
+def test_fan_out_empty(client):
+    assert fan_out(lambda item: item, [], 2) == []
+
+def test_fan_out_exception(client):
+    def fail_on_two(item):
+        if item == 2:
+            raise ValueError('two')
+        return item
+    results = fan_out(fail_on_two, [1, 2, 3], 3)
+    assert results[0] == 1
+    assert isinstance(results[1], ValueError)
+    assert results[2] == 3
+
+def test_fan_out_runs_concurrently(client):
+    lock = threading.Lock()
+    running = {'now': 0, 'max': 0}
+    def track(item):
+        with lock:
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+        time.sleep(0.05)
+        with lock:
+            running['now'] -= 1
+        return item
+    assert fan_out(track, list(range(6)), 3) == list(range(6))
+    assert running['max'] == 3
+
+def test_fan_out_timeout(client):
+    def slow_on_two(item):
+        if item == 2:
+            time.sleep(1)
+        return item
+    _timer = time.time()
+    results = fan_out(slow_on_two, [1, 2, 3], 3, timeout=0.1)
+    assert time.time() - _timer < 1
+    assert results[0] == 1
+    assert isinstance(results[1], FanOutTimeout)
+    assert results[2] == 3
+
+def test_fan_out_deadline(client):
+    def slow_on_two(item):
+        if item == 2:
+            time.sleep(1)
+        return item
+    _timer = time.time()
+    results = fan_out(slow_on_two, [1, 2, 3], 3, deadline=0.1)
+    assert time.time() - _timer < 1
+    assert isinstance(results[1], FanOutTimeout)
+    assert results[2] == 3
+
+def test_fan_out_app_context(client):
+    app = client.application
+    def get_app(item):
+        return current_app._get_current_object()
+    assert fan_out(get_app, [1], 1) == [app]
+
+def test_import_key():
+    key_cache.clear()
+    pem = RSA.generate(1024).export_key()
+    key = import_key(pem)
+    # str and bytes versions of a PEM share a cache entry
+    assert import_key(pem.decode()) is key
+    # a different key is a different entry
+    other_pem = RSA.generate(1024).export_key()
+    assert import_key(other_pem) != key
+    assert len(key_cache) == 2
+
+def _connection_pair(**session):
+    profile = datamodels.Profile(display_name='User', handle='handle', user_id='1')
+    other_profile = datamodels.Profile(display_name='Other', handle='other', user_id='2')
+    # each side's connection to the other
+    connection = datamodels.Connection(
+        profile=profile, host='other_host.com', handle='other',
+        public_key=other_profile.public_key, status=connection_status.CONNECTED,
+        **session,
+    )
+    other_connection = datamodels.Connection(
+        profile=other_profile, host='localhost', handle='handle',
+        public_key=profile.public_key, status=connection_status.CONNECTED,
+        **session,
+    )
+    return profile, connection, other_profile, other_connection
+
+def test_envelope_rsa(client):
+    profile, connection, other_profile, other_connection = _connection_pair()
+    envelope = secure_envelope(profile, connection, {'a': 1})
+    assert 'enc_key' in envelope
+    assert 'session_id' not in envelope
+    assert open_envelope(other_profile, other_connection, envelope) == {'a': 1}
+
+def test_envelope_session(client):
+    profile, connection, other_profile, other_connection = _connection_pair(
+        session_id='session',
+        session_key='00' * 32,
+        session_expires=datetime.now().astimezone(tz.UTC) + timedelta(hours=1),
+    )
+    envelope = secure_envelope(profile, connection, {'a': 1})
+    assert envelope['session_id'] == 'session'
+    assert 'enc_key' not in envelope
+    assert 'signature' not in envelope
+    assert open_envelope(other_profile, other_connection, envelope) == {'a': 1}
+    envelope['mac'] = '00' * 32
+    with pytest.raises(ValueError):
+        open_envelope(other_profile, other_connection, envelope)
+    other_connection.session_id = 'other_session'
+    with pytest.raises(ValueError):
+        open_envelope(other_profile, other_connection, envelope)
+
+def test_envelope_session_rotated(client):
+    session_expires = datetime.now().astimezone(tz.UTC) + timedelta(hours=1)
+    profile, connection, other_profile, other_connection = _connection_pair(
+        session_id='session',
+        session_key='00' * 32,
+        session_expires=session_expires,
+    )
+    envelope = secure_envelope(profile, connection, {'a': 1})
+    rotate_session(other_connection, 'new_session', '11' * 32, session_expires)
+    assert other_connection.prev_session_id == 'session'
+    # envelopes sent under the session that was replaced can still be opened
+    assert open_envelope(other_profile, other_connection, envelope) == {'a': 1}
+    rotate_session(connection, 'new_session', '11' * 32, session_expires)
+    envelope = secure_envelope(profile, connection, {'b': 2})
+    assert open_envelope(other_profile, other_connection, envelope) == {'b': 2}
+    # only the last session replaced is kept
+    rotate_session(other_connection, 'newer_session', '22' * 32, session_expires)
+    envelope = secure_envelope(profile, connection, {'b': 2})
+    assert open_envelope(other_profile, other_connection, envelope) == {'b': 2}
+    connection.session_id = 'session'
+    connection.session_key = '00' * 32
+    envelope = secure_envelope(profile, connection, {'a': 1})
+    with pytest.raises(ValueError):
+        open_envelope(other_profile, other_connection, envelope)
+
+def test_envelope_session_expired(client):
+    profile, connection, other_profile, other_connection = _connection_pair(
+        session_id='session',
+        session_key='00' * 32,
+        session_expires=datetime.now().astimezone(tz.UTC) - timedelta(seconds=1),
+    )
+    # expired sessions fall back to RSA
+    envelope = secure_envelope(profile, connection, {'a': 1})
+    assert 'enc_key' in envelope
+    assert open_envelope(other_profile, other_connection, envelope) == {'a': 1}
+
+def _add_ec_keys(profile, connection):
+    profile.ec_public_key, profile.ec_private_key = datamodels.Profile.generate_ec_keys()
+    connection.ec_public_key = profile.ec_public_key
+
+def test_envelope_ec(client):
+    profile, connection, other_profile, other_connection = _connection_pair()
+    _add_ec_keys(profile, other_connection)
+    _add_ec_keys(other_profile, connection)
+    envelope = secure_envelope(profile, connection, {'a': 1})
+    assert envelope['suite'] == EC_SUITE
+    assert open_envelope(other_profile, other_connection, envelope) == {'a': 1}
+    assert verify_signature(other_connection, envelope['signature'], {'a': 1}, EC_SUITE)
+    with pytest.raises(ValueError):
+        verify_signature(other_connection, envelope['signature'], {'a': 2}, EC_SUITE)
+    # the RSA key doesn't verify EC signatures
+    other_connection.ec_public_key = None
+    assert not verify_signature(other_connection, envelope['signature'], {'a': 1}, EC_SUITE)
+
+def test_envelope_ec_one_side(client):
+    profile, connection, other_profile, other_connection = _connection_pair()
+    # only the sender has EC keys - the receiver's connection knows them,
+    # but the sender has nothing to wrap keys for
+    _add_ec_keys(profile, other_connection)
+    envelope = secure_envelope(profile, connection, {'a': 1})
+    assert 'suite' not in envelope
+    assert open_envelope(other_profile, other_connection, envelope) == {'a': 1}
+
+def test_envelope_crypto_executor(client):
+    profile, connection, other_profile, other_connection = _connection_pair()
+    _add_ec_keys(profile, other_connection)
+    _add_ec_keys(other_profile, connection)
+    executor = CryptoExecutor(kind='process', workers=1)
+    with mock.patch.object(client.application, 'crypto_executor', executor):
+        try:
+            envelope = secure_envelope(profile, connection, {'a': 1})
+            assert open_envelope(other_profile, other_connection, envelope) == {'a': 1}
+            assert verify_signature(other_connection, envelope['signature'], {'a': 1}, EC_SUITE)
+            envelope = secure_envelope(other_profile, other_connection, {'b': 2})
+            with pytest.raises(ValueError):
+                verify_signature(connection, envelope['signature'], {'b': 3}, EC_SUITE)
+        finally:
+            executor.shutdown()
+    stats = executor.stats()
+    assert stats['calls'] == 5
+    assert stats['errors'] == 1
+
+def test_envelope_compressed(client):
+    profile, connection, other_profile, other_connection = _connection_pair()
+    payload = {'posts': [{'text': 'the same post again'} for _ in range(200)]}
+    envelope = secure_envelope(profile, connection, payload, accept_compression=['zlib'])
+    assert envelope['compression'] == 'zlib'
+    uncompressed = secure_envelope(profile, connection, payload)
+    assert 'compression' not in uncompressed
+    assert len(envelope['enc_payload']) < len(uncompressed['enc_payload']) / 10
+    assert open_envelope(other_profile, other_connection, envelope) == payload
+    # small payloads aren't worth it
+    envelope = secure_envelope(profile, connection, {'a': 1}, accept_compression=['zlib'])
+    assert 'compression' not in envelope
+    # nothing in common
+    envelope = secure_envelope(profile, connection, payload, accept_compression=['brotli'])
+    assert 'compression' not in envelope
+    client.application.config['COMPRESSION'] = []
+    envelope = secure_envelope(profile, connection, payload, accept_compression=['zlib'])
+    assert 'compression' not in envelope
+
+def test_envelope_session_compressed(client):
+    profile, connection, other_profile, other_connection = _connection_pair(
+        session_id='session',
+        session_key='00' * 32,
+        session_expires=datetime.now().astimezone(tz.UTC) + timedelta(hours=1),
+    )
+    payload = {'posts': [{'text': 'the same post again'} for _ in range(200)]}
+    envelope = secure_envelope(profile, connection, payload, accept_compression=['zlib'])
+    assert envelope['session_id'] == 'session'
+    assert envelope['compression'] == 'zlib'
+    assert open_envelope(other_profile, other_connection, envelope) == payload
+
+def test_get_post_comments_incremental(client):
+    MockResponse = namedtuple('MockResponse', ['status_code', 'content'])
+    remote_comments_cache.clear()
+    profile, connection, other_profile, other_connection = _connection_pair()
+    now = datetime.now().astimezone(tz.UTC)
+    post = datamodels.Post(profile=profile, text='Post')
+    comment_references = {
+        post.id: [datamodels.CommentReference(connection=connection, post_id=post.id)]
+    }
+    comments = [
+        datamodels.Comment(
+            profile=other_profile, post_id=post.id, text=f'Comment {i}',
+            created=now - timedelta(minutes=2 - i),
+        ) for i in range(2)
+    ]
+
+    def response(comments):
+        envelope = secure_envelope(
+            other_profile, other_connection, [comment.as_json() for comment in comments]
+        )
+        return MockResponse(200, json.dumps(envelope))
+
+    with mock.patch.object(client.application, 'http_client') as req:
+        req.post.side_effect = [
+            response(comments[:1]),
+            # hosts that don't know about since send everything
+            response(comments),
+        ]
+        get_post_comments([post], comment_references, 'localhost')
+        assert [c.text for c in post.comments] == ['Comment 0']
+        post = datamodels.Post(profile=profile, id=post.id, text='Post')
+        get_post_comments([post], comment_references, 'localhost')
+    payloads = [
+        open_envelope(other_profile, other_connection, call.kwargs['json'])
+        for call in req.post.call_args_list
+    ]
+    assert 'since' not in payloads[0]
+    assert payloads[1]['since'] == {post.id: str(comments[0].created)}
+    assert [c.text for c in post.comments] == ['Comment 1', 'Comment 0']
+
+def test_get_comment_references(client):
+    profile, connection, other_profile, other_connection = _connection_pair()
+    posts = [datamodels.Post(profile=profile, text=f'Post {i}') for i in range(3)]
+    for post in posts[:2]:
+        datamodels.CommentReference(connection=connection, post_id=post.id).save()
+    datamodels.CommentReference(connection=connection, post_id='other post').save()
+    with mock.patch.object(
+        datamodels.CommentReference, 'list', wraps=datamodels.CommentReference.list
+    ) as comment_reference_list:
+        comment_references = get_comment_references(posts)
+    assert comment_reference_list.call_count == 1
+    assert sorted(comment_references) == sorted(post.id for post in posts[:2])
+    assert all(len(refs) == 1 for refs in comment_references.values())
+    assert posts[2].id not in comment_references
+    assert get_comment_references([]) == {}
@@ -5,6 +5,7 @@ from flask import _request_ctx_stack
 from unittest.mock import Mock
 
 from socialmedia import create_app
+from socialmedia.key_pool import KeyPool
 
 from test import datamodels
 from test.datamodels.base import BaseTestModel
@@ -14,7 +15,11 @@ def generate_signed_urls(files, expiration=60):
 
 @pytest.fixture
 def client():
-    app = create_app(datamodels, None, generate_signed_urls, Mock(), Mock(), Mock(), Mock())
+    # no pool processes in tests - keys are generated when they're needed
+    app = create_app(
+        datamodels, None, generate_signed_urls, Mock(), Mock(), Mock(), Mock(),
+        key_pool=KeyPool(size=0),
+    )
     with app.test_client() as client:
         # init the flask app context
         client.get('/')